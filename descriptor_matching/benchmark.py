@@ -0,0 +1,256 @@
+import cv2
+import numpy as np
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+import create_descriptor_data_base
+from descriptor_matcher import DescriptorMatcher
+from descriptor_store import is_npy_store
+from flann_index import index_paths
+from profiling import reset_timing, timing_report
+
+# Columns of the results table, in CSV order
+RESULT_FIELDS = [
+    'map_size', 'subregion_size', 'step', 'backend', 'feature_type', 'rows', 'build_s', 'db_bytes', 'index_bytes',
+    'load_ms', 'index_build_ms', 'query_p50_ms', 'query_p90_ms', 'query_p99_ms', 'top1_hit_rate', 'topk_hit_rate',
+]
+
+def synthesize_map(seed_image, size, rng, noise=4.0):
+    """
+    Grows a seed image into a square map of tiles, each a random crop of the seed resized to the tile side, turned
+    by a random multiple of 90 degrees, possibly flipped, with its own gain, offset and noise.
+
+    Tiling exact copies of the seed would make the map periodic, so a query would have several equally good true
+    locations and the hit rates would measure tie-breaking. Random crop offsets and sizes make every tile a
+    different view of the seed.
+
+    Args:
+        seed_image (numpy.ndarray): The grayscale seed image.
+        size (int): The side of the map in pixels.
+        rng (numpy.random.Generator): The random generator.
+        noise (float, optional): The standard deviation of the Gaussian noise added to each tile. Defaults to 4.0.
+
+    Returns:
+        numpy.ndarray: The (size, size) map.
+    """
+    seed_side = min(seed_image.shape[:2])
+    tile = max(seed_side // 2, 1)
+    n_tiles = -(-size // tile)
+    rows = []
+    for _ in range(n_tiles):
+        row = []
+        for _ in range(n_tiles):
+            side = int(rng.integers(tile, seed_side + 1))
+            top = int(rng.integers(0, seed_image.shape[0] - side + 1))
+            left = int(rng.integers(0, seed_image.shape[1] - side + 1))
+            patch = cv2.resize(seed_image[top:top + side, left:left + side], (tile, tile), interpolation=cv2.INTER_AREA)
+            patch = np.rot90(patch, int(rng.integers(4)))
+            if rng.integers(2):
+                patch = patch[:, ::-1]
+            patch = patch * rng.uniform(0.8, 1.2) + rng.uniform(-20, 20) + rng.normal(0, noise, patch.shape)
+            row.append(np.clip(patch, 0, 255).astype(np.uint8))
+        rows.append(np.concatenate(row, axis=1))
+    return np.ascontiguousarray(np.concatenate(rows, axis=0)[:size, :size])
+
+def sample_queries(train_image, n_queries, query_size, rng, noise=0.0):
+    """
+    Crops query frames at random known locations of a map.
+
+    Args:
+        train_image (numpy.ndarray): The grayscale map.
+        n_queries (int): The number of queries.
+        query_size (int): The side of each query in pixels.
+        rng (numpy.random.Generator): The random generator.
+        noise (float, optional): The standard deviation of Gaussian noise added to every query. Defaults to 0.0.
+
+    Returns:
+        list: One (query image, (center_y, center_x)) tuple per query.
+    """
+    height, width = train_image.shape[:2]
+    half = query_size // 2
+    queries = []
+    for _ in range(n_queries):
+        center_y = int(rng.integers(half, height - half))
+        center_x = int(rng.integers(half, width - half))
+        query = train_image[center_y - half:center_y - half + query_size, center_x - half:center_x - half + query_size]
+        if noise > 0:
+            query = np.clip(query + rng.normal(0, noise, query.shape), 0, 255).astype(np.uint8)
+        queries.append((query, (center_y, center_x)))
+    return queries
+
+def path_bytes(path):
+    """
+    Returns the size of a file, or the total size of the files in a directory.
+
+    Args:
+        path (str): The path.
+
+    Returns:
+        int: The size in bytes, 0 if the path does not exist.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def is_hit(coords, center, tolerance):
+    """
+    Checks whether a returned subregion is centered within tolerance pixels of the true query center on both axes.
+
+    Args:
+        coords (tuple): The coordinates of the returned subregion, starting with center_y and center_x.
+        center (tuple): The true (center_y, center_x) of the query.
+        tolerance (float): The largest allowed offset in pixels.
+
+    Returns:
+        bool: Whether the subregion counts as a hit.
+    """
+    return abs(coords[0] - center[0]) <= tolerance and abs(coords[1] - center[1]) <= tolerance
+
+def run_configuration(train_path, train_image, queries, db_name, subregion_size, step, top_k, backend='sqlite', feature_type='sift', extraction_mode='global', aggregate=False, geometric_top_k=0, tolerance=None, mask_path=None):
+    """
+    Builds one database, loads it into a DescriptorMatcher and times every query against it.
+
+    Args:
+        train_path (str): The path of the saved map.
+        train_image (numpy.ndarray): The map.
+        queries (list): The (query path, (center_y, center_x)) of every query.
+        db_name (str): The path of the database to build.
+        subregion_size (int): The side of each subregion.
+        step (int): The step between subregions.
+        top_k (int): The number of best matches searched for the true location.
+        backend (str, optional): The storage backend, 'sqlite' or 'npy'. Defaults to 'sqlite'.
+        feature_type (str, optional): The feature type of the database. Defaults to 'sift'.
+        extraction_mode (str, optional): The extraction mode, 'global' or 'per_window'. Defaults to 'global'.
+        aggregate (bool, optional): Whether queries return vote map peaks. Defaults to False.
+        geometric_top_k (int, optional): The number of candidates re-ranked by RANSAC inliers. Defaults to 0.
+        tolerance (float, optional): The largest offset of a hit in pixels. Defaults to the step.
+        mask_path (str, optional): The query mask passed to the DescriptorMatcher. Defaults to None, which ignores
+                                   the keypoints near the center of every query.
+
+    Returns:
+        dict: One row of the results table, with the build and matcher timing reports under 'build_report' and
+              'match_report'.
+    """
+    tolerance = step if tolerance is None else tolerance
+
+    reset_timing()
+    start = time.perf_counter()
+    create_descriptor_data_base.main(train_path, subregion_size, step, db_name, extraction_mode, backend=backend, feature_type=feature_type)
+    build_s = time.perf_counter() - start
+    build_report = timing_report()
+
+    index_bytes = sum(path_bytes(path) for path in index_paths(db_name))
+    db_bytes = path_bytes(db_name) - (index_bytes if is_npy_store(db_name) else 0)
+
+    reset_timing()
+    start = time.perf_counter()
+    matcher = DescriptorMatcher(db_name, train_path, mask_path)
+    load_ms = (time.perf_counter() - start) * 1000
+    index_build_ms = timing_report()['spans']['index_build']['wall_ms']
+
+    latencies = []
+    top1_hits = topk_hits = 0
+    for query_path, center in queries:
+        best_matches, timings = matcher.match(query_path, top_k, aggregate=aggregate, geometric_top_k=geometric_top_k)
+        latencies.append(timings['total_ms'])
+        hits = [is_hit(coords, center, tolerance) for _, coords in best_matches[:top_k]]
+        top1_hits += bool(hits) and hits[0]
+        topk_hits += any(hits)
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) if latencies else (np.nan, np.nan, np.nan)
+    return {
+        'map_size': train_image.shape[0],
+        'subregion_size': subregion_size,
+        'step': step,
+        'backend': backend,
+        'feature_type': feature_type,
+        'rows': len(matcher.db_descriptors) if matcher.db_descriptors is not None else len(matcher.db_coords),
+        'build_s': build_s,
+        'db_bytes': db_bytes,
+        'index_bytes': index_bytes,
+        'load_ms': load_ms,
+        'index_build_ms': index_build_ms,
+        'query_p50_ms': float(p50),
+        'query_p90_ms': float(p90),
+        'query_p99_ms': float(p99),
+        'top1_hit_rate': top1_hits / max(len(queries), 1),
+        'topk_hit_rate': topk_hits / max(len(queries), 1),
+        'build_report': build_report,
+        'match_report': timing_report(),
+    }
+
+def main(seed_image_path, map_sizes, subregion_sizes, steps, output_dir='output/benchmark', n_queries=20, top_k=5, backend='sqlite', feature_type='sift', extraction_mode='global', aggregate=False, geometric_top_k=0, tolerance=None, noise=0.0, seed=0):
+    seed_image = cv2.imread(seed_image_path, cv2.IMREAD_GRAYSCALE)
+    if seed_image is None:
+        raise FileNotFoundError(f"Could not read the seed image {seed_image_path}")
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # The queries are clean crops of the map, so none of their keypoints are masked out. An all-white mask keeps
+    # every keypoint instead of the default exclusion of the center of the frame
+    mask_path = os.path.join(output_dir, 'query_mask.png')
+    cv2.imwrite(mask_path, np.full((1, 1), 255, dtype=np.uint8))
+
+    results = []
+    for map_size in map_sizes:
+        train_image = synthesize_map(seed_image, map_size, rng)
+        train_path = os.path.join(output_dir, f"map_{map_size}.png")
+        cv2.imwrite(train_path, train_image)
+
+        for subregion_size, step in itertools.product(subregion_sizes, steps):
+            # Queries cover one subregion, so each grid gets its own set, drawn from the same seeded generator
+            query_dir = os.path.join(output_dir, f"queries_{map_size}_{subregion_size}")
+            os.makedirs(query_dir, exist_ok=True)
+            queries = []
+            for i, (query, center) in enumerate(sample_queries(train_image, n_queries, subregion_size, rng, noise)):
+                query_path = os.path.join(query_dir, f"query_{i:04d}.png")
+                cv2.imwrite(query_path, query)
+                queries.append((query_path, center))
+
+            db_name = os.path.join(output_dir, f"map_{map_size}_{subregion_size}_{step}" + ('' if backend == 'npy' else '.db'))
+            print(f"Benchmarking a {map_size} px map with subregion_size={subregion_size}, step={step}")
+            result = run_configuration(train_path, train_image, queries, db_name, subregion_size, step, top_k, backend, feature_type, extraction_mode, aggregate, geometric_top_k, tolerance, mask_path)
+            print({field: result[field] for field in RESULT_FIELDS})
+            results.append(result)
+
+    with open(os.path.join(output_dir, 'results.json'), 'w') as f:
+        json.dump({
+            'seed_image_path': seed_image_path,
+            'n_queries': n_queries,
+            'top_k': top_k,
+            'aggregate': aggregate,
+            'geometric_top_k': geometric_top_k,
+            'noise': noise,
+            'seed': seed,
+            'results': results,
+        }, f, indent=4)
+    with open(os.path.join(output_dir, 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark descriptor database builds and queries on synthetic maps of increasing size.')
+    parser.add_argument('--seed_image_path', type=str, required=True, help='Image tiled into the synthetic maps.')
+    parser.add_argument('--map_sizes', type=int, nargs='+', default=[1000, 2000, 4000], help='Sides of the synthetic square maps in pixels.')
+    parser.add_argument('--subregion_sizes', type=int, nargs='+', default=[400], help='Subregion sizes to benchmark.')
+    parser.add_argument('--steps', type=int, nargs='+', default=[100], help='Steps to benchmark.')
+    parser.add_argument('--output_dir', type=str, default='output/benchmark', help='Directory of the maps, queries, databases and results.')
+    parser.add_argument('--n_queries', type=int, default=20, help='Number of queries per configuration.')
+    parser.add_argument('--top_k', type=int, default=5, help='Number of best matches searched for the true location.')
+    parser.add_argument('--backend', type=str, default='sqlite', choices=['sqlite', 'npy'], help='Storage backend of the databases.')
+    parser.add_argument('--feature_type', type=str, default='sift', choices=['sift', 'orb', 'akaze'], help='Local feature of the databases.')
+    parser.add_argument('--extraction_mode', type=str, default='global', choices=['global', 'per_window'], help='Extraction mode of the databases.')
+    parser.add_argument('--aggregate', action='store_true', help='Match with the spatial vote map.')
+    parser.add_argument('--geometric_top_k', type=int, default=0, help='Number of candidates re-ranked by RANSAC inliers.')
+    parser.add_argument('--tolerance', type=float, default=None, help='Largest offset in pixels of a hit from the true query center. Defaults to the step.')
+    parser.add_argument('--noise', type=float, default=0.0, help='Standard deviation of the Gaussian noise added to the queries.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the query locations and noise.')
+
+    args = parser.parse_args()
+
+    main(args.seed_image_path, args.map_sizes, args.subregion_sizes, args.steps, args.output_dir, args.n_queries, args.top_k, args.backend, args.feature_type, args.extraction_mode, args.aggregate, args.geometric_top_k, args.tolerance, args.noise, args.seed)
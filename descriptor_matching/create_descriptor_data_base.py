@@ -2,9 +2,24 @@ import cv2
 import numpy as np
 import sqlite3
 from tqdm import tqdm
+import hashlib
 import os
 import argparse
-from multiprocessing import Pool, cpu_count
+import queue
+import threading
+from functools import partial
+from multiprocessing import Pool, cpu_count, shared_memory
+from descriptor_store import NpyStoreWriter, load_descriptor_store, read_features
+from feature_types import FEATURE_TYPES, feature_metadata, get_extractor
+from subregion_grid import grid_shape, level_shape, windows_containing
+from flann_index import load_index, save_index
+from descriptor_quantization import quantize_store
+from profiling import profiled, span, timed_batches, timed_call, write_timing_report
+
+# Grayscale train image and feature extractor shared by the tasks of a worker process, set up by init_worker
+_SHARED_MEMORY = None
+_SHARED_IMAGE = None
+_EXTRACTOR = None
 
 def load_image(image_path):
     """
@@ -47,31 +62,255 @@ def sample_locations(img, subregion_size, step):
 
 def process_subregion(args):
     """
-    Process a single subregion to extract SIFT descriptors.
+    Process a single subregion to extract feature descriptors.
     
     Args:
-        args (tuple): A tuple containing the image and coordinates of the subregion.
+        args (tuple): A tuple containing the image, the coordinates of the subregion and the FeatureExtractor to
+                      run on it.
     
     Returns:
         list: A list of tuples containing the descriptors and their corresponding subregion coordinates.
     """
-    image, coords = args
+    image, coords, extractor = args
     center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x = coords
     subregion = image[top_left_y:bottom_right_y + 1, top_left_x:bottom_right_x + 1]
     
-    sift = cv2.SIFT_create()
-    keypoints, descriptors = sift.detectAndCompute(subregion, None)
+    keypoints, descriptors = extractor.detect_and_compute(subregion)
     
     result = []
-    if descriptors is not None:
-        for descriptor in descriptors:
-            result.append((descriptor, coords))
+    for descriptor in descriptors:
+        result.append((descriptor, coords))
     
     return result
 
-def extract_descriptors(image, subregion_coords, subregion_size):
+def tile_origins(image_shape, tile_size=1024):
+    """
+    Lists the top-left corners of the detection tiles of an image, in row-major order.
+
+    Tiles start at the image origin, so extending an image to the right or bottom keeps every existing tile in
+    place.
+
+    Args:
+        image_shape (tuple): The shape of the image.
+        tile_size (int, optional): The side length of each tile. Defaults to 1024.
+
+    Returns:
+        list: List of (tile_y, tile_x) tuples.
+    """
+    height, width = image_shape[:2]
+    return [(y, x) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+def tile_bounds(image_shape, tile_y, tile_x, tile_size=1024, tile_margin=64):
+    """
+    Computes the region the detector sees for a tile: the tile padded by tile_margin on every side and clipped to the image.
+
+    Args:
+        image_shape (tuple): The shape of the image.
+        tile_y (int): The top edge of the tile.
+        tile_x (int): The left edge of the tile.
+        tile_size (int, optional): The side length of the tile. Defaults to 1024.
+        tile_margin (int, optional): The context added around the tile. Defaults to 64.
+
+    Returns:
+        tuple: The (y0, y1, x0, x1) bounds of the padded region.
+    """
+    height, width = image_shape[:2]
+    return (max(tile_y - tile_margin, 0), min(tile_y + tile_size + tile_margin, height),
+            max(tile_x - tile_margin, 0), min(tile_x + tile_size + tile_margin, width))
+
+def tile_hash(image, tile_y, tile_x, subregion_size, step, tile_size=1024, tile_margin=64, scale=1.0):
+    """
+    Hashes everything the keypoints of a tile depend on: the pixels of its padded region, the build parameters and
+    the part of its core covered by the subregion grid.
+
+    A tile on the bottom or right edge of the image also changes hash when the image is extended, because its
+    padded region grows, which is what keeps its edge keypoints correct. The grid coverage matters on its own:
+    keypoints past the last full subregion are dropped, and extending the image adds subregions that can reach
+    into tiles whose padded region did not change.
+
+    Args:
+        image (numpy.ndarray): The input image.
+        tile_y (int): The top edge of the tile.
+        tile_x (int): The left edge of the tile.
+        subregion_size (int): The size of each subregion.
+        step (int): The step size between subregions.
+        tile_size (int, optional): The side length of the tile. Defaults to 1024.
+        tile_margin (int, optional): The context added around the tile. Defaults to 64.
+        scale (float, optional): The pyramid scale the image was resized by. Defaults to 1.0.
+
+    Returns:
+        str: The hex digest.
+    """
+    y0, y1, x0, x1 = tile_bounds(image.shape, tile_y, tile_x, tile_size, tile_margin)
+
+    # The rows and columns of the tile core before the end of the last full subregion, which is all that the
+    # extent of the image changes about which keypoints are kept
+    n_rows, n_cols = grid_shape(image.shape, subregion_size, step)
+    covered_y = min(max((n_rows - 1) * step + subregion_size - tile_y, 0), tile_size) if n_rows else 0
+    covered_x = min(max((n_cols - 1) * step + subregion_size - tile_x, 0), tile_size) if n_cols else 0
+
+    sha = hashlib.sha1(repr((subregion_size, step, tile_size, tile_margin, float(scale), y1 - y0, x1 - x0, covered_y, covered_x)).encode())
+    sha.update(np.ascontiguousarray(image[y0:y1, x0:x1]).tobytes())
+    return sha.hexdigest()
+
+def extract_descriptors_global(image, subregion_size, step, batch_size=512, tile_size=1024, tile_margin=64, tile_ids=None, scale=1.0, level=0, feature_type='sift'):
+    """
+    Extracts descriptors once over the whole image, keeping each keypoint that lies in at least one subregion.
+
+    Every keypoint is yielded once rather than once per overlapping subregion; the subregions containing it follow
+    from its position and the grid parameters (see subregion_grid.windows_containing). Unlike extract_descriptors,
+    keypoints near a subregion border keep the descriptor computed from the full image context, so the results
+    differ slightly from the per-window extraction. Detection runs over large tiles padded by tile_margin on every
+    side, and each keypoint is kept only by the tile whose core contains it, so the detector's scale space never
+    has to be built for the whole image at once.
+
+    Args:
+        image (numpy.ndarray): The input image.
+        subregion_size (int): The size of each subregion.
+        step (int): The step size between subregions.
+        batch_size (int, optional): The number of keypoints per yielded batch. Defaults to 512.
+        tile_size (int, optional): The side length of each detection tile. Defaults to 1024.
+        tile_margin (int, optional): The context added around each detection tile. Defaults to 64.
+        tile_ids (dict, optional): Maps the (tile_y, tile_x) origins of the tiles to extract to their database ids.
+                                   Only those tiles are processed and each keypoint is tagged with its tile id.
+                                   Defaults to None, which processes every tile without tagging.
+        scale (float, optional): The pyramid scale the image was resized by. Keypoints are reported in the pixels
+                                 of the full resolution train image. Defaults to 1.0.
+        level (int, optional): The pyramid level stored with each keypoint. Defaults to 0.
+        feature_type (str, optional): The feature type to extract, see feature_types.FEATURE_TYPES. Defaults to
+                                      'sift'.
+
+    Yields:
+        list: A batch of tuples containing the descriptors and their keypoints. Each tuple consists of a descriptor
+              (numpy.ndarray) and a keypoint tuple (x, y, scale, angle, level) in train image pixels, followed by
+              the tile id when tile_ids is given.
     """
-    Extracts descriptors from an image using the SIFT algorithm with multiprocessing.
+    extractor = get_extractor(feature_type)
+    tiles = tile_origins(image.shape, tile_size) if tile_ids is None else list(tile_ids)
+
+    for tile_y, tile_x in tqdm(tiles, desc="Extracting Descriptors"):
+        y0, y1, x0, x1 = tile_bounds(image.shape, tile_y, tile_x, tile_size, tile_margin)
+        keypoints, descriptors = extractor.detect_and_compute(image[y0:y1, x0:x1])
+        if len(descriptors) == 0:
+            continue
+
+        keypoints = np.array([(kp.pt[0] + x0, kp.pt[1] + y0, kp.size, kp.angle) for kp in keypoints], dtype=np.float32)
+        points = np.rint(keypoints[:, :2]).astype(np.int64)
+        in_core = ((points[:, 0] >= tile_x) & (points[:, 0] < tile_x + tile_size) &
+                   (points[:, 1] >= tile_y) & (points[:, 1] < tile_y + tile_size))
+        # Keypoints past the last full subregion of a row or column belong to no window
+        in_grid = np.zeros(len(points), dtype=bool)
+        in_grid[windows_containing(points, image.shape, subregion_size, step)[0]] = True
+        keep = in_core & in_grid
+        keypoints, descriptors = keypoints[keep], descriptors[keep]
+        keypoints[:, :3] /= scale
+        keypoints = [(*keypoint, level) for keypoint in keypoints.tolist()]
+        if tile_ids is not None:
+            keypoints = [(*keypoint, tile_ids[tile_y, tile_x]) for keypoint in keypoints]
+
+        for start in range(0, len(keypoints), batch_size):
+            yield [(descriptor, tuple(keypoint)) for descriptor, keypoint in zip(descriptors[start:start + batch_size], keypoints[start:start + batch_size])]
+
+def build_pyramid(image, scales):
+    """
+    Resizes the train image once per pyramid scale.
+
+    Args:
+        image (numpy.ndarray): The input image.
+        scales (list): The scale of each level; a scale of 0.5 halves the image, so a subregion of that level covers
+                       twice as much ground as one of the full resolution image.
+
+    Returns:
+        list: The image of each level.
+    """
+    pyramid = []
+    for scale in scales:
+        if scale == 1:
+            pyramid.append(image)
+        else:
+            height, width = level_shape(image.shape, scale)
+            pyramid.append(cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA))
+    return pyramid
+
+def extract_descriptors_pyramid(pyramid, scales, subregion_size, step, tile_ids=None, feature_type='sift'):
+    """
+    Runs extract_descriptors_global over every level of an image pyramid with the same subregion grid.
+
+    Args:
+        pyramid (list): The image of each level, from build_pyramid.
+        scales (list): The scale of each level.
+        subregion_size (int): The size of each subregion, in level pixels.
+        step (int): The step size between subregions, in level pixels.
+        tile_ids (dict, optional): Maps the (level, tile_y, tile_x) keys of the tiles to extract to their database
+                                   ids. Defaults to None, which processes every tile of every level.
+        feature_type (str, optional): The feature type to extract. Defaults to 'sift'.
+
+    Yields:
+        list: The keypoint batches of extract_descriptors_global, level by level.
+    """
+    for level, (level_image, scale) in enumerate(zip(pyramid, scales)):
+        level_tile_ids = None
+        if tile_ids is not None:
+            level_tile_ids = {(tile_y, tile_x): tile_id for (tile_level, tile_y, tile_x), tile_id in tile_ids.items() if tile_level == level}
+            if not level_tile_ids:
+                continue
+        yield from extract_descriptors_global(level_image, subregion_size, step, tile_ids=level_tile_ids, scale=scale, level=level, feature_type=feature_type)
+
+def init_worker(shm_name, shape, dtype, feature_type='sift'):
+    """
+    Pool initializer that attaches a worker process to the shared train image and creates the feature extractor
+    that all of its tasks reuse.
+
+    Args:
+        shm_name (str): The name of the shared memory block holding the image.
+        shape (tuple): The shape of the image.
+        dtype (str): The dtype of the image.
+        feature_type (str, optional): The feature type the worker extracts. Defaults to 'sift'.
+
+    Returns:
+        None
+    """
+    global _SHARED_MEMORY, _SHARED_IMAGE, _EXTRACTOR
+    _SHARED_MEMORY = shared_memory.SharedMemory(name=shm_name)
+    _SHARED_IMAGE = np.ndarray(shape, dtype=dtype, buffer=_SHARED_MEMORY.buf)
+    _EXTRACTOR = get_extractor(feature_type)
+
+def process_shared_subregion(coords):
+    """
+    Process a single subregion of the shared train image set up by init_worker.
+
+    Args:
+        coords (tuple): The coordinates of the subregion.
+
+    Returns:
+        list: A list of tuples containing the descriptors and their corresponding subregion coordinates.
+    """
+    return process_subregion((_SHARED_IMAGE, coords, _EXTRACTOR))
+
+def bounded_tasks(tasks, semaphore, stop_event):
+    """
+    Wraps a task iterable so that the pool can only pull a new task after a slot in the semaphore is released.
+
+    Pool.imap_unordered consumes its input eagerly from a background thread, so without this every subregion
+    result could pile up in memory while the writer falls behind.
+
+    Args:
+        tasks (iterable): The tasks to hand to the pool.
+        semaphore (threading.Semaphore): Semaphore holding one slot per task allowed in flight.
+        stop_event (threading.Event): Event that ends the iteration early when set.
+
+    Yields:
+        The next task.
+    """
+    for task in tasks:
+        semaphore.acquire()
+        if stop_event.is_set():
+            return
+        yield task
+
+def extract_descriptors(image, subregion_coords, subregion_size, chunksize=64, max_pending=None, feature_type='sift'):
+    """
+    Extracts descriptors from every subregion of an image with multiprocessing.
 
     Args:
         image (numpy.ndarray): The input image.
@@ -79,90 +318,423 @@ def extract_descriptors(image, subregion_coords, subregion_size):
                                  top-left coordinates (top_left_y, top_left_x), and bottom-right coordinates 
                                  (bottom_right_y, bottom_right_x) for each subregion.
         subregion_size (int): The size of each subregion.
+        chunksize (int, optional): The number of subregions sent to a worker per task. Defaults to 64.
+        max_pending (int, optional): The number of subregions allowed in flight before the consumer catches up.
+                                     Defaults to four chunks per worker.
+        feature_type (str, optional): The feature type to extract. Defaults to 'sift'.
+
+    Yields:
+        list: The descriptors of one subregion, as tuples of a descriptor (numpy.ndarray) and a coordinate tuple 
+              (center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x).
+    """
+    n_workers = cpu_count()
+    if max_pending is None:
+        max_pending = 4 * chunksize * n_workers
+    semaphore = threading.Semaphore(max_pending)
+    stop_event = threading.Event()
+
+    # Copy the image into shared memory once so each task only carries its coordinates
+    shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+    shared_image = np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)
+    shared_image[:] = image
+    try:
+        initargs = (shm.name, image.shape, image.dtype.str, feature_type)
+        tasks = bounded_tasks(subregion_coords, semaphore, stop_event)
+
+        # Use multiprocessing to process subregions in parallel
+        with Pool(n_workers, initializer=init_worker, initargs=initargs) as pool:
+            try:
+                for result in tqdm(pool.imap_unordered(process_shared_subregion, tasks, chunksize=chunksize), total=len(subregion_coords), desc="Extracting Descriptors"):
+                    yield result
+                    semaphore.release()
+            finally:
+                # Unblock the pool's task feeder so the pool can shut down
+                stop_event.set()
+                semaphore.release(max_pending)
+    finally:
+        del shared_image
+        shm.close()
+        shm.unlink()
+
+def is_tiled_database(db_name):
+    """
+    Checks whether a SQLite file is a deduplicated database that records the content hash of its pyramid tiles.
+
+    Args:
+        db_name (str): The name of the database file.
 
     Returns:
-        list: A list of tuples containing the descriptors and their corresponding subregion coordinates.
-              Each tuple consists of a descriptor (numpy.ndarray) and a coordinate tuple (center_y, center_x, 
-              top_left_y, top_left_x, bottom_right_y, bottom_right_x).
+        bool: True if the file exists and has a `tiles` table with a `level` column.
     """
-    descriptors_list = []
-    
-    # Prepare arguments for multiprocessing
-    args = [(image, coords) for coords in subregion_coords]
-    
-    # Use multiprocessing to process subregions in parallel
-    with Pool(cpu_count()) as pool:
-        for result in tqdm(pool.imap_unordered(process_subregion, args), total=len(subregion_coords), desc="Extracting Descriptors"):
-            descriptors_list.extend(result)
-    
-    return descriptors_list
+    if not os.path.isfile(db_name):
+        return False
+    conn = sqlite3.connect(db_name)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(tiles)')]
+    conn.close()
+    return 'level' in columns
 
-def create_database(db_name):
+def create_database(db_name, grid=None, incremental=False, feature_type='sift'):
     """
-    Creates a SQLite database with a table named `descriptors` to store descriptors.
+    Creates a SQLite database to store descriptors.
+
+    Without a grid, descriptors are stored once per subregion in a `descriptors` table. With a grid, every keypoint
+    is stored once in a `keypoints` table tagged with its pyramid level and the detection tile it came from, the
+    content hash of every tile goes in a `tiles` table, the scale of every level goes in a `levels` table, and the
+    grid parameters go in a one-row `grid` table, from which the subregions containing each keypoint are
+    recomputed on load. The feature type and descriptor layout go in a one-row `features` table.
+
+    The connection is tuned for a bulk build (write-ahead logging, no fsync) and may be handed to a writer thread;
+    call finalize_database once the build is done.
 
     Args:
         db_name (str): The name of the database file.
+        grid (dict, optional): The image_height, image_width, subregion_size and step of the sampling grid and the
+                               scales of the pyramid levels. Defaults to None.
+        incremental (bool, optional): Whether to keep an existing tiled database of the same feature type so
+                                      that only its changed tiles are rebuilt. Any other existing file is
+                                      replaced. Defaults to False.
+        feature_type (str, optional): The feature type of the descriptors. Defaults to 'sift'.
 
     Returns:
         tuple: A tuple containing the database connection and cursor.
     """
-    # Remove existing database file if it exists
-    if os.path.exists(db_name):
+    # Remove existing database file if it exists and cannot be updated in place
+    if os.path.exists(db_name) and not (incremental and grid is not None and is_tiled_database(db_name) and read_features(db_name)['feature_type'] == feature_type):
         os.remove(db_name)
     
-    conn = sqlite3.connect(db_name)
+    conn = sqlite3.connect(db_name, check_same_thread=False)
     c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS descriptors (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            descriptor BLOB,
-            center_y INTEGER,
-            center_x INTEGER,
-            top_left_y INTEGER,
-            top_left_x INTEGER,
-            bottom_right_y INTEGER,
-            bottom_right_x INTEGER
-        )
-    ''')
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=OFF')
+    features = feature_metadata(feature_type)
+    c.execute('CREATE TABLE IF NOT EXISTS features (feature_type TEXT, descriptor_dim INTEGER, descriptor_dtype TEXT)')
+    c.execute('DELETE FROM features')
+    c.execute('INSERT INTO features VALUES (?, ?, ?)', (features['feature_type'], features['descriptor_dim'], features['descriptor_dtype']))
+    if grid is not None:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS keypoints (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                descriptor BLOB,
+                x REAL,
+                y REAL,
+                scale REAL,
+                angle REAL,
+                level INTEGER,
+                tile_id INTEGER
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS keypoints_tile_id ON keypoints (tile_id)')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS tiles (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                level INTEGER,
+                tile_y INTEGER,
+                tile_x INTEGER,
+                content_hash TEXT,
+                UNIQUE (level, tile_y, tile_x)
+            )
+        ''')
+        c.execute('CREATE TABLE IF NOT EXISTS levels (level INTEGER PRIMARY KEY, scale REAL)')
+        c.execute('DELETE FROM levels')
+        c.executemany('INSERT INTO levels VALUES (?, ?)', list(enumerate(grid['scales'])))
+        c.execute('CREATE TABLE IF NOT EXISTS grid (image_height INTEGER, image_width INTEGER, subregion_size INTEGER, step INTEGER)')
+        c.execute('DELETE FROM grid')
+        c.execute('INSERT INTO grid VALUES (?, ?, ?, ?)', (grid['image_height'], grid['image_width'], grid['subregion_size'], grid['step']))
+    else:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS descriptors (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                descriptor BLOB,
+                center_y INTEGER,
+                center_x INTEGER,
+                top_left_y INTEGER,
+                top_left_x INTEGER,
+                bottom_right_y INTEGER,
+                bottom_right_x INTEGER
+            )
+        ''')
     conn.commit()
     return conn, c
 
-def insert_descriptors(conn, c, descriptors_list):
+def sync_tiles(conn, c, pyramid, scales, subregion_size, step, tile_size=1024, tile_margin=64):
     """
-    Inserts descriptors into the `descriptors` table of the database.
+    Compares the tiles of every pyramid level with those recorded in a tiled database and clears every tile that
+    has to be extracted again.
+
+    Keypoints of changed tiles and of tiles no longer in the pyramid are deleted. Changed and new tiles are left
+    with no content hash until mark_tiles_done records it, so a build that stops halfway redoes them on the next
+    run.
 
     Args:
         conn: Connection to the SQLite database.
         c: Cursor for the database connection.
-        descriptors_list: List of tuples containing descriptors and their coordinates.
+        pyramid (list): The image of each level, from build_pyramid.
+        scales (list): The scale of each level.
+        subregion_size (int): The size of each subregion.
+        step (int): The step size between subregions.
+        tile_size (int, optional): The side length of each detection tile. Defaults to 1024.
+        tile_margin (int, optional): The context added around each detection tile. Defaults to 64.
+
+    Returns:
+        tuple: A dict mapping the (level, tile_y, tile_x) key of every tile to extract to its id, a dict of their
+               new content hashes keyed the same way, and the number of tiles left unchanged.
+    """
+    stored = {(level, tile_y, tile_x): (tile_id, content_hash) for tile_id, level, tile_y, tile_x, content_hash in c.execute('SELECT id, level, tile_y, tile_x, content_hash FROM tiles')}
+    hashes = {
+        (level, *origin): tile_hash(level_image, *origin, subregion_size, step, tile_size, tile_margin, scale)
+        for level, (level_image, scale) in enumerate(zip(pyramid, scales))
+        for origin in tile_origins(level_image.shape, tile_size)
+    }
+    changed = [key for key in hashes if key not in stored or stored[key][1] != hashes[key]]
+
+    stale = [stored[key][0] for key in stored if key not in hashes]
+    outdated = [stored[key][0] for key in changed if key in stored]
+    c.executemany('DELETE FROM keypoints WHERE tile_id = ?', [(tile_id,) for tile_id in stale + outdated])
+    c.executemany('DELETE FROM tiles WHERE id = ?', [(tile_id,) for tile_id in stale])
+    c.executemany('UPDATE tiles SET content_hash = NULL WHERE id = ?', [(tile_id,) for tile_id in outdated])
+    c.executemany('INSERT INTO tiles (level, tile_y, tile_x) VALUES (?, ?, ?)', [key for key in changed if key not in stored])
+    conn.commit()
+
+    tile_ids = {(level, tile_y, tile_x): tile_id for tile_id, level, tile_y, tile_x in c.execute('SELECT id, level, tile_y, tile_x FROM tiles')}
+    return {key: tile_ids[key] for key in changed}, {key: hashes[key] for key in changed}, len(hashes) - len(changed)
+
+def mark_tiles_done(conn, c, tile_ids, hashes):
+    """
+    Records the content hashes of tiles whose keypoints have all been written.
+
+    Args:
+        conn: Connection to the SQLite database.
+        c: Cursor for the database connection.
+        tile_ids (dict): Maps tile keys to their ids, as returned by sync_tiles.
+        hashes (dict): Maps tile keys to their content hashes, as returned by sync_tiles.
 
     Returns:
         None
     """
-    for descriptor, coords in tqdm(descriptors_list, desc="Inserting Descriptors"):
-        center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x = coords
-        c.execute('''
-            INSERT INTO descriptors (descriptor, center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', [descriptor.tobytes(), center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x])
+    c.executemany('UPDATE tiles SET content_hash = ? WHERE id = ?', [(hashes[key], tile_id) for key, tile_id in tile_ids.items()])
     conn.commit()
 
-def main(image_path, subregion_size, step, db_name):
-    image = load_image(image_path)
-    subregion_coords = sample_locations(image, subregion_size, step)
-    descriptors_list = extract_descriptors(image, subregion_coords, subregion_size)
-    conn, c = create_database(db_name)
-    insert_descriptors(conn, c, descriptors_list)
-    conn.close()
+def finalize_database(conn, c):
+    """
+    Restores durable settings on a database built by create_database and folds the write-ahead log back into the
+    main file so the `*.db` can be copied on its own.
+
+    Args:
+        conn: Connection to the SQLite database.
+        c: Cursor for the database connection.
+
+    Returns:
+        None
+    """
+    conn.commit()
+    c.execute('PRAGMA synchronous=FULL')
+    c.execute('PRAGMA journal_mode=DELETE').fetchall()
+
+def insert_descriptors(conn, c, descriptors_list):
+    """
+    Inserts descriptors into the `descriptors` table of the database with a single batched statement.
+
+    Args:
+        conn: Connection to the SQLite database.
+        c: Cursor for the database connection.
+        descriptors_list: Iterable of tuples containing descriptors and their coordinates.
+
+    Returns:
+        int: The number of rows inserted.
+    """
+    rows = [(descriptor.tobytes(), *coords) for descriptor, coords in descriptors_list]
+    c.executemany('''
+        INSERT INTO descriptors (descriptor, center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    return len(rows)
+
+def insert_keypoints(conn, c, keypoints_list):
+    """
+    Inserts descriptors into the `keypoints` table of the database with a single batched statement.
+
+    Args:
+        conn: Connection to the SQLite database.
+        c: Cursor for the database connection.
+        keypoints_list: Iterable of tuples containing descriptors and their (x, y, scale, angle, level, tile_id)
+                        keypoints.
+
+    Returns:
+        int: The number of rows inserted.
+    """
+    rows = [(descriptor.tobytes(), *keypoint) for descriptor, keypoint in keypoints_list]
+    c.executemany('INSERT INTO keypoints (descriptor, x, y, scale, angle, level, tile_id) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    return len(rows)
+
+def write_descriptors(write, batch_queue, batch_size, errors):
+    """
+    Writer loop that drains batches of descriptors from a queue into the database until it receives None.
+
+    Batches are merged until at least batch_size rows are pending so each write stays large. If a write fails, the
+    error is recorded and the queue keeps draining so the producer never blocks on a dead writer.
+
+    Args:
+        write (callable): Function that stores a list of (descriptor, coords) tuples.
+        batch_queue (queue.Queue): Queue of descriptor batches, terminated by None.
+        batch_size (int): The minimum number of rows per insert.
+        errors (list): List that receives any exception raised while writing.
+
+    Returns:
+        None
+    """
+    pending = []
+    while True:
+        batch = batch_queue.get()
+        if errors:
+            if batch is None:
+                return
+            continue
+
+        try:
+            if batch is not None:
+                pending.extend(batch)
+            if pending and (batch is None or len(pending) >= batch_size):
+                write(pending)
+                pending = []
+        except Exception as e:
+            errors.append(e)
+
+        if batch is None:
+            return
+
+def stream_descriptors(write, batches, batch_size=50000, queue_size=16):
+    """
+    Streams descriptor batches into the database through a writer thread fed by a bounded queue.
+
+    The producer blocks once queue_size batches are waiting, which in turn stops it from pulling more work, so
+    memory use stays bounded regardless of the size of the train image.
+
+    Args:
+        write (callable): Function that stores a list of (descriptor, coords or keypoint) tuples, such as
+                          insert_descriptors bound to a connection or NpyStoreWriter.write.
+        batches (iterable): Iterable of lists of (descriptor, coords or keypoint) tuples.
+        batch_size (int, optional): The minimum number of rows per insert. Defaults to 50000.
+        queue_size (int, optional): The maximum number of batches waiting for the writer. Defaults to 16.
+
+    Returns:
+        None
+    """
+    batch_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    writer = threading.Thread(target=write_descriptors, args=(write, batch_queue, batch_size, errors))
+    writer.start()
+
+    try:
+        for batch in batches:
+            batch_queue.put(batch)
+            if errors:
+                break
+    finally:
+        batch_queue.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+def main(image_path, subregion_size, step, db_name, extraction_mode='per_window', chunksize=64, batch_size=50000, queue_size=16, backend='sqlite', build_index=True, quantize='none', pca_dim=64, pq_subvectors=8, drop_full_descriptors=False, incremental=False, scales=(1.0,), feature_type='sift', timing_report_path=None):
+    with span('image_load'):
+        image = load_image(image_path)
+    changed = True
+    # Global extraction stores each keypoint once and recomputes its subregions from the grid on load
+    grid = None
+    if extraction_mode == 'global':
+        grid = {'image_height': image.shape[0], 'image_width': image.shape[1], 'subregion_size': subregion_size, 'step': step, 'scales': list(scales)}
+        with span('sampling', len(scales)):
+            pyramid = build_pyramid(image, scales)
+    else:
+        with span('sampling') as s:
+            subregion_coords = sample_locations(image, subregion_size, step)
+            s.count = len(subregion_coords)
+
+    if backend == 'npy':
+        writer = NpyStoreWriter(db_name, grid=grid, feature_type=feature_type)
+        if grid is not None:
+            batches = extract_descriptors_pyramid(pyramid, scales, subregion_size, step, feature_type=feature_type)
+        else:
+            batches = extract_descriptors(image, subregion_coords, subregion_size, chunksize, feature_type=feature_type)
+        stream_descriptors(timed_call(writer.write, 'database_write'), timed_batches(batches, 'extraction'), batch_size, queue_size)
+        writer.close()
+    elif grid is not None:
+        conn, c = create_database(db_name, grid, incremental, feature_type)
+        with span('tile_sync') as s:
+            tile_ids, hashes, n_unchanged = sync_tiles(conn, c, pyramid, scales, subregion_size, step)
+            s.count = len(tile_ids)
+        print(f"Extracting {len(tile_ids)} tiles, {n_unchanged} unchanged")
+        batches = extract_descriptors_pyramid(pyramid, scales, subregion_size, step, tile_ids, feature_type)
+        stream_descriptors(timed_call(partial(insert_keypoints, conn, c), 'database_write'), timed_batches(batches, 'extraction'), batch_size, queue_size)
+        mark_tiles_done(conn, c, tile_ids, hashes)
+        with span('database_finalize'):
+            finalize_database(conn, c)
+        conn.close()
+        changed = bool(tile_ids)
+    else:
+        conn, c = create_database(db_name, feature_type=feature_type)
+        batches = extract_descriptors(image, subregion_coords, subregion_size, chunksize, feature_type=feature_type)
+        stream_descriptors(timed_call(partial(insert_descriptors, conn, c), 'database_write'), timed_batches(batches, 'extraction'), batch_size, queue_size)
+        with span('database_finalize'):
+            finalize_database(conn, c)
+        conn.close()
+
+    # A quantized store is searched through its codes, so it has no use for a FLANN index
+    if quantize != 'none':
+        with span('quantization'):
+            quantize_store(db_name, quantize, pca_dim, pq_subvectors, drop_full_descriptors=drop_full_descriptors)
+    elif build_index:
+        with span('database_read') as s:
+            db_descriptors, _ = load_descriptor_store(db_name)
+            s.count = len(db_descriptors)
+        # An incremental run that changed nothing keeps the saved index if it is still usable
+        if changed or load_index(db_name, db_descriptors) is None:
+            with span('index_build', len(db_descriptors)):
+                save_index(db_name, db_descriptors)
+
+    if timing_report_path is not None:
+        write_timing_report(timing_report_path)
     
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create a descriptor database.')
     parser.add_argument('--image_path', type=str, default='/home/undadmin/Documents/GitHub/BEV_localization/Google_Earth_vids/ppl_v2/sat4.png', help='Path to the image file.')
     parser.add_argument('--subregion_size', type=int, default=120, help='Size of subregions.')
     parser.add_argument('--step', type=int, default=20, help='Step size for sampling.')
-    parser.add_argument('--db_name', type=str, default='descriptor_data_bases/ppl_v2_4.db', help='Name of the database file.')
+    parser.add_argument('--db_name', type=str, default='descriptor_data_bases/ppl_v2_4.db', help='Name of the database file, or the directory of the store for the npy backend.')
+    parser.add_argument('--backend', type=str, default='sqlite', choices=['sqlite', 'npy'], help='Write a SQLite database or a memory-mappable columnar .npy store.')
+    parser.add_argument('--skip_index', action='store_true', help='Do not build and save the FLANN index next to the database.')
+    parser.add_argument('--extraction_mode', type=str, default='per_window', choices=['global', 'per_window'], help='Extract features once over the whole image or once per subregion.')
+    parser.add_argument('--feature_type', type=str, default='sift', choices=list(FEATURE_TYPES), help='Extract float SIFT descriptors or binary ORB/AKAZE descriptors stored as packed bytes.')
+    parser.add_argument('--chunksize', type=int, default=64, help='Number of subregions sent to a worker per task in per_window mode.')
+    parser.add_argument('--batch_size', type=int, default=50000, help='Minimum number of rows written per insert.')
+    parser.add_argument('--queue_size', type=int, default=16, help='Maximum number of descriptor batches waiting for the database writer.')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1.0], help='Scales of the image pyramid levels stored in one database, e.g. 1 0.7 0.5, in global mode.')
+    parser.add_argument('--incremental', action='store_true', help='Update an existing global-mode SQLite database in place, extracting only tiles whose pixels or parameters changed.')
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'sq', 'pq'], help='Compress the npy store with PCA and uint8 scalar quantization or product quantization.')
+    parser.add_argument('--pca_dim', type=int, default=64, help='PCA dimension the descriptors are reduced to before quantization.')
+    parser.add_argument('--pq_subvectors', type=int, default=8, help='Number of product quantization subvectors (bytes per code).')
+    parser.add_argument('--drop_full_descriptors', action='store_true', help='Keep only the quantized codes. Re-ranking is then unavailable.')
+    parser.add_argument('--timing_report', type=str, default=None, help='Path of the JSON timing report. Defaults to <db_name>.timing.json, or timing.json inside an npy store.')
+    parser.add_argument('--profile', type=str, default=None, help='Run under cProfile and dump the stats to this path.')
 
     args = parser.parse_args()
+    if args.quantize != 'none' and args.backend != 'npy':
+        parser.error('--quantize requires --backend npy')
+    if args.quantize != 'none' and args.feature_type != 'sift':
+        parser.error('--quantize requires float descriptors (--feature_type sift)')
+    if args.quantize == 'pq' and args.pca_dim % args.pq_subvectors != 0:
+        parser.error('--pca_dim must be divisible by --pq_subvectors')
+    if args.incremental and (args.backend != 'sqlite' or args.extraction_mode != 'global'):
+        parser.error('--incremental requires --backend sqlite and --extraction_mode global')
+    if args.scales != [1.0] and args.extraction_mode != 'global':
+        parser.error('--scales requires --extraction_mode global')
+
+    timing_report_path = args.timing_report
+    if timing_report_path is None:
+        timing_report_path = os.path.join(args.db_name, 'timing.json') if args.backend == 'npy' else args.db_name + '.timing.json'
 
-    main(args.image_path, args.subregion_size, args.step, args.db_name)
+    with profiled(args.profile):
+        main(args.image_path, args.subregion_size, args.step, args.db_name, args.extraction_mode, args.chunksize, args.batch_size, args.queue_size, args.backend, not args.skip_index, args.quantize, args.pca_dim, args.pq_subvectors, args.drop_full_descriptors, args.incremental, args.scales, args.feature_type, timing_report_path)
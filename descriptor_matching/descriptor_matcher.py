@@ -1,46 +1,76 @@
-import sqlite3
 import numpy as np
 import cv2
 from tqdm import tqdm
 import argparse
-
-import cv2
-import numpy as np
-
-def extract_non_black_pixels(image_path):
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool, cpu_count
+from scipy.ndimage import gaussian_filter, maximum_filter
+from descriptor_store import load_descriptor_store, load_keypoints, read_features
+from feature_types import empty_descriptors, get_extractor
+from flann_index import get_index, knn_search
+from profiling import profiled, span, write_timing_report
+from spatial_index import SpatialIndex, geo_to_pixels
+from subregion_verification import SubregionVerifier, count_inliers, load_train_image, ratio_matches
+
+def load_mask(mask_path):
     """
-    Extracts non-black pixels from an image and returns their (x, y) coordinates.
+    Loads a mask image as a boolean array marking its black pixels, where query keypoints are ignored.
+
+    The array can be computed once and passed to extract_keypoints_and_descriptors for every query.
 
     Args:
-        image_path (str): The path to the input image.
+        mask_path (str): The path to the mask image.
 
     Returns:
-        list: A list of (x, y) coordinates of non-black pixels in the image.
+        numpy.ndarray: A (height, width) boolean array that is True on black pixels.
     """
     # Load the image
-    image = cv2.imread(image_path)
-    
-    # Convert the image to RGB (cv2 loads images in BGR by default)
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    image = cv2.imread(mask_path)
     
     # Create a mask where non-black pixels are False
-    non_black_mask = np.all(image_rgb == [0, 0, 0], axis=-1)
-    
-    # Find non-zero (True) indices
-    non_black_indices = np.argwhere(non_black_mask)
-    
-    # Convert indices to (x, y) coordinates
-    non_black_pixels = [(idx[1], idx[0]) for idx in non_black_indices]
-    
-    return non_black_pixels
+    return np.all(image == 0, axis=-1)
 
-def extract_keypoints_and_descriptors(image_path, mask_path):
+def filter_keypoints(keypoints, image_shape, mask=None, radius=150):
     """
-    Extracts keypoints and descriptors from an image using the SIFT algorithm.
+    Finds the keypoints to keep, either those not on a black pixel of the mask or, without a mask, those outside
+    a radius around the image center.
+
+    Args:
+        keypoints (list): The keypoints detected in the image.
+        image_shape (tuple): The shape of the image the keypoints were detected in.
+        mask (numpy.ndarray, optional): Boolean array from load_mask. Defaults to None.
+        radius (float, optional): The radius around the center to ignore when there is no mask. Defaults to 150.
+
+    Returns:
+        numpy.ndarray: A boolean array that is True for every keypoint to keep.
+    """
+    points = np.array([kp.pt for kp in keypoints], dtype=np.float32).reshape(-1, 2)
+
+    if mask is not None:
+        # Look up the mask pixel each keypoint falls on
+        cols = np.clip(np.rint(points[:, 0]).astype(np.int64), 0, mask.shape[1] - 1)
+        rows = np.clip(np.rint(points[:, 1]).astype(np.int64), 0, mask.shape[0] - 1)
+        return ~mask[rows, cols]
+
+    center = np.array([image_shape[1] / 2, image_shape[0] / 2], dtype=np.float32)
+    return np.sum((points - center) ** 2, axis=1) > radius ** 2
+
+def extract_keypoints_and_descriptors(image_path, mask_path, mask=None, feature_type='sift'):
+    """
+    Extracts keypoints and descriptors from an image, with SIFT unless another feature type is given.
 
     Args:
         image_path (str): The path to the input image.
-        mask_path (str, optional): The path to a mask image. If provided, keypoints inside the mask will be ignored.
+        mask_path (str, optional): The path to a mask image. If provided, keypoints on its black pixels will be ignored.
+        mask (numpy.ndarray, optional): The mask already loaded by load_mask. Used instead of re-reading mask_path
+                                        when given.
+        feature_type (str, optional): The feature type of the database the query is matched against. Defaults to
+                                      'sift'.
 
     Returns:
         tuple: A tuple containing two lists. The first list contains the keypoints detected in the image, and the second list contains the corresponding descriptors.
@@ -49,89 +79,76 @@ def extract_keypoints_and_descriptors(image_path, mask_path):
     query = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
     # query = cv2.GaussianBlur(query, (3, 3), 0)
     
-    # Initialize SIFT detector
-    sift = cv2.SIFT_create()
-    
-    # Detect keypoints and compute descriptors
-    keypoints, descriptors = sift.detectAndCompute(query, None)
+    # Detect keypoints and compute descriptors with the extractor cached for this process
+    keypoints, descriptors = get_extractor(feature_type).detect_and_compute(query)
+    if len(descriptors) == 0:
+        return np.array([], dtype=object), descriptors
 
-    if mask_path is not None:
-        # Convert extract_non_black_pixels(mask_path) to a set for faster lookup
-        non_black_pixels = set(extract_non_black_pixels(mask_path))
+    if mask is None and mask_path is not None:
+        mask = load_mask(mask_path)
 
-        # Use set comprehension for faster tuple creation
-        keep_indices = [i for i, kp in enumerate(keypoints) if (kp.pt[0], kp.pt[1]) not in non_black_pixels]
-
-    else:
-        center_x = query.shape[1] / 2
-        center_y = query.shape[0] / 2
-        
-        # Ignore keypoints within a 150 pixel radius of the center of the image
-        keep_indices = []
-        for i, kp in enumerate(keypoints):
-            if np.linalg.norm(np.array([kp.pt[0], kp.pt[1]]) - np.array([center_x, center_y])) > 150:
-                keep_indices.append(i)
+    # Ignore keypoints on the mask, or within a 150 pixel radius of the center of the image without one
+    keep = filter_keypoints(keypoints, query.shape, mask)
 
     keypoints = np.array(keypoints)
-    descriptors = np.array(descriptors)
     
     # Use numpy advanced indexing
-    keypoints = keypoints[keep_indices]
-    descriptors = descriptors[keep_indices]
+    keypoints = keypoints[keep]
+    descriptors = descriptors[keep]
     
     return keypoints, descriptors
 
-def find_closest_matches(db_name, keypoints, descriptors, n_best_matches):
+def find_closest_matches(db_name, keypoints, descriptors, n_best_matches, verify_index=False, rerank=0):
     """
-    Connects to the database, queries descriptors, converts them to a NumPy array, uses FLANN for nearest neighbor search,
-    finds the closest matches, sorts matches by distance, and selects the top 3 best matches.
+    Loads the database descriptors and their FLANN index, finds the closest database descriptor of every query
+    descriptor, sorts matches by distance, and selects the top x best matches.
+
+    The index saved by create_descriptor_data_base.py is used when it is in sync with the database; otherwise a
+    fresh one is built in memory.
 
     Args:
-        db_name (str): The name of the database to connect to.
+        db_name (str): The path of the `*.db` file or columnar store directory to match against.
         keypoints (list): List of keypoints.
         descriptors (numpy.ndarray): Array of descriptors.
+        n_best_matches (int): The number of best matches to return.
+        verify_index (bool, optional): Whether to verify the saved index against the full descriptor checksum.
+                                       Defaults to False.
+        rerank (int, optional): The number of candidates re-ranked with full descriptors when the database is
+                                quantized. Defaults to 0.
 
     Returns:
         list: List of the top x best matches, each containing a tuple with distance and coordinates.
     """
-    # Connect to the database
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
-
-
-    closest_matches = []
-
-    # Query descriptors from the database
-    c.execute('SELECT descriptor, center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x FROM descriptors')
-    rows = c.fetchall()
-    
-    # Convert the descriptors from the database to a NumPy array
-    db_descriptors = []
-    db_coords = []
-    for row in tqdm(rows, desc="Reading Database Descriptors"):
-        stored_descriptor = np.frombuffer(row[0], dtype=np.float32)
-        stored_descriptor = stored_descriptor.reshape(-1, 128)  # Assuming SIFT descriptors are 128-dimensional
-        db_descriptors.append(stored_descriptor)
-        db_coords.append(row[1:])
-
-    db_descriptors = np.vstack(db_descriptors)
-    db_coords = np.array(db_coords)
+    # Load descriptors from either database backend
+    db_descriptors, db_coords = load_descriptor_store(db_name)
     
     # Use FLANN for efficient nearest neighbor search
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-    search_params = dict(checks=50)
+    index = get_index(db_name, db_descriptors, verify_index, rerank)
+    indices, distances = knn_search(index, descriptors, k=2)
 
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
-    matches = flann.knnMatch(descriptors, db_descriptors, k=2)
+    return select_best_matches(indices, distances, db_coords, n_best_matches)
 
-    
-    for match in tqdm(matches, desc="Finding Closest Matches"):
-        distance = match[0].distance
-        coords = db_coords[match[0].trainIdx]
-        closest_matches.append((distance, coords))
+def select_best_matches(indices, distances, db_coords, n_best_matches):
+    """
+    Turns the nearest-neighbour results of a query into subregion matches sorted by distance.
 
-    conn.close()
+    Args:
+        indices (numpy.ndarray): The (M, k) database row indices returned by knn_search.
+        distances (numpy.ndarray): The (M, k) distances returned by knn_search.
+        db_coords (numpy.ndarray): The (N, 6) subregion coordinates of the database rows.
+        n_best_matches (int): The number of best matches to return.
+
+    Returns:
+        list: List of the top x best matches, each containing a tuple with distance and coordinates.
+    """
+    closest_matches = []
+
+    for train_idx, distance in tqdm(zip(indices[:, 0], distances[:, 0]), total=len(indices), desc="Finding Closest Matches"):
+        # Queries without any neighbour are padded with an infinite distance
+        if not np.isfinite(distance):
+            continue
+        coords = tuple(db_coords[train_idx].tolist())
+        closest_matches.append((float(distance), coords))
 
     # Sort matches by distance
     closest_matches.sort(key=lambda x: x[0])
@@ -141,12 +158,132 @@ def find_closest_matches(db_name, keypoints, descriptors, n_best_matches):
     
     return best_matches
 
+def vote_matches(indices, distances, db_coords, extent, bin_size=20, ratio=0.75, smooth_sigma=None):
+    """
+    Accumulates the nearest-neighbour matches of a query into a 2D vote map over the train image.
+
+    Matches that fail Lowe's ratio test are dropped. Every other match votes for the center of the subregion it
+    hit, weighted by how clearly it passed the test (1 - d1 / d2).
+
+    Overlapping subregions may store the same keypoint several times, and a deduplicated database can still hold
+    distinct keypoints of the same spot, so the second neighbour used by the ratio test is the first one whose
+    subregion does not overlap the best one. When none of the k neighbours qualifies, the
+    k-th distance stands in for it, which can only make the test stricter. Matches without a finite best and
+    second distance are dropped.
+
+    Args:
+        indices (numpy.ndarray): The (M, k) database row indices returned by knn_search, with k >= 2.
+        distances (numpy.ndarray): The (M, k) distances returned by knn_search.
+        db_coords (numpy.ndarray): The (N, 6) subregion coordinates of the database rows.
+        extent (tuple): The (height, width) of the train image.
+        bin_size (int, optional): The side length in pixels of each accumulator cell. Defaults to 20.
+        ratio (float, optional): The ratio test threshold. Defaults to 0.75.
+        smooth_sigma (float, optional): The Gaussian smoothing applied to the accumulator, in pixels. The copies of
+                                        one keypoint hit subregions up to half a subregion from its true position,
+                                        so this defaults to a third of the subregion size.
+
+    Returns:
+        numpy.ndarray: The float32 accumulator of shape (ceil(height / bin_size), ceil(width / bin_size)).
+    """
+    n_rows = -(-extent[0] // bin_size)
+    n_cols = -(-extent[1] // bin_size)
+    if len(indices) == 0:
+        return np.zeros((n_rows, n_cols), dtype=np.float32)
+
+    # Find the first neighbour in a subregion that does not overlap the best match
+    coords = db_coords[indices]
+    subregion_size = coords[:, 0, 4] - coords[:, 0, 2] + 1
+    offsets = np.abs(coords[:, :, :2] - coords[:, :1, :2]).max(axis=2)
+    distinct = offsets >= subregion_size[:, None]
+    second = np.where(distinct.any(axis=1), distinct.argmax(axis=1), indices.shape[1] - 1)
+    second_distances = distances[np.arange(len(distances)), second]
+
+    # Lowe's ratio test. Neighbours missing from a prior region or an LSH miss are padded with infinite distances,
+    # which would pass it at full weight, so a match needs a real best and second neighbour
+    passed = np.isfinite(distances[:, 0]) & np.isfinite(second_distances) & (distances[:, 0] < ratio * second_distances)
+    weights = 1 - distances[passed, 0] / np.maximum(second_distances[passed], 1e-6)
+    centers = coords[passed, 0, :2]
+
+    rows = np.clip(centers[:, 0] // bin_size, 0, n_rows - 1)
+    cols = np.clip(centers[:, 1] // bin_size, 0, n_cols - 1)
+    accumulator = np.bincount(rows * n_cols + cols, weights=weights, minlength=n_rows * n_cols)
+    accumulator = accumulator.reshape(n_rows, n_cols).astype(np.float32)
+
+    if smooth_sigma is None:
+        smooth_sigma = subregion_size[0] / 3
+    if smooth_sigma > 0:
+        accumulator = gaussian_filter(accumulator, smooth_sigma / bin_size)
+    return accumulator
+
+def overlap_neighbours(db_coords, max_neighbours=64, deduplicated=False, n_levels=1):
+    """
+    Estimates how many nearest neighbours a query needs so that the ratio test of vote_matches can look past the
+    copies of a keypoint stored in overlapping subregions.
+
+    Args:
+        db_coords (numpy.ndarray): The (N, 6) subregion coordinates of the database rows.
+        max_neighbours (int, optional): The upper bound on the returned count. Defaults to 64.
+        deduplicated (bool, optional): Whether every keypoint is stored once. Only the few distinct keypoints
+                                       near the best match then have to be looked past. Defaults to False.
+        n_levels (int, optional): The number of pyramid levels of a deduplicated database. SIFT finds the same
+                                  spot again on every level, so each level adds as many neighbours. Defaults to 1.
+
+    Returns:
+        int: The number of neighbours to search for, at least 2.
+    """
+    if len(db_coords) == 0:
+        return 2
+    if deduplicated:
+        return min(8 * n_levels, max_neighbours)
+
+    subregion_size = int(db_coords[0, 4] - db_coords[0, 2] + 1)
+    top_left_x = np.unique(db_coords[:, 3])
+    step = int(np.diff(top_left_x).min()) if len(top_left_x) > 1 else subregion_size
+    windows_per_axis = -(-subregion_size // step)
+    return int(min(max(windows_per_axis ** 2 + 1, 2), max_neighbours))
+
+def find_vote_peaks(accumulator, n_peaks, subregion_size, bin_size=20, nms_radius=None):
+    """
+    Picks the strongest local maxima of a vote map as localization hypotheses, using non-maximum suppression.
+
+    Args:
+        accumulator (numpy.ndarray): The vote map from vote_matches.
+        n_peaks (int): The maximum number of hypotheses to return.
+        subregion_size (int): The side length of the subregion drawn around each hypothesis.
+        bin_size (int, optional): The side length in pixels of each accumulator cell. Defaults to 20.
+        nms_radius (int, optional): The suppression radius in pixels. Defaults to half the subregion size.
+
+    Returns:
+        list: List of hypotheses, strongest first, each a tuple of the vote score and the coordinates
+              (center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x) of a subregion centered
+              on the peak, in the same layout as the matches of find_closest_matches.
+    """
+    if nms_radius is None:
+        nms_radius = subregion_size // 2
+    nms_cells = max(nms_radius // bin_size, 1)
+    is_peak = (accumulator == maximum_filter(accumulator, size=2 * nms_cells + 1)) & (accumulator > 0)
+    peak_rows, peak_cols = np.nonzero(is_peak)
+    scores = accumulator[peak_rows, peak_cols]
+    order = np.argsort(scores)[::-1][:n_peaks]
+
+    half_subregion = subregion_size // 2
+    hypotheses = []
+    for row, col, score in zip(peak_rows[order], peak_cols[order], scores[order]):
+        center_y = int(row * bin_size + bin_size // 2)
+        center_x = int(col * bin_size + bin_size // 2)
+        top_left_y, top_left_x = center_y - half_subregion, center_x - half_subregion
+        coords = (center_y, center_x, top_left_y, top_left_x, top_left_y + subregion_size - 1, top_left_x + subregion_size - 1)
+        hypotheses.append((float(score), coords))
+
+    return hypotheses
+
 def draw_matches(image_path, matches, output_path):
     """
     Draws matches on an image and optionally saves the image with the drawn rectangles.
 
     Args:
-        image_path (str): The path to the image on which to draw the matches.
+        image_path (str or numpy.ndarray): The path to the image on which to draw the matches, or the already loaded
+            image, which is left untouched.
         matches (List[Tuple[float, Tuple[int, int, int, int, int, int]]]): A list of matches, where each match is a tuple containing the distance and the coordinates of the rectangle to be drawn.
         output_path (str, optional): The path to save the image with the drawn rectangles. If not provided, the image will not be saved.
 
@@ -154,7 +291,10 @@ def draw_matches(image_path, matches, output_path):
         None
     """
     # Load the image on which to draw the shapes
-    image = cv2.imread(image_path)
+    if isinstance(image_path, str):
+        image = cv2.imread(image_path)
+    else:
+        image = image_path.copy()
     
     # Iterate through the matches and draw rectangles
     for i, match in enumerate(matches):
@@ -192,7 +332,7 @@ def extract_subregion(image_path, coords):
     Extracts a subregion from an image using the given coordinates.
 
     Args:
-        image_path (str): The path to the image file.
+        image_path (str or numpy.ndarray): The path to the image file, or the already loaded image.
         coords (tuple): A tuple containing the center coordinates (center_y, center_x) and the top-left 
             and bottom-right coordinates (top_left_y, top_left_x, bottom_right_y, bottom_right_x) of the subregion.
 
@@ -201,7 +341,10 @@ def extract_subregion(image_path, coords):
 
     """
     # Load the image
-    image = cv2.imread(image_path)
+    if isinstance(image_path, str):
+        image = cv2.imread(image_path)
+    else:
+        image = image_path
 
     center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x = coords
 
@@ -219,85 +362,522 @@ def extract_subregion(image_path, coords):
 
     return subregion
 
-def display_sift_matches(query_path, query_keypoints, query_descriptors, img2, count):
+class DescriptorMatcher:
+    def __init__(self, db_name, train_file_path, mask_file_path=None, verify_index=False, rerank=0, binary_index='lsh'):
+        """
+        Loads a descriptor database, its FLANN index, the train image and the query mask once so that many query
+        frames can be matched without paying those costs again.
+
+        Args:
+            db_name (str): The path of the `*.db` file or columnar store directory to match against.
+            train_file_path (str): The path of the train image the database was created from, or of a `.npy` copy
+                                   of it, which is memory-mapped.
+            mask_file_path (str, optional): The path to a mask image applied to every query. Defaults to None.
+            verify_index (bool, optional): Whether to verify the saved index against the full descriptor checksum.
+                                           Defaults to False.
+            rerank (int, optional): The number of candidates re-ranked with full descriptors when the database is
+                                    quantized. Defaults to 0.
+            binary_index (str, optional): How binary descriptors are searched, 'lsh' or 'bf' (see
+                                          flann_index.build_index). Defaults to 'lsh'.
+
+        Returns:
+            None
+        """
+        self.db_name = db_name
+        self.train_file_path = train_file_path
+        self.mask_file_path = mask_file_path
+        self.binary_index = binary_index
+        # Built on the first query with a prior position, see spatial
+        self.spatial_index = None
+
+        with span('database_read') as s:
+            self.feature_type = read_features(db_name)['feature_type']
+            self.db_descriptors, self.db_coords = load_descriptor_store(db_name)
+            self.db_keypoints, self.grid = load_keypoints(db_name)
+            s.count = len(self.db_coords)
+        with span('index_build', len(self.db_coords)):
+            self.index = get_index(db_name, self.db_descriptors, verify_index, rerank, binary_index)
+        with span('image_load'):
+            self.train_image = load_train_image(train_file_path)
+            self.mask = load_mask(mask_file_path) if mask_file_path is not None else None
+        self.verifier = SubregionVerifier(self.train_image, feature_type=self.feature_type)
+
+        if self.grid is not None:
+            self.subregion_size = self.grid['subregion_size']
+            self.scales = self.grid['scales']
+            self.db_levels = np.asarray(self.db_keypoints[:, 4]).astype(np.int64)
+            # Keypoints sorted by x, so the keypoints of a candidate window are found with two binary searches
+            self.x_order = np.argsort(self.db_keypoints[:, 0], kind='stable')
+            self.sorted_x = np.asarray(self.db_keypoints[:, 0])[self.x_order]
+        else:
+            self.subregion_size = int(self.db_coords[0, 4] - self.db_coords[0, 2] + 1) if len(self.db_coords) else 0
+            self.scales = [1.0]
+            self.db_levels = np.zeros(len(self.db_coords), dtype=np.int64)
+        self.vote_neighbours = overlap_neighbours(self.db_coords, deduplicated=self.grid is not None, n_levels=len(self.scales))
+
+    def spatial(self):
+        """
+        Returns the spatial index of the database rows, building it on first use.
+
+        Returns:
+            SpatialIndex: The spatial index.
+        """
+        if self.spatial_index is None:
+            with span('spatial_index_build', len(self.db_coords)):
+                self.spatial_index = SpatialIndex(self.db_coords, self.db_descriptors, binary_index=self.binary_index)
+        return self.spatial_index
+
+    def match(self, query_file_path, n_best_matches, output_path=None, visualize=False, aggregate=False, ratio=0.75, bin_size=20, geometric_top_k=0, inlier_margin=2.0, min_inliers=8, prior=None):
+        """
+        Matches one query frame against the loaded database.
+
+        Args:
+            query_file_path (str): The path of the query image.
+            n_best_matches (int): The number of best matches to return.
+            output_path (str, optional): Where to save the train image with the matches drawn. Defaults to None.
+            visualize (bool, optional): Whether to verify every best match with SIFT and save the match images as
+                                        output/sift_matches_{i}.png. Defaults to False.
+            aggregate (bool, optional): Whether to return the peaks of the spatial vote map instead of the raw
+                                        closest matches. Defaults to False.
+            ratio (float, optional): The ratio test threshold used when aggregating. Defaults to 0.75.
+            bin_size (int, optional): The vote map cell size in pixels used when aggregating. Defaults to 20.
+            geometric_top_k (int, optional): The number of candidates re-ranked by RANSAC homography inliers, see
+                                             verify_geometry. Defaults to 0, which skips the stage.
+            inlier_margin (float, optional): How many times more inliers than the runner-up a candidate needs to
+                                             stop the re-ranking early. Defaults to 2.0.
+            min_inliers (int, optional): The inliers a candidate needs before it can stop the re-ranking early.
+                                         Defaults to 8.
+            prior (tuple, optional): A (center_y, center_x, radius) circle in train image pixels, for example from
+                                     geo_to_pixels. Only database rows whose window center lies inside it are
+                                     searched. Defaults to None, which searches the whole database.
+
+        Returns:
+            tuple: The best matches, as returned by find_closest_matches (or scored hypotheses from find_vote_peaks
+                   when aggregating, led by the inlier counts of the checked candidates from verify_geometry when
+                   re-ranking), and a dict of per-stage timings in milliseconds.
+        """
+        timings = {}
+        start = time.perf_counter()
+
+        with span('query_extraction') as s:
+            keypoints, descriptors = extract_keypoints_and_descriptors(query_file_path, self.mask_file_path, self.mask, self.feature_type)
+            s.count = len(descriptors)
+        timings['extract_ms'] = s.wall_ms
+
+        with span('knn_search', len(descriptors)) as s:
+            k = self.vote_neighbours if aggregate else 2
+            if prior is None:
+                indices, distances = knn_search(self.index, descriptors, k)
+            else:
+                indices, distances = self.spatial().search(descriptors, k, *prior)
+        timings['search_ms'] = s.wall_ms
+
+        with span('rank') as s:
+            best_matches = self.rank(indices, distances, max(n_best_matches, geometric_top_k), aggregate, ratio, bin_size)
+            s.count = len(best_matches)
+        timings['aggregate_ms'] = s.wall_ms
+
+        if geometric_top_k > 0:
+            with span('geometric_verification', geometric_top_k) as s:
+                query_points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+                best_matches = self.verify_geometry(query_points, descriptors, best_matches, n_best_matches, geometric_top_k, inlier_margin, min_inliers, ratio)
+            timings['geometric_ms'] = s.wall_ms
+
+        with span('drawing') as s:
+            if output_path is not None:
+                draw_matches(self.train_image, best_matches, output_path)
+                s.count = 1
+        timings['draw_ms'] = s.wall_ms
+
+        if visualize:
+            coords_list = [coords for _, coords in best_matches]
+            with span('verification', len(coords_list)) as s:
+                verifications = self.verifier.verify(descriptors, coords_list)
+            timings['verify_ms'] = s.wall_ms
+
+            with span('drawing', len(coords_list)) as s:
+                query_image = cv2.imread(query_file_path)
+                for i, (coords, verification) in enumerate(zip(coords_list, verifications)):
+                    self.verifier.draw(query_image, list(keypoints), coords, verification, f"output/sift_matches_{i}.png")
+            timings['draw_ms'] += s.wall_ms
+
+        timings['total_ms'] = (time.perf_counter() - start) * 1000
+        return best_matches, timings
+
+    def rank(self, indices, distances, n_best_matches, aggregate=False, ratio=0.75, bin_size=20):
+        """
+        Turns the nearest-neighbour results of one query into its best matches.
+
+        Args:
+            indices (numpy.ndarray): The (M, k) database row indices returned by knn_search.
+            distances (numpy.ndarray): The (M, k) distances returned by knn_search.
+            n_best_matches (int): The number of best matches to return.
+            aggregate (bool, optional): Whether to return vote map peaks instead of the raw closest matches.
+                                        Defaults to False.
+            ratio (float, optional): The ratio test threshold used when aggregating. Defaults to 0.75.
+            bin_size (int, optional): The vote map cell size in pixels used when aggregating. Defaults to 20.
+
+        Returns:
+            list: The best matches, each a tuple of a distance (or vote score) and subregion coordinates.
+        """
+        if aggregate:
+            # One vote map per pyramid level, so the peaks compete as (location, scale) hypotheses
+            hypotheses = []
+            levels = self.db_levels[indices[:, 0]] if len(indices) else np.empty(0, dtype=np.int64)
+            for level, scale in enumerate(self.scales):
+                rows = levels == level
+                accumulator = vote_matches(indices[rows], distances[rows], self.db_coords, self.train_image.shape[:2], bin_size, ratio)
+                hypotheses += find_vote_peaks(accumulator, n_best_matches, int(round(self.subregion_size / scale)), bin_size)
+            hypotheses.sort(key=lambda x: x[0], reverse=True)
+            return hypotheses[:n_best_matches]
+        return select_best_matches(indices[:, :2], distances[:, :2], self.db_coords, n_best_matches)
+
+    def verify_geometry(self, query_points, descriptors, candidates, n_best_matches, geometric_top_k, inlier_margin=2.0, min_inliers=8, ratio=0.75):
+        """
+        Re-ranks candidate windows by the number of query matches consistent with a single homography.
+
+        The query descriptors are ratio-tested against the database keypoints stored inside each window, so no SIFT
+        runs; databases without stored keypoint positions or descriptors fall back to the cached SIFT features of
+        the subregion. The first geometric_top_k candidates are checked in their original order, which stops as
+        soon as the best one has at least min_inliers inliers and inlier_margin times as many as the runner-up.
+
+        Args:
+            query_points (numpy.ndarray): The (M, 2) x, y positions of the query descriptors.
+            descriptors (numpy.ndarray): The (M, D) query descriptors.
+            candidates (list): The candidate matches, each a tuple of a score and subregion coordinates, best first.
+            n_best_matches (int): The number of best matches to return.
+            geometric_top_k (int): The number of candidates that may be checked.
+            inlier_margin (float, optional): The early exit ratio between the best and second best inlier counts.
+                                             Defaults to 2.0.
+            min_inliers (int, optional): The inliers needed for an early exit. Defaults to 8.
+            ratio (float, optional): The ratio test threshold. Defaults to 0.75.
+
+        Returns:
+            list: Up to n_best_matches matches: the checked candidates as (inlier count, coordinates) tuples, most
+                  inliers first, followed by the candidates that were not checked, because of an early exit or
+                  because they are past geometric_top_k, with their original scores and in their original order.
+        """
+        checked = []
+        for order, (_, coords) in enumerate(candidates[:geometric_top_k]):
+            checked.append((self.window_inliers(query_points, descriptors, coords, ratio), order, coords))
+
+            counts = sorted((inliers for inliers, _, _ in checked), reverse=True)
+            if len(counts) > 1 and counts[0] >= min_inliers and counts[0] >= inlier_margin * counts[1]:
+                break
+
+        checked.sort(key=lambda x: (-x[0], x[1]))
+        return ([(inliers, coords) for inliers, _, coords in checked] + candidates[len(checked):])[:n_best_matches]
+
+    def window_inliers(self, query_points, descriptors, coords, ratio=0.75):
+        """
+        Counts the RANSAC homography inliers between a query and one candidate window.
+
+        Args:
+            query_points (numpy.ndarray): The (M, 2) x, y positions of the query descriptors.
+            descriptors (numpy.ndarray): The (M, D) query descriptors.
+            coords (tuple): The coordinates of the candidate window.
+            ratio (float, optional): The ratio test threshold. Defaults to 0.75.
+
+        Returns:
+            int: The number of inliers.
+        """
+        if self.grid is not None and self.db_descriptors is not None:
+            rows = self.window_rows(coords)
+            query_idx, train_idx = ratio_matches(descriptors, self.db_descriptors[rows], ratio)
+            train_points = np.asarray(self.db_keypoints[rows[train_idx], :2])
+        else:
+            subregion_keypoints, good_matches = self.verifier.verify_one(descriptors, coords)
+            query_idx = np.array([m.queryIdx for m in good_matches], dtype=np.int64)
+            train_points = np.float32([subregion_keypoints[m.trainIdx].pt for m in good_matches]).reshape(-1, 2)
+        return count_inliers(query_points[query_idx], train_points)
+
+    def window_rows(self, coords):
+        """
+        Finds the database keypoints lying inside a window, on the pyramid level of the window.
+
+        Args:
+            coords (tuple): The (center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x)
+                            coordinates of the window in full resolution pixels.
+
+        Returns:
+            numpy.ndarray: The sorted database row indices of the keypoints.
+        """
+        _, _, top_left_y, top_left_x, bottom_right_y, bottom_right_x = coords
+        start, end = np.searchsorted(self.sorted_x, [top_left_x, bottom_right_x + 1])
+        rows = self.x_order[start:end]
+
+        y = np.asarray(self.db_keypoints[rows, 1])
+        level = self.scales.index(self.scale_of(coords))
+        rows = rows[(y >= top_left_y) & (y < bottom_right_y + 1) & (self.db_levels[rows] == level)]
+        return np.sort(rows)
+
+    def scale_of(self, coords):
+        """
+        Finds the pyramid scale of a match from the size of its subregion.
+
+        Args:
+            coords (tuple): The (center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x)
+                            coordinates of the match.
+
+        Returns:
+            float: The scale of the level whose subregions are closest in size.
+        """
+        side = coords[4] - coords[2] + 1
+        return min(self.scales, key=lambda scale: abs(self.subregion_size / scale - side))
+
+    def match_batch(self, query_file_paths, n_best_matches, aggregate=False, ratio=0.75, bin_size=20, processes=None, prior=None, geometric_top_k=0, inlier_margin=2.0, min_inliers=8):
+        """
+        Matches many query frames at once: SIFT runs for all frames in a process pool, then every descriptor is
+        searched in a single FLANN call and the results are split back per frame.
+
+        Args:
+            query_file_paths (list): The paths of the query images.
+            n_best_matches (int): The number of best matches to return per frame.
+            aggregate (bool, optional): Whether to return vote map peaks instead of the raw closest matches.
+                                        Defaults to False.
+            ratio (float, optional): The ratio test threshold used when aggregating. Defaults to 0.75.
+            bin_size (int, optional): The vote map cell size in pixels used when aggregating. Defaults to 20.
+            processes (int, optional): The number of extraction processes. Defaults to cpu_count().
+            prior (tuple, optional): A (center_y, center_x, radius) circle in train image pixels that every frame
+                                     is searched within, see match. Defaults to None, which searches the whole
+                                     database.
+            geometric_top_k (int, optional): The number of candidates of each frame re-ranked by homography inliers,
+                                             see match. Defaults to 0, which skips the stage.
+            inlier_margin (float, optional): The early exit ratio of the re-ranking. Defaults to 2.0.
+            min_inliers (int, optional): The inliers needed for an early exit of the re-ranking. Defaults to 8.
+
+        Returns:
+            list: One tuple per frame of its path, best matches, number of query descriptors and a dict of timings in
+                  milliseconds. The search time of the batched call is split between frames by descriptor count.
+        """
+        with span('query_extraction', len(query_file_paths)):
+            with Pool(processes or cpu_count(), initializer=init_query_worker, initargs=(self.mask_file_path, self.feature_type)) as pool:
+                extracted = list(tqdm(pool.imap(extract_query_descriptors, query_file_paths), total=len(query_file_paths), desc="Extracting Query Descriptors"))
+
+        counts = [len(descriptors) for _, _, descriptors, _ in extracted]
+        all_descriptors = np.vstack([descriptors for _, _, descriptors, _ in extracted] + [empty_descriptors(self.feature_type)])
+
+        with span('knn_search', len(all_descriptors)) as search:
+            k = self.vote_neighbours if aggregate else 2
+            if prior is None:
+                indices, distances = knn_search(self.index, all_descriptors, k)
+            else:
+                indices, distances = self.spatial().search(all_descriptors, k, *prior)
+
+        results = []
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        for (query_file_path, query_points, descriptors, extract_ms), start, end in zip(extracted, offsets[:-1], offsets[1:]):
+            with span('rank') as s:
+                best_matches = self.rank(indices[start:end], distances[start:end], max(n_best_matches, geometric_top_k), aggregate, ratio, bin_size)
+                s.count = len(best_matches)
+            timings = {
+                'extract_ms': extract_ms,
+                'search_ms': search.wall_ms * (end - start) / max(len(all_descriptors), 1),
+                'aggregate_ms': s.wall_ms,
+            }
+
+            if geometric_top_k > 0:
+                with span('geometric_verification', geometric_top_k) as s:
+                    best_matches = self.verify_geometry(query_points, descriptors, best_matches, n_best_matches, geometric_top_k, inlier_margin, min_inliers, ratio)
+                timings['geometric_ms'] = s.wall_ms
+            else:
+                best_matches = best_matches[:n_best_matches]
+            results.append((query_file_path, best_matches, int(end - start), timings))
+
+        return results
+
+# Query mask and feature type shared by the batch extraction workers, set up by init_query_worker
+_QUERY_MASK = None
+_QUERY_FEATURE_TYPE = 'sift'
+
+def init_query_worker(mask_file_path, feature_type='sift'):
     """
-    Display SIFT matches between two images.
+    Pool initializer that loads the query mask and creates the feature extractor once per batch extraction worker.
 
     Args:
-        query_path (str): The path to the query image.
-        query_keypoints (list): The keypoints detected in the query image.
-        query_descriptors (numpy.ndarray): The descriptors extracted from the query image.
-        img2 (numpy.ndarray): The second image for matching.
-        count (int): The count of the image.
+        mask_file_path (str): The path to the mask image, or None.
+        feature_type (str, optional): The feature type of the database. Defaults to 'sift'.
 
     Returns:
         None
     """
-    # Initiate SIFT detector
-    sift = cv2.SIFT_create()
+    global _QUERY_MASK, _QUERY_FEATURE_TYPE
+    _QUERY_MASK = load_mask(mask_file_path) if mask_file_path is not None else None
+    _QUERY_FEATURE_TYPE = feature_type
+    get_extractor(feature_type)
 
-    img1 = cv2.imread(query_path, cv2.IMREAD_GRAYSCALE)
-    img1_color = cv2.imread(query_path)
+def extract_query_descriptors(query_file_path):
+    """
+    Extracts the descriptors of one query frame inside a batch extraction worker.
 
-    kp2, des2 = sift.detectAndCompute(img2, None)
+    Args:
+        query_file_path (str): The path of the query image.
 
-    # FLANN parameters
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-    search_params = dict(checks=50)
+    Returns:
+        tuple: The query path, the (M, 2) x, y positions of its keypoints, its descriptors and the extraction time in
+               milliseconds.
+    """
+    start = time.perf_counter()
+    keypoints, descriptors = extract_keypoints_and_descriptors(query_file_path, None, _QUERY_MASK, _QUERY_FEATURE_TYPE)
+    query_points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+    return query_file_path, query_points, descriptors, (time.perf_counter() - start) * 1000
+
+def find_query_files(query_dir):
+    """
+    Lists the query images of a batch, given either a directory or a glob pattern.
 
-    # Create FLANN matcher
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
+    Args:
+        query_dir (str): A directory of images or a glob pattern such as `frames/frame_*.png`.
 
-    # Match descriptors
-    matches = flann.knnMatch(query_descriptors, des2, k=2)
+    Returns:
+        list: The sorted image paths.
+    """
+    if os.path.isdir(query_dir):
+        extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+        return sorted(os.path.join(query_dir, f) for f in os.listdir(query_dir) if f.lower().endswith(extensions))
+    return sorted(glob.glob(query_dir))
 
-    # Apply ratio test
-    good_matches = []
-    for m, n in matches:
-        if m.distance < 0.75 * n.distance:
-            good_matches.append(m)
+def write_batch_results(results, csv_path, scale_of=None):
+    """
+    Writes the results of DescriptorMatcher.match_batch to a CSV file with one row per frame and match rank.
 
-    # Compute scale factors
-    scale_x = img1.shape[1] / img2.shape[1]
-    scale_y = img1.shape[0] / img2.shape[0]
+    Args:
+        results (list): The results returned by match_batch.
+        csv_path (str): The path of the CSV file.
+        scale_of (callable, optional): Maps match coordinates to their pyramid scale, such as
+                                       DescriptorMatcher.scale_of. Defaults to None, which reports a scale of 1.
 
-    # Resize subregion
-    resized_subregion = cv2.resize(img2, (img1.shape[1], img1.shape[0]))
+    Returns:
+        None
+    """
+    if os.path.dirname(csv_path):
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frame', 'rank', 'score', 'center_y', 'center_x', 'top_left_y', 'top_left_x', 'bottom_right_y', 'bottom_right_x',
+                         'scale', 'n_descriptors', 'extract_ms', 'search_ms', 'aggregate_ms'])
+        for query_file_path, best_matches, n_descriptors, timings in results:
+            timing_values = [f"{timings[key]:.3f}" for key in ('extract_ms', 'search_ms', 'aggregate_ms')]
+            if not best_matches:
+                writer.writerow([query_file_path, '', '', '', '', '', '', '', '', '', n_descriptors] + timing_values)
+            for rank, (score, coords) in enumerate(best_matches, start=1):
+                scale = scale_of(coords) if scale_of is not None else 1.0
+                writer.writerow([query_file_path, rank, f"{score:.4f}", *coords, scale, n_descriptors] + timing_values)
+
+def serve(matcher, n_best_matches, input_stream=sys.stdin, output_stream=sys.stdout, aggregate=False, ratio=0.75, bin_size=20, geometric_top_k=0, inlier_margin=2.0, min_inliers=8, prior=None):
+    """
+    Answers a stream of queries read as JSON lines until the input is closed.
 
-    # Adjust keypoints
-    adjusted_keypoints2 = []
-    for kp in kp2:
-        x, y = kp.pt
-        adjusted_keypoints2.append(cv2.KeyPoint(x * scale_x, y * scale_y, kp.size * scale_x))
+    Each input line is either a bare query image path or a JSON object with a `query_file_path` key and optional
+    `n_best_matches`, `output_path`, `visualize`, `aggregate`, `ratio`, `bin_size`, `geometric_top_k`,
+    `inlier_margin`, `min_inliers` and `prior` (center_y, center_x, radius in pixels) keys, which override the
+    defaults below for that query. Each answer is written as one JSON line holding the matches and the per-stage
+    latency of that frame, or an `error` key if the query failed.
 
-    # Draw matches
-    img_matches = cv2.drawMatches(img1_color, query_keypoints, resized_subregion, adjusted_keypoints2, good_matches, None, flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
+    Args:
+        matcher (DescriptorMatcher): The loaded matcher.
+        n_best_matches (int): The default number of best matches to return.
+        input_stream (file, optional): Where queries are read from. Defaults to sys.stdin.
+        output_stream (file, optional): Where answers are written to. Defaults to sys.stdout.
+        aggregate (bool, optional): The default for whether to return vote map peaks. Defaults to False.
+        ratio (float, optional): The default ratio test threshold. Defaults to 0.75.
+        bin_size (int, optional): The default vote map cell size in pixels. Defaults to 20.
+        geometric_top_k (int, optional): The default number of candidates re-ranked by homography inliers.
+                                         Defaults to 0.
+        inlier_margin (float, optional): The default early exit ratio of the re-ranking. Defaults to 2.0.
+        min_inliers (int, optional): The default inliers needed for an early exit of the re-ranking. Defaults to 8.
+        prior (tuple, optional): The default (center_y, center_x, radius) circle searched, for requests without a
+                                 `prior` key. A request can search the whole database with `"prior": null`.
+                                 Defaults to None.
 
-    # Save the matches
-    cv2.imwrite(f"output/sift_matches_{count}.png", img_matches)
+    Returns:
+        None
+    """
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
 
-def main(query_file_path, mask_file_path, db_name, train_file_path, output_path, n_best_matches):
-    keypoints, descriptors = extract_keypoints_and_descriptors(query_file_path, mask_file_path)
-    best_matches = find_closest_matches(db_name, keypoints, descriptors,n_best_matches)
-    draw_matches(train_file_path, best_matches, output_path)
+        try:
+            request = json.loads(line) if line.startswith('{') else {'query_file_path': line}
+            best_matches, timings = matcher.match(
+                request['query_file_path'],
+                request.get('n_best_matches', n_best_matches),
+                request.get('output_path'),
+                request.get('visualize', False),
+                request.get('aggregate', aggregate),
+                ratio=request.get('ratio', ratio),
+                bin_size=request.get('bin_size', bin_size),
+                geometric_top_k=request.get('geometric_top_k', geometric_top_k),
+                inlier_margin=request.get('inlier_margin', inlier_margin),
+                min_inliers=request.get('min_inliers', min_inliers),
+                prior=request.get('prior', prior)
+            )
+            response = {
+                'query_file_path': request['query_file_path'],
+                # JSON has no infinity, so scores of padded neighbours are written as null
+                'matches': [{'distance': distance if np.isfinite(distance) else None, 'coords': list(coords), 'scale': matcher.scale_of(coords)} for distance, coords in best_matches],
+                'timings': timings,
+            }
+        except Exception as e:
+            response = {'query': line, 'error': str(e)}
+
+        output_stream.write(json.dumps(response) + '\n')
+        output_stream.flush()
+
+def main(query_file_path, mask_file_path, db_name, train_file_path, output_path, n_best_matches, verify_index=False, serve_queries=False, aggregate=False, ratio=0.75, bin_size=20, query_dir=None, csv_path='output/batch_results.csv', processes=None, rerank=0, visualize=False, geometric_top_k=0, inlier_margin=2.0, min_inliers=8, binary_index='lsh', timing_report_path=None, prior=None, prior_geo=None, train_bounds=None):
+    matcher = DescriptorMatcher(db_name, train_file_path, mask_file_path, verify_index, rerank, binary_index)
+    if prior_geo is not None:
+        prior = geo_to_pixels(*prior_geo, train_bounds, matcher.train_image.shape)
+        print(f"Prior in pixels: center_y={prior[0]:.1f}, center_x={prior[1]:.1f}, radius={prior[2]:.1f}")
+    if serve_queries:
+        serve(matcher, n_best_matches, aggregate=aggregate, ratio=ratio, bin_size=bin_size, geometric_top_k=geometric_top_k, inlier_margin=inlier_margin, min_inliers=min_inliers, prior=prior)
+    elif query_dir is not None:
+        results = matcher.match_batch(find_query_files(query_dir), n_best_matches, aggregate, ratio, bin_size, processes, prior, geometric_top_k, inlier_margin, min_inliers)
+        write_batch_results(results, csv_path, matcher.scale_of)
+        print(f"Wrote results for {len(results)} frames to {csv_path}")
+    else:
+        best_matches, _ = matcher.match(query_file_path, n_best_matches, output_path, visualize=visualize, aggregate=aggregate, ratio=ratio, bin_size=bin_size, geometric_top_k=geometric_top_k, inlier_margin=inlier_margin, min_inliers=min_inliers, prior=prior)
+        for distance, coords in best_matches:
+            print((distance, coords, matcher.scale_of(coords)))
 
-    for i, match in enumerate(best_matches):
-        subregion = extract_subregion(train_file_path, match[1])
-        display_sift_matches(query_file_path, keypoints, descriptors, subregion, i)
-        print(match)
+    if timing_report_path is not None:
+        write_timing_report(timing_report_path)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--query_file_path', type=str, default='/home/undadmin/Documents/GitHub/BEV_localization/Google_Earth_vids/ppl_v2/all_bevs/frame_0952.png', help='Path to the query image file.')
     parser.add_argument('--mask_file_path', type=str, default='/home/undadmin/Documents/GitHub/BEV_localization/Google_Earth_vids/ppl_v2/mask.png', help='Path to the mask image file.')
-    parser.add_argument('--db_name', type=str, default='/home/undadmin/Documents/GitHub/BEV_localization/descriptor_data_bases/ppl_v2_4.db', help='Name of the database file.')
+    parser.add_argument('--db_name', type=str, default='/home/undadmin/Documents/GitHub/BEV_localization/descriptor_data_bases/ppl_v2_4.db', help='Name of the database file, or the directory of a columnar .npy store.')
     parser.add_argument('--train_file_path', type=str, default='/home/undadmin/Documents/GitHub/BEV_localization/Google_Earth_vids/ppl_v2/sat4.png', help='Path to the training image file.')
     parser.add_argument('--output_path', type=str, default='output/output_image.png', help='Path to save the output image.')
     parser.add_argument('--n_best_matches', type=int, default=10, help='Number of best matches to return.')
+    parser.add_argument('--verify_index', action='store_true', help='Check the saved FLANN index against a full checksum of the database before using it.')
+    parser.add_argument('--aggregate', action='store_true', help='Vote the ratio-tested matches into a location heatmap and return its peaks.')
+    parser.add_argument('--ratio', type=float, default=0.75, help='Lowe ratio test threshold used by --aggregate.')
+    parser.add_argument('--bin_size', type=int, default=20, help='Heatmap cell size in pixels used by --aggregate.')
+    parser.add_argument('--query_dir', type=str, default=None, help='Directory or glob of query images to match as one batch instead of --query_file_path.')
+    parser.add_argument('--csv_path', type=str, default='output/batch_results.csv', help='Path of the CSV written by --query_dir.')
+    parser.add_argument('--processes', type=int, default=None, help='Number of SIFT extraction processes used by --query_dir. Defaults to the CPU count.')
+    parser.add_argument('--rerank', type=int, default=0, help='Number of candidates per query re-ranked with the full descriptors when the database is quantized.')
+    parser.add_argument('--visualize', action='store_true', help='Verify every best match with SIFT and save the match images as output/sift_matches_{i}.png.')
+    parser.add_argument('--geometric_top_k', type=int, default=0, help='Number of candidates re-ranked by the inliers of a RANSAC homography between the query and each candidate window.')
+    parser.add_argument('--inlier_margin', type=float, default=2.0, help='Stop the --geometric_top_k re-ranking once the best candidate has this many times the inliers of the runner-up.')
+    parser.add_argument('--min_inliers', type=int, default=8, help='Inliers the best candidate needs before the --geometric_top_k re-ranking can stop early.')
+    parser.add_argument('--binary_index', type=str, default='lsh', choices=['lsh', 'bf'], help='Search the binary descriptors of an ORB/AKAZE database with a FLANN LSH index or an exact brute-force Hamming matcher.')
+    parser.add_argument('--serve', action='store_true', help='Load everything once and answer query paths or JSON requests read line by line from stdin.')
+    parser.add_argument('--prior', type=float, nargs=3, default=None, metavar=('CENTER_Y', 'CENTER_X', 'RADIUS'), help='Only search the database rows whose window center lies within this circle, in train image pixels.')
+    parser.add_argument('--prior_geo', type=float, nargs=3, default=None, metavar=('LAT', 'LON', 'RADIUS_M'), help='The --prior circle given as a latitude, longitude and radius in meters. Requires --train_bounds.')
+    parser.add_argument('--train_bounds', type=float, nargs=4, default=None, metavar=('TOP_LEFT_LAT', 'TOP_LEFT_LON', 'BOTTOM_RIGHT_LAT', 'BOTTOM_RIGHT_LON'), help='Latitude and longitude of the corners of the north-up train image, used by --prior_geo.')
+    parser.add_argument('--timing_report', type=str, default='output/timing_report.json', help='Path of the JSON report of the time, memory and item counts of every stage.')
+    parser.add_argument('--profile', type=str, default=None, help='Run under cProfile and dump the stats to this path.')
 
     args = parser.parse_args()
+    if args.prior_geo is not None and args.train_bounds is None:
+        parser.error('--prior_geo requires --train_bounds')
 
-    main(args.query_file_path, args.mask_file_path, args.db_name, args.train_file_path, args.output_path, args.n_best_matches)
+    with profiled(args.profile):
+        main(args.query_file_path, args.mask_file_path, args.db_name, args.train_file_path, args.output_path, args.n_best_matches, args.verify_index, args.serve, args.aggregate, args.ratio, args.bin_size, args.query_dir, args.csv_path, args.processes, args.rerank, args.visualize, args.geometric_top_k, args.inlier_margin, args.min_inliers, args.binary_index, args.timing_report, args.prior, args.prior_geo, args.train_bounds)
 
 
@@ -0,0 +1,431 @@
+import cv2
+import numpy as np
+from tqdm import tqdm
+import json
+import os
+import time
+import argparse
+from descriptor_store import DESCRIPTORS_FILE, is_npy_store, load_descriptor_store
+
+QUANTIZER_FILE = 'quantizer.npz'
+CODES_FILE = 'codes.npy'
+CODE_NORMS_FILE = 'code_norms.npy'
+
+def has_quantizer(db_name):
+    """
+    Checks whether a descriptor database holds compressed codes.
+
+    Args:
+        db_name (str): The path of the `*.db` file or columnar store directory.
+
+    Returns:
+        bool: True if the database is a columnar store with a quantizer.
+    """
+    return is_npy_store(db_name) and os.path.exists(os.path.join(db_name, QUANTIZER_FILE))
+
+def train_pca(descriptors, dim, sample_size=100000, seed=0):
+    """
+    Fits a PCA projection to a random sample of the descriptors.
+
+    Args:
+        descriptors (numpy.ndarray): The float32 (N, D) descriptor matrix.
+        dim (int): The number of components to keep.
+        sample_size (int, optional): The maximum number of rows used for fitting. Defaults to 100000.
+        seed (int, optional): The seed of the row sample. Defaults to 0.
+
+    Returns:
+        tuple: The float32 (D,) mean and the float32 (dim, D) components.
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(descriptors), min(sample_size, len(descriptors)), replace=False))
+    sample = np.asarray(descriptors[sample], dtype=np.float32)
+
+    mean = sample.mean(axis=0)
+    _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+    return mean.astype(np.float32), vt[:dim].astype(np.float32)
+
+def train_product_quantizer(projected, n_subvectors, n_centroids=256, iterations=20):
+    """
+    Trains one k-means codebook per subvector of the projected descriptors.
+
+    Args:
+        projected (numpy.ndarray): The float32 (N, dim) training vectors. dim must be divisible by n_subvectors.
+        n_subvectors (int): The number of subvectors, which is also the number of bytes per code.
+        n_centroids (int, optional): The number of centroids per codebook, at most 256 and at most the number of
+            training vectors. Defaults to 256.
+        iterations (int, optional): The number of k-means iterations. Defaults to 20.
+
+    Returns:
+        numpy.ndarray: The float32 (n_subvectors, n_centroids, dim / n_subvectors) codebooks.
+    """
+    # k-means needs at least as many samples as centroids, so small stores get smaller codebooks
+    n_centroids = max(1, min(n_centroids, 256, len(projected)))
+    sub_dim = projected.shape[1] // n_subvectors
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 1e-3)
+    codebooks = []
+    for j in tqdm(range(n_subvectors), desc="Training Codebooks"):
+        subvectors = np.ascontiguousarray(projected[:, j * sub_dim:(j + 1) * sub_dim])
+        _, _, centers = cv2.kmeans(subvectors, n_centroids, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+        codebooks.append(centers)
+    return np.stack(codebooks).astype(np.float32)
+
+def project(descriptors, quantizer):
+    """
+    Projects descriptors onto the PCA components of a quantizer.
+
+    Args:
+        descriptors (numpy.ndarray): The (N, D) descriptors.
+        quantizer (dict): The quantizer parameters.
+
+    Returns:
+        numpy.ndarray: The float32 (N, dim) projected descriptors.
+    """
+    return (np.asarray(descriptors, dtype=np.float32) - quantizer['mean']) @ quantizer['components'].T
+
+def encode(descriptors, quantizer):
+    """
+    Compresses descriptors into uint8 codes.
+
+    Args:
+        descriptors (numpy.ndarray): The (N, D) descriptors.
+        quantizer (dict): The quantizer parameters.
+
+    Returns:
+        numpy.ndarray: The uint8 codes, (N, dim) for scalar quantization or (N, n_subvectors) for product
+                       quantization.
+    """
+    projected = project(descriptors, quantizer)
+
+    if quantizer['method'] == 'sq':
+        codes = np.rint((projected - quantizer['sq_min']) / quantizer['sq_scale'])
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    codebooks = quantizer['codebooks']
+    sub_dim = codebooks.shape[2]
+    codes = np.empty((len(projected), len(codebooks)), dtype=np.uint8)
+    for j, codebook in enumerate(codebooks):
+        subvectors = projected[:, j * sub_dim:(j + 1) * sub_dim]
+        dists = (subvectors ** 2).sum(axis=1, keepdims=True) - 2 * subvectors @ codebook.T + (codebook ** 2).sum(axis=1)
+        codes[:, j] = dists.argmin(axis=1)
+    return codes
+
+def decode(codes, quantizer):
+    """
+    Reconstructs projected descriptors from their codes.
+
+    Args:
+        codes (numpy.ndarray): The uint8 codes.
+        quantizer (dict): The quantizer parameters.
+
+    Returns:
+        numpy.ndarray: The float32 (N, dim) reconstructions.
+    """
+    if quantizer['method'] == 'sq':
+        return codes.astype(np.float32) * quantizer['sq_scale'] + quantizer['sq_min']
+
+    codebooks = quantizer['codebooks']
+    return np.concatenate([codebook[codes[:, j]] for j, codebook in enumerate(codebooks)], axis=1)
+
+def quantize_store(store_path, method='pq', pca_dim=64, n_subvectors=8, n_lists=None, drop_full_descriptors=False, block_rows=65536):
+    """
+    Trains a quantizer on a columnar store and writes the compressed codes next to its descriptors.
+
+    Rows are also assigned to the nearest of n_lists coarse k-means centroids, and the codes are written grouped by
+    list so a query only has to decode the few lists closest to it.
+
+    Args:
+        store_path (str): The directory of the columnar store.
+        method (str, optional): "sq" for uint8 scalar quantization or "pq" for product quantization. Defaults to "pq".
+        pca_dim (int, optional): The PCA dimension the descriptors are reduced to first. Defaults to 64.
+        n_subvectors (int, optional): The number of product quantization subvectors. Defaults to 8.
+        n_lists (int, optional): The number of coarse lists. Defaults to the square root of the row count.
+        drop_full_descriptors (bool, optional): Whether to delete `descriptors.npy` afterwards. The store then only
+                                                holds codes and cannot re-rank. Defaults to False.
+        block_rows (int, optional): The number of rows encoded at a time. Defaults to 65536.
+
+    Returns:
+        dict: The quantizer parameters.
+    """
+    if method == 'pq' and pca_dim % n_subvectors != 0:
+        raise ValueError(f"pca_dim ({pca_dim}) must be divisible by n_subvectors ({n_subvectors})")
+
+    descriptors, _ = load_descriptor_store(store_path)
+    mean, components = train_pca(descriptors, pca_dim)
+    quantizer = {'method': method, 'mean': mean, 'components': components}
+
+    sample = descriptors[np.sort(np.random.default_rng(0).choice(len(descriptors), min(100000, len(descriptors)), replace=False))]
+    projected_sample = project(sample, quantizer)
+    if method == 'sq':
+        quantizer['sq_min'] = projected_sample.min(axis=0)
+        quantizer['sq_scale'] = np.maximum(projected_sample.max(axis=0) - quantizer['sq_min'], 1e-6) / 255
+    else:
+        quantizer['codebooks'] = train_product_quantizer(projected_sample, n_subvectors)
+
+    if n_lists is None:
+        n_lists = int(np.sqrt(len(descriptors)))
+    # Like the codebooks, the coarse lists can never outnumber the training sample
+    n_lists = max(1, min(n_lists, len(projected_sample)))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+    _, _, quantizer['list_centroids'] = cv2.kmeans(projected_sample, n_lists, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+
+    code_width = pca_dim if method == 'sq' else n_subvectors
+    codes = np.empty((len(descriptors), code_width), dtype=np.uint8)
+    code_norms = np.empty(len(descriptors), dtype=np.float32)
+    lists = np.empty(len(descriptors), dtype=np.int32)
+    for start in tqdm(range(0, len(descriptors), block_rows), desc="Encoding Descriptors"):
+        block = descriptors[start:start + block_rows]
+        codes[start:start + block_rows] = encode(block, quantizer)
+        code_norms[start:start + block_rows] = (decode(codes[start:start + block_rows], quantizer) ** 2).sum(axis=1)
+        lists[start:start + block_rows] = nearest_lists(project(block, quantizer), quantizer['list_centroids'], 1)[:, 0]
+
+    order = np.argsort(lists, kind='stable')
+    quantizer['list_rows'] = order.astype(np.int32)
+    quantizer['list_offsets'] = np.searchsorted(lists[order], np.arange(n_lists + 1)).astype(np.int64)
+    np.save(os.path.join(store_path, CODES_FILE), codes[order])
+    # ||x||^2 of every decoded row, so loading the index does not have to decode the whole store
+    np.save(os.path.join(store_path, CODE_NORMS_FILE), code_norms[order])
+
+    np.savez(os.path.join(store_path, QUANTIZER_FILE), **quantizer)
+    if drop_full_descriptors:
+        del descriptors
+        os.remove(os.path.join(store_path, DESCRIPTORS_FILE))
+
+    return quantizer
+
+def nearest_lists(projected, centroids, n_probe):
+    """
+    Finds the coarse lists closest to each projected vector.
+
+    Args:
+        projected (numpy.ndarray): The float32 (M, dim) projected vectors.
+        centroids (numpy.ndarray): The float32 (n_lists, dim) coarse centroids.
+        n_probe (int): The number of lists per vector.
+
+    Returns:
+        numpy.ndarray: The (M, n_probe) list ids, closest first.
+    """
+    dists = (projected ** 2).sum(axis=1, keepdims=True) - 2 * projected @ centroids.T + (centroids ** 2).sum(axis=1)
+    n_probe = min(n_probe, len(centroids))
+    part = np.argpartition(dists, n_probe - 1, axis=1)[:, :n_probe]
+    order = np.argsort(np.take_along_axis(dists, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+def load_quantizer(store_path):
+    """
+    Loads the quantizer parameters of a columnar store.
+
+    Args:
+        store_path (str): The directory of the columnar store.
+
+    Returns:
+        dict: The quantizer parameters.
+    """
+    with np.load(os.path.join(store_path, QUANTIZER_FILE)) as data:
+        quantizer = {key: data[key] for key in data.files}
+    quantizer['method'] = str(quantizer['method'])
+    return quantizer
+
+class QuantizedIndex:
+    def __init__(self, store_path, full_descriptors=None, rerank=0, n_probe=16):
+        """
+        Searches the compressed codes of a columnar store with asymmetric distances: queries stay float32 and are
+        compared to the decoded database codes of the coarse lists nearest to them.
+
+        It exposes the same knnSearch call as cv2.flann.Index so it can be used anywhere a FLANN index is.
+
+        Args:
+            store_path (str): The directory of the columnar store.
+            full_descriptors (numpy.ndarray, optional): The full descriptors used for re-ranking. Defaults to None.
+            rerank (int, optional): The number of candidates per query re-ranked with exact distances to the full
+                                    descriptors. 0 disables re-ranking. Defaults to 0.
+            n_probe (int, optional): The number of coarse lists searched per query. Defaults to 16.
+
+        Returns:
+            None
+        """
+        self.quantizer = load_quantizer(store_path)
+        self.codes = np.load(os.path.join(store_path, CODES_FILE), mmap_mode='r')
+        self.full_descriptors = full_descriptors
+        self.rerank = rerank if full_descriptors is not None else 0
+        self.n_probe = n_probe
+
+        self.list_rows = self.quantizer['list_rows']
+        self.list_offsets = self.quantizer['list_offsets']
+        self.list_sizes = np.diff(self.list_offsets)
+        # ||x||^2 of every decoded row, so each query only needs one matrix product. Stores quantized before the
+        # norms were saved get them by decoding every code once
+        code_norms_path = os.path.join(store_path, CODE_NORMS_FILE)
+        if os.path.exists(code_norms_path):
+            self.code_norms = np.load(code_norms_path, mmap_mode='r')
+        else:
+            self.code_norms = np.concatenate([
+                (decode(self.codes[start:start + 65536], self.quantizer) ** 2).sum(axis=1)
+                for start in range(0, len(self.codes), 65536)
+            ] + [np.empty(0, dtype=np.float32)])
+
+    def search_list(self, projected, list_id, n_candidates):
+        """
+        Finds the closest rows of a coarse list for every query probing it.
+
+        Decoding the list and taking one matrix product gives the same distances as per-subvector lookup tables,
+        but runs through BLAS instead of a gather per code.
+
+        Args:
+            projected (numpy.ndarray): The float32 (M, dim) projected queries probing the list.
+            list_id (int): The list to search.
+            n_candidates (int): The number of rows kept per query.
+
+        Returns:
+            tuple: The (M, n_candidates) positions of the kept rows in the list-ordered codes and their squared
+                   distances, padded with infinite distances when the list is shorter than n_candidates.
+        """
+        start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+        decoded = decode(self.codes[start:end], self.quantizer)
+        dists = (projected ** 2).sum(axis=1, keepdims=True) - 2 * projected @ decoded.T + self.code_norms[start:end]
+
+        positions = np.zeros((len(projected), n_candidates), dtype=np.int64)
+        best = np.full((len(projected), n_candidates), np.inf, dtype=np.float32)
+        keep = min(n_candidates, end - start)
+        if keep:
+            part = np.argpartition(dists, keep - 1, axis=1)[:, :keep]
+            positions[:, :keep] = start + part
+            best[:, :keep] = np.maximum(np.take_along_axis(dists, part, axis=1), 0)
+        return positions, best
+
+    def knnSearch(self, query_descriptors, knn, params=None):
+        """
+        Finds the knn closest database rows of each query.
+
+        Args:
+            query_descriptors (numpy.ndarray): The float32 (M, D) query descriptors.
+            knn (int): The number of neighbours per query.
+            params (dict, optional): Ignored, accepted for compatibility with cv2.flann.Index. Defaults to None.
+
+        Returns:
+            tuple: The int32 (M, knn) row indices and the float32 (M, knn) squared distances, closest first.
+        """
+        projected = project(query_descriptors, self.quantizer)
+        n_candidates = min(max(knn, self.rerank), len(self.codes))
+        # Probe enough lists that even the smallest ones hold n_candidates rows between them
+        n_probe = max(self.n_probe, np.searchsorted(np.cumsum(np.sort(self.list_sizes)), n_candidates) + 1)
+        probes = nearest_lists(projected, self.quantizer['list_centroids'], n_probe)
+
+        # Each list is decoded once for all the queries probing it
+        positions = np.zeros((len(projected), probes.shape[1], n_candidates), dtype=np.int64)
+        dists = np.full((len(projected), probes.shape[1], n_candidates), np.inf, dtype=np.float32)
+        for list_id in np.unique(probes):
+            queries, slots = np.nonzero(probes == list_id)
+            positions[queries, slots], dists[queries, slots] = self.search_list(projected[queries], list_id, n_candidates)
+
+        positions = positions.reshape(len(projected), -1)
+        dists = dists.reshape(len(projected), -1)
+        part = np.argpartition(dists, n_candidates - 1, axis=1)[:, :n_candidates]
+        best_idx = self.list_rows[np.take_along_axis(positions, part, axis=1)].astype(np.int64)
+        best_dist = np.take_along_axis(dists, part, axis=1)
+
+        if self.rerank:
+            rows = np.sort(np.unique(best_idx))
+            full = np.asarray(self.full_descriptors[rows], dtype=np.float32)
+            candidates = full[np.searchsorted(rows, best_idx)]
+            best_dist = ((candidates - np.asarray(query_descriptors, dtype=np.float32)[:, None, :]) ** 2).sum(axis=2)
+
+        order = np.argsort(best_dist, axis=1)[:, :knn]
+        return np.take_along_axis(best_idx, order, axis=1).astype(np.int32), np.take_along_axis(best_dist, order, axis=1).astype(np.float32)
+
+def exact_knn(descriptors, queries, k, block_rows=65536):
+    """
+    Finds the exact k nearest database rows of each query by brute force.
+
+    Args:
+        descriptors (numpy.ndarray): The (N, D) database descriptors.
+        queries (numpy.ndarray): The (M, D) query descriptors.
+        k (int): The number of neighbours per query.
+        block_rows (int, optional): The number of database rows compared at a time. Defaults to 65536.
+
+    Returns:
+        numpy.ndarray: The (M, k) row indices, closest first.
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    best_idx = np.empty((len(queries), 0), dtype=np.int64)
+    best_dist = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(descriptors), block_rows):
+        block = np.asarray(descriptors[start:start + block_rows], dtype=np.float32)
+        block_dist = (queries ** 2).sum(axis=1, keepdims=True) - 2 * queries @ block.T + (block ** 2).sum(axis=1)
+        dists = np.concatenate([best_dist, block_dist], axis=1)
+        idx = np.concatenate([best_idx, np.broadcast_to(np.arange(start, start + len(block)), block_dist.shape)], axis=1)
+        part = np.argpartition(dists, min(k, dists.shape[1]) - 1, axis=1)[:, :k]
+        best_dist = np.take_along_axis(dists, part, axis=1)
+        best_idx = np.take_along_axis(idx, part, axis=1)
+    order = np.argsort(best_dist, axis=1)
+    return np.take_along_axis(best_idx, order, axis=1)
+
+def benchmark_recall(store_path, n_queries=500, k=10, rerank=100, noise=0.25, seed=0):
+    """
+    Measures how much accuracy and speed the compressed codes of a store trade against exact search.
+
+    Queries are database descriptors perturbed with Gaussian noise. Recall@1 is the share of queries whose exact
+    nearest neighbour is returned first, and recall@k the share of exact top-k neighbours found in the top k.
+    Distances are compared as vectors, so duplicate rows from overlapping subregions count as the same neighbour.
+
+    Args:
+        store_path (str): The directory of a quantized columnar store that still holds its full descriptors.
+        n_queries (int, optional): The number of queries. Defaults to 500.
+        k (int, optional): The number of neighbours compared. Defaults to 10.
+        rerank (int, optional): The number of candidates re-ranked in the re-ranking run. Defaults to 100.
+        noise (float, optional): The standard deviation of the query noise relative to the descriptor norm.
+                                 Defaults to 0.25.
+        seed (int, optional): The seed of the query sample. Defaults to 0.
+
+    Returns:
+        dict: The sizes, search times and recalls of exact, quantized and re-ranked search.
+    """
+    descriptors, _ = load_descriptor_store(store_path)
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(descriptors[rng.choice(len(descriptors), n_queries, replace=False)], dtype=np.float32)
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    queries = queries + rng.normal(0, 1, queries.shape).astype(np.float32) * norms * noise / np.sqrt(queries.shape[1])
+
+    start = time.perf_counter()
+    truth = exact_knn(descriptors, queries, k)
+    exact_ms = (time.perf_counter() - start) * 1000
+    truth_vectors = np.asarray(descriptors[truth.ravel()]).reshape(n_queries, k, -1)
+
+    def recall(found):
+        found_vectors = np.asarray(descriptors[found.ravel()]).reshape(n_queries, k, -1)
+        top1 = np.all(found_vectors[:, 0] == truth_vectors[:, 0], axis=1).mean()
+        hits = np.all(found_vectors[:, :, None, :] == truth_vectors[:, None, :, :], axis=3).any(axis=1).mean()
+        return float(top1), float(hits)
+
+    report = {
+        'rows': int(len(descriptors)),
+        'full_bytes': int(descriptors.nbytes),
+        'code_bytes': int(np.load(os.path.join(store_path, CODES_FILE), mmap_mode='r').nbytes),
+        'exact_search_ms': exact_ms,
+    }
+    for name, n_rerank in (('quantized', 0), ('reranked', rerank)):
+        index = QuantizedIndex(store_path, descriptors, n_rerank)
+        start = time.perf_counter()
+        found, _ = index.knnSearch(queries, k)
+        report[f'{name}_search_ms'] = (time.perf_counter() - start) * 1000
+        report[f'{name}_recall_at_1'], report[f'{name}_recall_at_{k}'] = recall(found)
+
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compress a columnar descriptor store, or benchmark the recall of its codes.')
+    parser.add_argument('--store_path', type=str, required=True, help='Directory of the columnar store.')
+    parser.add_argument('--method', type=str, default='pq', choices=['sq', 'pq'], help='uint8 scalar quantization or product quantization.')
+    parser.add_argument('--pca_dim', type=int, default=64, help='PCA dimension the descriptors are reduced to before quantization.')
+    parser.add_argument('--pq_subvectors', type=int, default=8, help='Number of product quantization subvectors (bytes per code).')
+    parser.add_argument('--n_lists', type=int, default=None, help='Number of coarse lists. Defaults to the square root of the row count.')
+    parser.add_argument('--drop_full_descriptors', action='store_true', help='Delete descriptors.npy after encoding. Re-ranking is then unavailable.')
+    parser.add_argument('--benchmark', action='store_true', help='Report the recall and speed of an already quantized store instead of quantizing it.')
+
+    args = parser.parse_args()
+    if not args.benchmark and args.method == 'pq' and args.pca_dim % args.pq_subvectors != 0:
+        parser.error('--pca_dim must be divisible by --pq_subvectors')
+
+    if args.benchmark:
+        print(json.dumps(benchmark_recall(args.store_path), indent=4))
+    else:
+        quantize_store(args.store_path, args.method, args.pca_dim, args.pq_subvectors, args.n_lists, args.drop_full_descriptors)
@@ -0,0 +1,332 @@
+import sqlite3
+import numpy as np
+from tqdm import tqdm
+import json
+import os
+import shutil
+import argparse
+from feature_types import feature_metadata
+from subregion_grid import level_shape, nearest_windows
+
+DESCRIPTORS_FILE = 'descriptors.npy'
+COORDS_FILE = 'coords.npy'
+KEYPOINTS_FILE = 'keypoints.npy'
+GRID_FILE = 'grid.json'
+FEATURES_FILE = 'features.json'
+
+# Room reserved for each .npy header so it can be rewritten in place once the row count is known
+NPY_HEADER_SIZE = 128
+
+def is_npy_store(db_name):
+    """
+    Checks whether a database path refers to a columnar `.npy` store rather than a SQLite file.
+
+    Args:
+        db_name (str): The path of the descriptor database.
+
+    Returns:
+        bool: True if the path is a directory holding a columnar store.
+    """
+    return os.path.isdir(db_name)
+
+def npy_header(dtype, shape):
+    """
+    Builds a version 1.0 `.npy` header padded to exactly NPY_HEADER_SIZE bytes.
+
+    Args:
+        dtype (numpy.dtype): The dtype of the array.
+        shape (tuple): The shape of the array.
+
+    Returns:
+        bytes: The encoded header.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.dtype(dtype).str, tuple(shape))
+    header_len = NPY_HEADER_SIZE - 10
+    header = header.ljust(header_len - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + np.uint16(header_len).tobytes() + header.encode('latin1')
+
+class NpyStoreWriter:
+    def __init__(self, store_path, descriptor_dim=None, grid=None, feature_type='sift'):
+        """
+        Opens a columnar descriptor store for streaming writes.
+
+        Rows are appended to `descriptors.npy` (N x descriptor_dim, float32 or packed uint8 bytes for binary
+        features) and either `coords.npy` (int32, N x 6) or, when a grid is given, `keypoints.npy` (float32, N x 5
+        of x, y, scale, angle, level) with the grid parameters in `grid.json`. The feature type is recorded in
+        `features.json`. The headers are written with a placeholder row count and fixed up by close.
+
+        Args:
+            store_path (str): The directory of the store. An existing store is replaced.
+            descriptor_dim (int, optional): The length of each descriptor. Defaults to that of the feature type.
+            grid (dict, optional): The image_height, image_width, subregion_size and step of the sampling grid and
+                                   the scales of the pyramid levels of a keypoint store. Defaults to None.
+            feature_type (str, optional): The feature type of the descriptors. Defaults to 'sift'.
+
+        Returns:
+            None
+        """
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path)
+        os.makedirs(store_path)
+
+        features = feature_metadata(feature_type)
+        if descriptor_dim is not None:
+            features['descriptor_dim'] = descriptor_dim
+        with open(os.path.join(store_path, FEATURES_FILE), 'w') as f:
+            json.dump(features, f, indent=4)
+
+        self.store_path = store_path
+        self.descriptor_dim = features['descriptor_dim']
+        self.descriptor_dtype = np.dtype(features['descriptor_dtype'])
+        self.n_rows = 0
+        if grid is not None:
+            with open(os.path.join(store_path, GRID_FILE), 'w') as f:
+                json.dump(grid, f, indent=4)
+            self.rows_file_name, self.rows_dtype, self.rows_width = KEYPOINTS_FILE, np.float32, 5
+        else:
+            self.rows_file_name, self.rows_dtype, self.rows_width = COORDS_FILE, np.int32, 6
+
+        self.descriptors_file = open(os.path.join(store_path, DESCRIPTORS_FILE), 'wb')
+        self.rows_file = open(os.path.join(store_path, self.rows_file_name), 'wb')
+        self.descriptors_file.write(npy_header(self.descriptor_dtype, (0, self.descriptor_dim)))
+        self.rows_file.write(npy_header(self.rows_dtype, (0, self.rows_width)))
+
+    def write(self, descriptors_list):
+        """
+        Appends a batch of descriptors to the store.
+
+        Args:
+            descriptors_list (list): List of tuples containing descriptors and their coordinates or keypoints.
+
+        Returns:
+            int: The number of rows written.
+        """
+        if not descriptors_list:
+            return 0
+        descriptors = np.asarray([descriptor for descriptor, _ in descriptors_list], dtype=self.descriptor_dtype)
+        rows = np.asarray([row for _, row in descriptors_list], dtype=self.rows_dtype)
+        self.descriptors_file.write(descriptors.reshape(-1, self.descriptor_dim).tobytes())
+        self.rows_file.write(rows.tobytes())
+        self.n_rows += len(descriptors_list)
+        return len(descriptors_list)
+
+    def close(self):
+        """
+        Writes the final row counts into the headers and closes the files.
+
+        Returns:
+            None
+        """
+        for file, dtype, width in ((self.descriptors_file, self.descriptor_dtype, self.descriptor_dim), (self.rows_file, self.rows_dtype, self.rows_width)):
+            file.seek(0)
+            file.write(npy_header(dtype, (self.n_rows, width)))
+            file.close()
+
+def has_keypoints_table(conn):
+    """
+    Checks whether a SQLite descriptor database uses the deduplicated `keypoints` schema.
+
+    Args:
+        conn: Connection to the SQLite database.
+
+    Returns:
+        bool: True if the database has a `keypoints` table.
+    """
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'keypoints'").fetchone() is not None
+
+def read_grid(conn):
+    """
+    Reads the sampling grid and pyramid scales of a deduplicated SQLite database.
+
+    Args:
+        conn: Connection to the SQLite database.
+
+    Returns:
+        dict: The image_height, image_width, subregion_size, step and scales of the database.
+    """
+    grid = dict(zip(('image_height', 'image_width', 'subregion_size', 'step'), conn.execute('SELECT image_height, image_width, subregion_size, step FROM grid').fetchone()))
+    has_levels = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'levels'").fetchone() is not None
+    grid['scales'] = [row[0] for row in conn.execute('SELECT scale FROM levels ORDER BY level')] if has_levels else [1.0]
+    return grid
+
+def read_features(db_name):
+    """
+    Reads the feature type of a descriptor database. Databases built before it was recorded hold SIFT descriptors.
+
+    Args:
+        db_name (str): The path of the `*.db` file or columnar store directory.
+
+    Returns:
+        dict: The feature_type, descriptor_dim and descriptor_dtype of the descriptors.
+    """
+    if is_npy_store(db_name):
+        features_path = os.path.join(db_name, FEATURES_FILE)
+        if not os.path.exists(features_path):
+            return feature_metadata('sift')
+        with open(features_path, 'r') as f:
+            return json.load(f)
+
+    conn = sqlite3.connect(db_name)
+    has_features = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'features'").fetchone() is not None
+    row = conn.execute('SELECT feature_type, descriptor_dim, descriptor_dtype FROM features').fetchone() if has_features else None
+    conn.close()
+    if row is None:
+        return feature_metadata('sift')
+    return dict(zip(('feature_type', 'descriptor_dim', 'descriptor_dtype'), row))
+
+def load_keypoints(db_name, mmap=True):
+    """
+    Loads the keypoints and sampling grid of a deduplicated database.
+
+    Databases built before pyramid levels were stored are read as a single level of scale 1.
+
+    Args:
+        db_name (str): The path of the `*.db` file or columnar store directory.
+        mmap (bool, optional): Whether to memory-map a columnar store. Defaults to True.
+
+    Returns:
+        tuple: A float32 (N, 5) array of (x, y, scale, angle, level) keypoints in full resolution train image pixels
+               and a dict with the image_height, image_width, subregion_size, step and level scales of the grid, or
+               (None, None) for a database that stores one row per subregion.
+    """
+    if is_npy_store(db_name):
+        if not os.path.exists(os.path.join(db_name, KEYPOINTS_FILE)):
+            return None, None
+        with open(os.path.join(db_name, GRID_FILE), 'r') as f:
+            grid = json.load(f)
+        grid.setdefault('scales', [1.0])
+        keypoints = np.load(os.path.join(db_name, KEYPOINTS_FILE), mmap_mode='r' if mmap else None)
+        if keypoints.shape[1] == 4:
+            keypoints = np.hstack([keypoints, np.zeros((len(keypoints), 1), dtype=np.float32)])
+        return keypoints, grid
+
+    conn = sqlite3.connect(db_name)
+    if not has_keypoints_table(conn):
+        conn.close()
+        return None, None
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(keypoints)')]
+    level = 'level' if 'level' in columns else '0'
+    keypoints = np.array(conn.execute(f'SELECT x, y, scale, angle, {level} FROM keypoints ORDER BY id').fetchall(), dtype=np.float32).reshape(-1, 5)
+    grid = read_grid(conn)
+    conn.close()
+    return keypoints, grid
+
+def keypoint_windows(keypoints, grid):
+    """
+    Computes the subregion each deduplicated keypoint is reported in.
+
+    The subregion is picked on the grid of the keypoint's pyramid level and mapped back to full resolution pixels,
+    so a level of scale 0.5 reports subregions twice the size of the grid's subregion_size.
+
+    Args:
+        keypoints (numpy.ndarray): The (N, 5) keypoints from load_keypoints.
+        grid (dict): The grid parameters from load_keypoints.
+
+    Returns:
+        numpy.ndarray: An int32 (N, 6) array of (center_y, center_x, top_left_y, top_left_x, bottom_right_y,
+                       bottom_right_x) coordinates.
+    """
+    image_shape = (grid['image_height'], grid['image_width'])
+    levels = np.asarray(keypoints[:, 4]).astype(np.int64)
+    coords = np.empty((len(keypoints), 6), dtype=np.int32)
+    for level, scale in enumerate(grid['scales']):
+        rows = levels == level
+        windows = nearest_windows(keypoints[rows, :2] * scale, level_shape(image_shape, scale), grid['subregion_size'], grid['step'])
+        # Bottom-right corners are inclusive, so scale the exclusive edge and step back one pixel
+        coords[rows, :4] = np.rint(windows[:, :4] / scale)
+        coords[rows, 4:] = np.rint((windows[:, 4:] + 1) / scale) - 1
+    return coords
+
+def load_descriptor_store(db_name, mmap=True):
+    """
+    Loads every descriptor and its subregion coordinates from either backend.
+
+    A columnar store is memory-mapped, so loading is nearly free and pages are only read as the search touches
+    them. A SQLite database is read in one query and converted with a single buffer join. In a deduplicated
+    database each keypoint is one row, and its coordinates are those of the subregion centered closest to it.
+
+    Args:
+        db_name (str): The path of the `*.db` file or columnar store directory.
+        mmap (bool, optional): Whether to memory-map a columnar store. Defaults to True.
+
+    Returns:
+        tuple: An (N, descriptor_dim) descriptor array, float32 or packed uint8 bytes as recorded by read_features,
+               and an (N, 6) array of (center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x)
+               coordinates. The descriptors are None for a quantized store whose full descriptors were dropped.
+    """
+    if is_npy_store(db_name):
+        mmap_mode = 'r' if mmap else None
+        descriptors_path = os.path.join(db_name, DESCRIPTORS_FILE)
+        descriptors = np.load(descriptors_path, mmap_mode=mmap_mode) if os.path.exists(descriptors_path) else None
+        keypoints, grid = load_keypoints(db_name, mmap)
+        if keypoints is not None:
+            return descriptors, keypoint_windows(keypoints, grid)
+        coords = np.load(os.path.join(db_name, COORDS_FILE), mmap_mode=mmap_mode)
+        return descriptors, coords
+
+    features = read_features(db_name)
+    dtype, dim = features['descriptor_dtype'], features['descriptor_dim']
+    conn = sqlite3.connect(db_name)
+    c = conn.cursor()
+    if has_keypoints_table(conn):
+        rows = c.execute('SELECT descriptor FROM keypoints ORDER BY id').fetchall()
+        conn.close()
+        keypoints, grid = load_keypoints(db_name)
+        descriptors = np.frombuffer(b''.join(row[0] for row in rows), dtype=dtype).reshape(-1, dim)
+        return descriptors, keypoint_windows(keypoints, grid)
+
+    c.execute('SELECT descriptor, center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x FROM descriptors ORDER BY id')
+    rows = c.fetchall()
+    conn.close()
+
+    descriptors = np.frombuffer(b''.join(row[0] for row in rows), dtype=dtype).reshape(-1, dim)
+    coords = np.array([row[1:] for row in rows], dtype=np.int32).reshape(-1, 6)
+    return descriptors, coords
+
+def convert_db_to_npy(db_name, store_path, batch_size=100000):
+    """
+    Converts an existing SQLite descriptor database into a columnar store.
+
+    Args:
+        db_name (str): The path of the `*.db` file.
+        store_path (str): The directory of the columnar store to create.
+        batch_size (int, optional): The number of rows copied at a time. Defaults to 100000.
+
+    Returns:
+        int: The number of rows converted.
+    """
+    features = read_features(db_name)
+    conn = sqlite3.connect(db_name)
+    c = conn.cursor()
+    if has_keypoints_table(conn):
+        grid = read_grid(conn)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(keypoints)')]
+        total = c.execute('SELECT COUNT(*) FROM keypoints').fetchone()[0]
+        c.execute(f"SELECT descriptor, x, y, scale, angle, {'level' if 'level' in columns else '0'} FROM keypoints ORDER BY id")
+    else:
+        grid = None
+        total = c.execute('SELECT COUNT(*) FROM descriptors').fetchone()[0]
+        c.execute('SELECT descriptor, center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x FROM descriptors ORDER BY id')
+
+    writer = NpyStoreWriter(store_path, features['descriptor_dim'], grid, features['feature_type'])
+    with tqdm(total=total, desc="Converting Descriptors") as pbar:
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.write([(np.frombuffer(row[0], dtype=features['descriptor_dtype']), row[1:]) for row in rows])
+            pbar.update(len(rows))
+    writer.close()
+    conn.close()
+
+    return writer.n_rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a SQLite descriptor database into a columnar .npy store.')
+    parser.add_argument('--db_name', type=str, required=True, help='Path to the *.db file to convert.')
+    parser.add_argument('--store_path', type=str, required=True, help='Directory of the columnar store to create.')
+    parser.add_argument('--batch_size', type=int, default=100000, help='Number of rows copied at a time.')
+
+    args = parser.parse_args()
+
+    convert_db_to_npy(args.db_name, args.store_path, args.batch_size)
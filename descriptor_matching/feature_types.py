@@ -0,0 +1,122 @@
+import cv2
+import numpy as np
+import threading
+
+# Descriptor layout of every supported feature type. Binary descriptors are packed bytes compared by Hamming distance
+FEATURE_TYPES = {
+    'sift': {'descriptor_dim': 128, 'descriptor_dtype': 'float32'},
+    'orb': {'descriptor_dim': 32, 'descriptor_dtype': 'uint8'},
+    'akaze': {'descriptor_dim': 61, 'descriptor_dtype': 'uint8'},
+}
+
+# ORB keeps only its strongest keypoints, so allow as many per detection tile or frame as SIFT typically finds
+ORB_MAX_FEATURES = 20000
+
+def create_detector(feature_type='sift'):
+    """
+    Creates the OpenCV detector of a feature type.
+
+    Args:
+        feature_type (str, optional): One of the keys of FEATURE_TYPES. Defaults to 'sift'.
+
+    Returns:
+        cv2.Feature2D: The detector.
+    """
+    if feature_type == 'sift':
+        return cv2.SIFT_create()
+    if feature_type == 'orb':
+        return cv2.ORB_create(nfeatures=ORB_MAX_FEATURES)
+    if feature_type == 'akaze':
+        if not hasattr(cv2, 'AKAZE_create'):
+            raise ValueError(f"AKAZE is not available in OpenCV {cv2.__version__}")
+        return cv2.AKAZE_create()
+    raise ValueError(f"Unknown feature type {feature_type!r}; expected one of {', '.join(FEATURE_TYPES)}")
+
+def feature_metadata(feature_type='sift'):
+    """
+    Describes the descriptors of a feature type as they are recorded in a database.
+
+    Args:
+        feature_type (str, optional): One of the keys of FEATURE_TYPES. Defaults to 'sift'.
+
+    Returns:
+        dict: The feature_type, descriptor_dim and descriptor_dtype.
+    """
+    return {'feature_type': feature_type, **FEATURE_TYPES[feature_type]}
+
+def empty_descriptors(feature_type='sift'):
+    """
+    Returns a descriptor matrix with no rows, for frames or subregions where nothing was detected.
+
+    Args:
+        feature_type (str, optional): One of the keys of FEATURE_TYPES. Defaults to 'sift'.
+
+    Returns:
+        numpy.ndarray: A (0, descriptor_dim) array of the descriptor dtype.
+    """
+    return np.empty((0, FEATURE_TYPES[feature_type]['descriptor_dim']), dtype=FEATURE_TYPES[feature_type]['descriptor_dtype'])
+
+class FeatureExtractor:
+    def __init__(self, feature_type='sift'):
+        """
+        Holds one OpenCV detector and runs it on image after image.
+
+        Detectors are not guaranteed to be safe to share between threads, so use get_extractor to obtain the
+        extractor of the calling process and thread rather than constructing one per image.
+
+        Args:
+            feature_type (str, optional): One of the keys of FEATURE_TYPES. Defaults to 'sift'.
+
+        Returns:
+            None
+        """
+        self.feature_type = feature_type
+        self.detector = create_detector(feature_type)
+
+    def detect_and_compute(self, image, mask=None):
+        """
+        Detects keypoints and computes their descriptors.
+
+        Args:
+            image (numpy.ndarray): The grayscale image.
+            mask (numpy.ndarray, optional): A uint8 mask of the pixels to search. Defaults to None.
+
+        Returns:
+            tuple: The keypoints and their (K, descriptor_dim) descriptors, which have no rows when nothing is found.
+        """
+        keypoints, descriptors = self.detector.detectAndCompute(image, mask)
+        if descriptors is None:
+            return (), empty_descriptors(self.feature_type)
+        return keypoints, descriptors
+
+# Extractors of the current process, one set per thread, filled by get_extractor
+_EXTRACTORS = threading.local()
+
+def get_extractor(feature_type='sift'):
+    """
+    Returns the cached extractor of a feature type for the calling process and thread, creating it on first use.
+
+    Pool initializers call this once so that every task of a worker reuses the same detector.
+
+    Args:
+        feature_type (str, optional): One of the keys of FEATURE_TYPES. Defaults to 'sift'.
+
+    Returns:
+        FeatureExtractor: The extractor.
+    """
+    extractors = _EXTRACTORS.__dict__
+    if feature_type not in extractors:
+        extractors[feature_type] = FeatureExtractor(feature_type)
+    return extractors[feature_type]
+
+def is_binary(descriptors):
+    """
+    Checks whether descriptors are packed binary strings, to be compared by Hamming rather than L2 distance.
+
+    Args:
+        descriptors (numpy.ndarray): The descriptor matrix.
+
+    Returns:
+        bool: True for uint8 descriptors.
+    """
+    return descriptors is not None and descriptors.dtype == np.uint8
@@ -0,0 +1,288 @@
+import cv2
+import numpy as np
+import hashlib
+import json
+import os
+import argparse
+from descriptor_store import is_npy_store, load_descriptor_store
+from descriptor_quantization import QuantizedIndex, has_quantizer
+from feature_types import is_binary
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+INDEX_PARAMS = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+LSH_INDEX_PARAMS = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+SEARCH_PARAMS = dict(checks=50)
+
+# cv2.BFMatcher refuses train sets of 2^18 rows or more, so larger databases are searched block by block
+BRUTE_FORCE_BLOCK_ROWS = 1 << 17
+
+# Float descriptors are compared as one distance matrix per block, so their blocks are kept to a few tens of MB
+L2_BLOCK_ROWS = 8192
+
+class BruteForceIndex:
+    def __init__(self, descriptors, block_rows=BRUTE_FORCE_BLOCK_ROWS):
+        """
+        Exact brute-force search exposing the knnSearch interface of cv2.flann.Index: OpenCV's popcount Hamming
+        matcher over binary descriptors, and squared L2 distances from one BLAS matrix product per block
+        otherwise, which is several times faster than cv2.BFMatcher.
+
+        Args:
+            descriptors (numpy.ndarray): The (N, D) descriptors, packed uint8 bytes or float32.
+            block_rows (int, optional): The number of database rows matched at a time. Defaults to
+                                        BRUTE_FORCE_BLOCK_ROWS, or L2_BLOCK_ROWS for float descriptors.
+
+        Returns:
+            None
+        """
+        self.descriptors = descriptors
+        self.binary = is_binary(descriptors)
+        self.block_rows = block_rows if self.binary else min(block_rows, L2_BLOCK_ROWS)
+
+    def search_block(self, query_descriptors, block, knn):
+        """
+        Finds the knn rows of one block closest to each query descriptor.
+
+        Args:
+            query_descriptors (numpy.ndarray): The (M, D) query descriptors.
+            block (numpy.ndarray): The contiguous (B, D) database rows.
+            knn (int): The number of neighbours per query.
+
+        Returns:
+            tuple: The (M, knn) row indices within the block and their distances, -1 and inf where the block has
+                   fewer than knn rows.
+        """
+        idx = np.full((len(query_descriptors), knn), -1, dtype=np.int64)
+        dist = np.full((len(query_descriptors), knn), np.inf, dtype=np.float32)
+        if self.binary:
+            for i, matches in enumerate(cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(query_descriptors, block, k=knn)):
+                idx[i, :len(matches)] = [m.trainIdx for m in matches]
+                dist[i, :len(matches)] = [m.distance for m in matches]
+            return idx, dist
+
+        distances = (query_descriptors ** 2).sum(axis=1)[:, None] + (block ** 2).sum(axis=1)[None, :] - 2 * query_descriptors @ block.T
+        n = min(knn, len(block))
+        nearest = np.argpartition(distances, n - 1, axis=1)[:, :n] if n < len(block) else np.broadcast_to(np.arange(len(block)), distances.shape)
+        idx[:, :n] = nearest
+        dist[:, :n] = np.maximum(np.take_along_axis(distances, nearest, axis=1), 0)
+        return idx, dist
+
+    def knnSearch(self, query_descriptors, knn, params=None):
+        """
+        Finds the knn database descriptors closest to each query descriptor.
+
+        Args:
+            query_descriptors (numpy.ndarray): The (M, D) query descriptors, of the same dtype as the database.
+            knn (int): The number of neighbours per query.
+            params (dict, optional): Ignored; accepted for compatibility with cv2.flann.Index.
+
+        Returns:
+            tuple: The int32 (M, knn) row indices and the float32 (M, knn) Hamming or squared L2 distances, closest
+                   first, like FLANN. Missing neighbours of a database smaller than knn have index -1.
+        """
+        best_idx = np.full((len(query_descriptors), knn), -1, dtype=np.int64)
+        best_dist = np.full((len(query_descriptors), knn), np.inf, dtype=np.float32)
+        for start in range(0, len(self.descriptors), self.block_rows):
+            block = np.ascontiguousarray(self.descriptors[start:start + self.block_rows])
+            idx, dist = self.search_block(query_descriptors, block, knn)
+            idx = np.where(idx < 0, -1, idx + start)
+
+            # Merge the neighbours of this block with the best found so far
+            idx, dist = np.hstack([best_idx, idx]), np.hstack([best_dist, dist])
+            order = np.argsort(dist, axis=1, kind='stable')[:, :knn]
+            best_idx, best_dist = np.take_along_axis(idx, order, axis=1), np.take_along_axis(dist, order, axis=1)
+        return best_idx.astype(np.int32), best_dist
+
+def index_paths(db_name):
+    """
+    Returns where the FLANN index and its metadata are stored for a descriptor database.
+
+    Args:
+        db_name (str): The path of the `*.db` file or columnar store directory.
+
+    Returns:
+        tuple: The paths of the index file and of its JSON metadata file.
+    """
+    if is_npy_store(db_name):
+        base = os.path.join(db_name, 'index')
+    else:
+        base = db_name
+    return base + '.flann', base + '.flann.json'
+
+def descriptor_checksum(descriptors, block_rows=65536):
+    """
+    Computes a SHA-1 checksum of a descriptor matrix, reading it block by block so memory-mapped stores are not
+    loaded in one piece.
+
+    Args:
+        descriptors (numpy.ndarray): The (N, D) descriptor matrix.
+        block_rows (int, optional): The number of rows hashed at a time. Defaults to 65536.
+
+    Returns:
+        str: The hex digest.
+    """
+    sha = hashlib.sha1()
+    for start in range(0, len(descriptors), block_rows):
+        sha.update(np.ascontiguousarray(descriptors[start:start + block_rows]).tobytes())
+    return sha.hexdigest()
+
+def index_data(descriptors):
+    """
+    Converts descriptors to the contiguous array FLANN expects: packed uint8 bytes for binary descriptors and
+    float32 for every other type.
+
+    Args:
+        descriptors (numpy.ndarray): The (N, D) descriptor matrix.
+
+    Returns:
+        numpy.ndarray: The contiguous descriptor matrix.
+    """
+    return np.ascontiguousarray(descriptors, dtype=np.uint8 if is_binary(descriptors) else np.float32)
+
+def build_index(descriptors, binary_index='lsh'):
+    """
+    Builds a FLANN KD-tree index over float descriptors, or a Hamming index over binary descriptors.
+
+    Args:
+        descriptors (numpy.ndarray): The (N, D) descriptor matrix.
+        binary_index (str, optional): The index used for binary descriptors: 'lsh' for a FLANN LSH index or 'bf'
+                                      for an exact BruteForceIndex. Defaults to 'lsh'.
+
+    Returns:
+        cv2.flann.Index or BruteForceIndex: The index.
+    """
+    if is_binary(descriptors):
+        if binary_index == 'bf':
+            return BruteForceIndex(descriptors)
+        return cv2.flann.Index(index_data(descriptors), LSH_INDEX_PARAMS)
+    return cv2.flann.Index(index_data(descriptors), INDEX_PARAMS)
+
+def save_index(db_name, descriptors):
+    """
+    Builds a FLANN index for a descriptor database and saves it next to the database together with the row count
+    and checksum of the descriptors it was trained on.
+
+    Args:
+        db_name (str): The path of the `*.db` file or columnar store directory.
+        descriptors (numpy.ndarray): The descriptor matrix of the database.
+
+    Returns:
+        cv2.flann.Index: The index that was saved.
+    """
+    # OpenCV cannot search an LSH index read back from disk, and building one takes well under a second, so the
+    # index of binary descriptors is only ever built in memory
+    if is_binary(descriptors):
+        return build_index(descriptors)
+
+    index_file, meta_file = index_paths(db_name)
+    index = build_index(descriptors)
+    index.save(index_file)
+
+    with open(meta_file, 'w') as f:
+        json.dump({
+            'rows': int(descriptors.shape[0]),
+            'dim': int(descriptors.shape[1]),
+            'checksum': descriptor_checksum(descriptors),
+            'index_params': INDEX_PARAMS,
+        }, f, indent=4)
+
+    return index
+
+def load_index(db_name, descriptors, verify_checksum=False):
+    """
+    Loads the saved FLANN index of a descriptor database if it is in sync with the descriptors.
+
+    The row count and descriptor length are always checked. The full checksum costs a pass over the whole
+    database, so it is only compared when verify_checksum is set.
+
+    Args:
+        db_name (str): The path of the `*.db` file or columnar store directory.
+        descriptors (numpy.ndarray): The descriptor matrix the index will search. It must stay alive as long as
+                                     the index, since FLANN keeps a pointer to it rather than a copy.
+        verify_checksum (bool, optional): Whether to compare the descriptor checksum. Defaults to False.
+
+    Returns:
+        cv2.flann.Index: The loaded index, or None if there is no index or it does not match the database.
+    """
+    index_file, meta_file = index_paths(db_name)
+    if not (os.path.exists(index_file) and os.path.exists(meta_file)):
+        return None
+
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+
+    if meta['rows'] != descriptors.shape[0] or meta['dim'] != descriptors.shape[1]:
+        print(f"FLANN index {index_file} was built for {meta['rows']} rows but the database has {descriptors.shape[0]}; ignoring it.")
+        return None
+    if verify_checksum and meta['checksum'] != descriptor_checksum(descriptors):
+        print(f"FLANN index {index_file} does not match the database checksum; ignoring it.")
+        return None
+
+    index = cv2.flann.Index()
+    if not index.load(index_data(descriptors), index_file):
+        return None
+    return index
+
+def get_index(db_name, descriptors, verify_checksum=False, rerank=0, binary_index='lsh'):
+    """
+    Loads the saved FLANN index of a descriptor database, or builds one in memory if none is usable.
+
+    A quantized columnar store is searched through its compressed codes instead of a FLANN index, and binary
+    descriptors through an index built in memory.
+
+    Args:
+        db_name (str): The path of the `*.db` file or columnar store directory.
+        descriptors (numpy.ndarray): The descriptor matrix of the database, or None if a quantized store dropped it.
+        verify_checksum (bool, optional): Whether to compare the descriptor checksum. Defaults to False.
+        rerank (int, optional): The number of quantized candidates per query re-ranked with the full descriptors.
+                                Defaults to 0.
+        binary_index (str, optional): The index used for binary descriptors, see build_index. Defaults to 'lsh'.
+
+    Returns:
+        cv2.flann.Index, QuantizedIndex or BruteForceIndex: The index.
+    """
+    if has_quantizer(db_name):
+        return QuantizedIndex(db_name, descriptors, rerank)
+    if is_binary(descriptors):
+        return build_index(descriptors, binary_index)
+
+    index = load_index(db_name, descriptors, verify_checksum)
+    if index is None:
+        index = build_index(descriptors)
+    return index
+
+def knn_search(index, query_descriptors, k=2):
+    """
+    Finds the k nearest database descriptors of each query descriptor.
+
+    Args:
+        index (cv2.flann.Index, QuantizedIndex or BruteForceIndex): The index to search.
+        query_descriptors (numpy.ndarray): The (M, D) query descriptors.
+        k (int, optional): The number of neighbours per query. Defaults to 2.
+
+    Returns:
+        tuple: An int (M, k) array of database row indices and a float32 (M, k) array of L2 distances, or of
+               Hamming distances for binary descriptors. Neighbours an LSH index could not find point at row 0 with
+               an infinite distance.
+    """
+    if len(query_descriptors) == 0:
+        return np.empty((0, k), dtype=np.int32), np.empty((0, k), dtype=np.float32)
+
+    # Check more leaves when many neighbours are requested so they are not all taken from the first few
+    search_params = dict(SEARCH_PARAMS, checks=max(SEARCH_PARAMS['checks'], 4 * k))
+    indices, dists = index.knnSearch(index_data(query_descriptors), k, params=search_params)
+    if is_binary(query_descriptors):
+        missing = indices < 0
+        dists = np.where(missing, np.inf, dists).astype(np.float32)
+        return np.where(missing, 0, indices), dists
+    # FLANN reports squared L2 distances for KD-trees, and QuantizedIndex and BruteForceIndex follow suit
+    return indices, np.sqrt(dists)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and save the FLANN index of a descriptor database.')
+    parser.add_argument('--db_name', type=str, required=True, help='Path to the *.db file or columnar store directory.')
+
+    args = parser.parse_args()
+
+    db_descriptors, _ = load_descriptor_store(args.db_name)
+    save_index(args.db_name, db_descriptors)
@@ -0,0 +1,223 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+class Span:
+    def __init__(self, name, count=0):
+        """
+        One timed stage: the wall and CPU time between __enter__ and __exit__ plus the number of items it handled.
+
+        Args:
+            name (str): The stage name the time is reported under.
+            count (int, optional): The number of items handled, which can also be set inside the block.
+                                   Defaults to 0.
+
+        Returns:
+            None
+        """
+        self.name = name
+        self.count = count
+        self.wall_ms = 0.0
+        self.cpu_ms = 0.0
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_ms = (time.perf_counter() - self.wall_start) * 1000
+        self.cpu_ms = (time.process_time() - self.cpu_start) * 1000
+        _RECORDER.add(self)
+        return False
+
+class SpanRecorder:
+    def __init__(self):
+        """
+        Accumulates the spans of a run by name. Spans may finish on several threads, such as the database writer.
+
+        Returns:
+            None
+        """
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def add(self, span):
+        """
+        Adds a finished span to the totals of its name.
+
+        Args:
+            span (Span): The finished span.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            totals = self.spans.setdefault(span.name, {'calls': 0, 'wall_ms': 0.0, 'cpu_ms': 0.0, 'count': 0})
+            totals['calls'] += 1
+            totals['wall_ms'] += span.wall_ms
+            totals['cpu_ms'] += span.cpu_ms
+            totals['count'] += int(span.count)
+
+    def reset(self):
+        """
+        Forgets every span and restarts the run clocks.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.spans = {}
+            self.wall_start = time.perf_counter()
+            self.cpu_start = time.process_time()
+
+# Spans of the current process, reported by timing_report
+_RECORDER = SpanRecorder()
+
+def span(name, count=0):
+    """
+    Times a stage of the pipeline as a context manager. The Span is returned so the caller can read its times
+    after the block or set its count inside it.
+
+    Args:
+        name (str): The stage name the time is reported under.
+        count (int, optional): The number of items handled. Defaults to 0.
+
+    Returns:
+        Span: The span.
+    """
+    return Span(name, count)
+
+def reset_timing():
+    """
+    Starts a new timing report, for processes that time several runs one after the other such as benchmark.py.
+
+    Returns:
+        None
+    """
+    _RECORDER.reset()
+
+def timed_batches(batches, name):
+    """
+    Times a lazy producer of batches, such as an extraction generator, by the time spent producing each batch.
+
+    Args:
+        batches (iterable): Iterable of lists.
+        name (str): The stage name the time is reported under. The count is the total length of the batches.
+
+    Yields:
+        list: The batches, unchanged.
+    """
+    iterator = iter(batches)
+    while True:
+        with span(name) as s:
+            batch = next(iterator, None)
+            s.count = len(batch) if batch is not None else 0
+        if batch is None:
+            return
+        yield batch
+
+def timed_call(function, name):
+    """
+    Wraps a function that returns the number of items it handled, such as a database insert, in a span.
+
+    Args:
+        function (callable): The function to wrap.
+        name (str): The stage name the time is reported under.
+
+    Returns:
+        callable: The wrapped function.
+    """
+    def wrapper(*args, **kwargs):
+        with span(name) as s:
+            s.count = function(*args, **kwargs)
+        return s.count
+    return wrapper
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process and of its finished child processes.
+
+    Returns:
+        tuple: The peak RSS of the process and the largest peak RSS among its children, in megabytes.
+    """
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20
+    return own, children
+
+def timing_report():
+    """
+    Summarizes the run so far: total wall and CPU time, peak memory, and the calls, time and item counts of every
+    span name. CPU times are process-wide, so spans that overlap on different threads both include the CPU time of
+    the other; the time of worker processes is only in children_cpu_ms.
+
+    Returns:
+        dict: The report.
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    own_rss, children_rss = peak_rss_mb()
+    with _RECORDER.lock:
+        spans = {name: dict(totals) for name, totals in _RECORDER.spans.items()}
+    return {
+        'command': sys.argv,
+        'wall_ms': (time.perf_counter() - _RECORDER.wall_start) * 1000,
+        'cpu_ms': (time.process_time() - _RECORDER.cpu_start) * 1000,
+        'children_cpu_ms': (children.ru_utime + children.ru_stime) * 1000,
+        'peak_rss_mb': own_rss,
+        'children_peak_rss_mb': children_rss,
+        'spans': spans,
+    }
+
+def write_timing_report(report_path):
+    """
+    Writes timing_report as JSON.
+
+    Args:
+        report_path (str): The path of the JSON file.
+
+    Returns:
+        dict: The report that was written.
+    """
+    report = timing_report()
+    directory = os.path.dirname(report_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+@contextmanager
+def profiled(profile_path=None):
+    """
+    Runs the block under cProfile and dumps the stats to profile_path, for `python -m pstats` or snakeviz. Does
+    nothing when profile_path is None.
+
+    Args:
+        profile_path (str, optional): The path of the stats file. Defaults to None.
+
+    Yields:
+        None
+    """
+    if profile_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        directory = os.path.dirname(profile_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(profile_path)
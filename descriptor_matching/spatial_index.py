@@ -0,0 +1,201 @@
+import numpy as np
+import math
+from functools import lru_cache
+from flann_index import BruteForceIndex, build_index, index_data, knn_search
+
+# Side of the square tiles the window centers are bucketed into, in train image pixels
+ROI_TILE_SIZE = 512
+
+# Up to this many rows an exhaustive search of the region costs about as much as one FLANN search, whose cost is
+# set by its number of checks rather than by the number of rows
+ROI_EXACT_ROWS = 4096
+
+# Neighbours fetched from the index of the tiles covering a larger region per neighbour kept inside its circle
+ROI_OVERFETCH = 2
+
+# Meters per degree of latitude, and of longitude at the equator
+METERS_PER_DEGREE = 111320.0
+
+def geo_to_pixels(latitude, longitude, radius_m, train_bounds, image_shape):
+    """
+    Converts a prior position given in latitude and longitude, with a radius in meters, into train image pixels.
+
+    The train image is assumed to be north-up with its latitude and longitude varying linearly between its
+    corners, which holds for the map tiles it is made of over the extent of a flight.
+
+    Args:
+        latitude (float): The latitude of the prior center.
+        longitude (float): The longitude of the prior center.
+        radius_m (float): The radius of the prior in meters.
+        train_bounds (tuple): The (top_left_lat, top_left_lon, bottom_right_lat, bottom_right_lon) of the train image.
+        image_shape (tuple): The shape of the train image.
+
+    Returns:
+        tuple: The (center_y, center_x, radius) of the prior in pixels.
+    """
+    top_left_lat, top_left_lon, bottom_right_lat, bottom_right_lon = train_bounds
+    height, width = image_shape[:2]
+    center_y = (latitude - top_left_lat) / (bottom_right_lat - top_left_lat) * height
+    center_x = (longitude - top_left_lon) / (bottom_right_lon - top_left_lon) * width
+
+    # Average the ground resolution of both axes, which differ slightly away from the equator
+    meters_per_pixel_y = abs(bottom_right_lat - top_left_lat) * METERS_PER_DEGREE / height
+    meters_per_pixel_x = abs(bottom_right_lon - top_left_lon) * METERS_PER_DEGREE * math.cos(math.radians(latitude)) / width
+    return center_y, center_x, radius_m / ((meters_per_pixel_y + meters_per_pixel_x) / 2)
+
+class SpatialIndex:
+    def __init__(self, db_coords, db_descriptors, tile_size=ROI_TILE_SIZE, exact_rows=ROI_EXACT_ROWS, binary_index='lsh', cache_size=8):
+        """
+        Buckets the database rows by the tile holding the center of their window, so that the rows inside a region
+        of interest are found without scanning the whole database, and searches only those rows.
+
+        The rows are sorted by tile once, so the rows of each tile are a contiguous slice found with two binary
+        searches and a circle only tests the rows of the tiles it overlaps. Regions too large to search
+        exhaustively get a FLANN sub-index over the rows of their tiles, kept in an LRU cache of cache_size tile
+        sets, so consecutive frames of a flight whose prior stays over the same tiles reuse it.
+
+        Args:
+            db_coords (numpy.ndarray): The (N, 6) window coordinates of every row, starting with center_y, center_x.
+            db_descriptors (numpy.ndarray): The (N, D) descriptors of every row.
+            tile_size (int, optional): The side of each tile in pixels. Defaults to ROI_TILE_SIZE.
+            exact_rows (int, optional): The largest region searched exhaustively. Defaults to ROI_EXACT_ROWS.
+            binary_index (str, optional): The sub-index used for binary descriptors, see flann_index.build_index.
+                                          Defaults to 'lsh'.
+            cache_size (int, optional): The number of tile set sub-indexes kept. Defaults to 8.
+
+        Returns:
+            None
+        """
+        if db_descriptors is None:
+            raise ValueError("A region of interest search needs the full descriptors, which this quantized store dropped")
+
+        self.db_descriptors = db_descriptors
+        self.tile_size = tile_size
+        self.exact_rows = exact_rows
+        self.binary_index = binary_index
+        self.centers = np.asarray(db_coords[:, :2], dtype=np.int64)
+
+        tiles = self.centers // tile_size
+        self.n_tile_cols = int(tiles[:, 1].max()) + 1 if len(tiles) else 0
+        keys = tiles[:, 0] * self.n_tile_cols + tiles[:, 1]
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+        self.sub_index = lru_cache(maxsize=cache_size)(self.build_sub_index)
+
+    def tile_rows(self, tile_row, tile_col):
+        """
+        Returns the database rows whose window center lies in a tile.
+
+        Args:
+            tile_row (int): The row of the tile.
+            tile_col (int): The column of the tile.
+
+        Returns:
+            numpy.ndarray: The row indices, in database order.
+        """
+        key = tile_row * self.n_tile_cols + tile_col
+        start, end = np.searchsorted(self.sorted_keys, [key, key + 1])
+        return self.order[start:end]
+
+    def inside(self, rows, center_y, center_x, radius):
+        """
+        Checks which rows have their window center within a circle.
+
+        Args:
+            rows (numpy.ndarray): The row indices.
+            center_y (float): The row of the circle center in pixels.
+            center_x (float): The column of the circle center in pixels.
+            radius (float): The radius of the circle in pixels.
+
+        Returns:
+            numpy.ndarray: A boolean array of the same shape as rows.
+        """
+        return (self.centers[rows, 0] - center_y) ** 2 + (self.centers[rows, 1] - center_x) ** 2 <= radius ** 2
+
+    def tiles_within(self, center_y, center_x, radius):
+        """
+        Lists the tiles overlapping the bounding box of a circle.
+
+        Args:
+            center_y (float): The row of the circle center in pixels.
+            center_x (float): The column of the circle center in pixels.
+            radius (float): The radius of the circle in pixels.
+
+        Returns:
+            tuple: The (tile_row, tile_col) of every tile.
+        """
+        size = self.tile_size
+        return tuple((tile_row, tile_col)
+                     for tile_row in range(max(int((center_y - radius) // size), 0), int((center_y + radius) // size) + 1)
+                     for tile_col in range(max(int((center_x - radius) // size), 0), min(int((center_x + radius) // size), self.n_tile_cols - 1) + 1))
+
+    def rows_within(self, center_y, center_x, radius):
+        """
+        Returns the database rows whose window center lies within a circle.
+
+        Args:
+            center_y (float): The row of the circle center in pixels.
+            center_x (float): The column of the circle center in pixels.
+            radius (float): The radius of the circle in pixels.
+
+        Returns:
+            numpy.ndarray: The sorted row indices.
+        """
+        rows = np.sort(np.concatenate([self.order[:0]] + [self.tile_rows(*tile) for tile in self.tiles_within(center_y, center_x, radius)]))
+        return rows[self.inside(rows, center_y, center_x, radius)]
+
+    def build_sub_index(self, tiles):
+        """
+        Builds the FLANN index of the rows of a set of tiles. Called through the self.sub_index cache.
+
+        Args:
+            tiles (tuple): The (tile_row, tile_col) of every tile.
+
+        Returns:
+            tuple: The row indices, their contiguous descriptors, which must outlive the index, and the index.
+        """
+        rows = np.sort(np.concatenate([self.order[:0]] + [self.tile_rows(*tile) for tile in tiles]))
+        descriptors = index_data(self.db_descriptors[rows])
+        return rows, descriptors, build_index(descriptors, self.binary_index)
+
+    def search(self, query_descriptors, k, center_y, center_x, radius):
+        """
+        Finds the k nearest descriptors of each query descriptor among the rows whose window center lies within a
+        circle.
+
+        A region of up to exact_rows rows is searched exhaustively, so its cost follows its area and its neighbours
+        are exact. A larger region fetches ROI_OVERFETCH times more neighbours from the sub-index of the tiles
+        covering it and keeps those inside the circle; queries left with fewer than k get infinite distances.
+
+        Args:
+            query_descriptors (numpy.ndarray): The (M, D) query descriptors.
+            k (int): The number of neighbours per query.
+            center_y (float): The row of the circle center in pixels.
+            center_x (float): The column of the circle center in pixels.
+            radius (float): The radius of the circle in pixels.
+
+        Returns:
+            tuple: The (M, k) database row indices and distances, as returned by knn_search. Both have no rows when
+                   the circle holds no database rows.
+        """
+        rows = self.rows_within(center_y, center_x, radius)
+        if len(rows) == 0:
+            return np.empty((0, k), dtype=np.int64), np.empty((0, k), dtype=np.float32)
+
+        if len(rows) <= self.exact_rows:
+            indices, distances = knn_search(BruteForceIndex(index_data(self.db_descriptors[rows])), query_descriptors, k)
+        else:
+            rows, _, index = self.sub_index(self.tiles_within(center_y, center_x, radius))
+            indices, distances = knn_search(index, query_descriptors, min(k * ROI_OVERFETCH, len(rows)))
+
+        # Neighbours that are missing, or outside the circle in a tile cut by it, are pushed to the back
+        missing = (indices < 0) | (distances == np.inf)
+        indices = rows[np.maximum(indices, 0)]
+        distances = np.where(missing | ~self.inside(indices, center_y, center_x, radius), np.inf, distances).astype(np.float32)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        indices, distances = np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+        if indices.shape[1] < k:
+            pad = k - indices.shape[1]
+            indices = np.hstack([indices, np.zeros((len(indices), pad), dtype=indices.dtype)])
+            distances = np.hstack([distances, np.full((len(distances), pad), np.inf, dtype=np.float32)])
+        return np.where(distances == np.inf, 0, indices), distances
@@ -0,0 +1,131 @@
+import numpy as np
+
+def grid_shape(image_shape, subregion_size, step):
+    """
+    Computes the number of subregion rows and columns that sample_locations generates for an image.
+
+    Args:
+        image_shape (tuple): The shape of the image.
+        subregion_size (int): The size of each subregion.
+        step (int): The step size between subregions.
+
+    Returns:
+        tuple: The number of subregion rows and columns (n_rows, n_cols).
+    """
+    height, width = image_shape[:2]
+    n_rows = len(range(0, height - subregion_size + 1, step))
+    n_cols = len(range(0, width - subregion_size + 1, step))
+    return n_rows, n_cols
+
+def window_coords(rows, cols, subregion_size, step):
+    """
+    Converts subregion grid indices into the coordinate layout used by sample_locations.
+
+    Args:
+        rows (numpy.ndarray): The grid row index of each subregion.
+        cols (numpy.ndarray): The grid column index of each subregion.
+        subregion_size (int): The size of each subregion.
+        step (int): The step size between subregions.
+
+    Returns:
+        numpy.ndarray: An (N, 6) array of (center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x).
+    """
+    top_left_y = np.asarray(rows, dtype=np.int64) * step
+    top_left_x = np.asarray(cols, dtype=np.int64) * step
+    half_subregion = subregion_size // 2
+    return np.stack([
+        top_left_y + half_subregion,
+        top_left_x + half_subregion,
+        top_left_y,
+        top_left_x,
+        top_left_y + subregion_size - 1,
+        top_left_x + subregion_size - 1,
+    ], axis=1)
+
+def windows_containing(points, image_shape, subregion_size, step):
+    """
+    Finds every subregion of the sampling grid that contains each of the given pixel positions.
+
+    The grid produced by sample_locations is regular, so the lookup is done arithmetically: a pixel at row y lies
+    in the subregion rows whose top edge is in [y - subregion_size + 1, y], and likewise for columns.
+
+    Args:
+        points (numpy.ndarray): An (N, 2) integer array of (x, y) pixel positions.
+        image_shape (tuple): The shape of the image the grid was sampled from.
+        subregion_size (int): The size of each subregion.
+        step (int): The step size between subregions.
+
+    Returns:
+        tuple: Three arrays (point_idx, rows, cols) with one entry per (point, subregion) pair.
+    """
+    n_rows, n_cols = grid_shape(image_shape, subregion_size, step)
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    x, y = points[:, 0], points[:, 1]
+
+    # Ceiling division keeps the first subregion whose top edge is at or after y - subregion_size + 1
+    row_lo = -(-np.maximum(y - subregion_size + 1, 0) // step)
+    row_hi = np.minimum(y // step, n_rows - 1)
+    col_lo = -(-np.maximum(x - subregion_size + 1, 0) // step)
+    col_hi = np.minimum(x // step, n_cols - 1)
+
+    n_r = np.maximum(row_hi - row_lo + 1, 0)
+    n_c = np.maximum(col_hi - col_lo + 1, 0)
+    counts = n_r * n_c
+
+    point_idx = np.repeat(np.arange(len(points)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = row_lo[point_idx] + offsets // n_c[point_idx]
+    cols = col_lo[point_idx] + offsets % n_c[point_idx]
+
+    return point_idx, rows, cols
+
+def level_shape(image_shape, scale):
+    """
+    Computes the size of an image pyramid level.
+
+    Args:
+        image_shape (tuple): The shape of the full resolution image.
+        scale (float): The scale of the level.
+
+    Returns:
+        tuple: The (height, width) of the level.
+    """
+    return int(round(image_shape[0] * scale)), int(round(image_shape[1] * scale))
+
+def nearest_windows(points, image_shape, subregion_size, step):
+    """
+    Picks, for each pixel position, the subregion of the sampling grid whose center is closest to it among the
+    subregions containing it.
+
+    This is the window a deduplicated keypoint is reported in, so every keypoint maps to exactly one database
+    match instead of one per overlapping subregion.
+
+    Args:
+        points (numpy.ndarray): An (N, 2) array of (x, y) pixel positions, each inside at least one subregion.
+        image_shape (tuple): The shape of the image the grid was sampled from.
+        subregion_size (int): The size of each subregion.
+        step (int): The step size between subregions.
+
+    Returns:
+        numpy.ndarray: An (N, 6) array of (center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x).
+    """
+    n_rows, n_cols = grid_shape(image_shape, subregion_size, step)
+    points = np.rint(np.asarray(points, dtype=np.float64).reshape(-1, 2)).astype(np.int64)
+    half_subregion = subregion_size // 2
+
+    # Positions scaled back from a pyramid level can round one pixel past the last subregion, so they are clamped
+    # into the pixels the grid covers first
+    x = np.clip(points[:, 0], 0, max((n_cols - 1) * step + subregion_size - 1, 0))
+    y = np.clip(points[:, 1], 0, max((n_rows - 1) * step + subregion_size - 1, 0))
+
+    # The bounds of the subregions containing each position, as in windows_containing. np.clip silently returns
+    # the upper bound when the lower one exceeds it, so that case is made explicit: it only happens for a position
+    # between two subregions of a grid whose step exceeds the subregion size, which keeps the one before it
+    row_hi = np.minimum(y // step, n_rows - 1)
+    col_hi = np.minimum(x // step, n_cols - 1)
+    row_lo = np.minimum(-(-np.maximum(y - subregion_size + 1, 0) // step), row_hi)
+    col_lo = np.minimum(-(-np.maximum(x - subregion_size + 1, 0) // step), col_hi)
+
+    rows = np.clip(np.rint((y - half_subregion) / step).astype(np.int64), row_lo, row_hi)
+    cols = np.clip(np.rint((x - half_subregion) / step).astype(np.int64), col_lo, col_hi)
+    return window_coords(rows, cols, subregion_size, step)
@@ -0,0 +1,190 @@
+import cv2
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from feature_types import get_extractor, is_binary
+
+def load_train_image(train_file_path):
+    """
+    Loads the train image once for verification. A `.npy` copy of the image is memory-mapped, so only the pixels of
+    the verified subregions are ever read; any other format is decoded with OpenCV.
+
+    Args:
+        train_file_path (str): The path of the train image, or of a `.npy` array holding it.
+
+    Returns:
+        numpy.ndarray: The train image.
+    """
+    if train_file_path.endswith('.npy'):
+        return np.load(train_file_path, mmap_mode='r')
+    return cv2.imread(train_file_path)
+
+def match_descriptors(query_descriptors, train_descriptors, ratio=0.75):
+    """
+    Matches two small sets of descriptors exhaustively, by Hamming distance for binary descriptors and L2 distance
+    otherwise, and keeps the matches passing the Lowe ratio test.
+
+    Args:
+        query_descriptors (numpy.ndarray): The (M, D) query descriptors.
+        train_descriptors (numpy.ndarray): The (K, D) train descriptors.
+        ratio (float, optional): The ratio test threshold. Defaults to 0.75.
+
+    Returns:
+        list: The good cv2.DMatch objects.
+    """
+    if len(query_descriptors) == 0 or len(train_descriptors) < 2:
+        return []
+
+    binary = is_binary(query_descriptors)
+    dtype = np.uint8 if binary else np.float32
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING if binary else cv2.NORM_L2)
+    matches = matcher.knnMatch(np.ascontiguousarray(query_descriptors, dtype=dtype), np.ascontiguousarray(train_descriptors, dtype=dtype), k=2)
+    return [pair[0] for pair in matches if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance]
+
+def ratio_matches(query_descriptors, train_descriptors, ratio=0.75):
+    """
+    Runs match_descriptors and returns the matched rows as arrays.
+
+    Args:
+        query_descriptors (numpy.ndarray): The (M, D) query descriptors.
+        train_descriptors (numpy.ndarray): The (K, D) train descriptors.
+        ratio (float, optional): The ratio test threshold. Defaults to 0.75.
+
+    Returns:
+        tuple: The query and train row indices of the good matches.
+    """
+    good_matches = match_descriptors(query_descriptors, train_descriptors, ratio)
+    return np.array([m.queryIdx for m in good_matches], dtype=np.int64), np.array([m.trainIdx for m in good_matches], dtype=np.int64)
+
+def count_inliers(query_points, train_points, reprojection_threshold=5.0):
+    """
+    Fits a homography between matched points with RANSAC and counts the matches consistent with it.
+
+    Args:
+        query_points (numpy.ndarray): The (n, 2) x, y positions of the matches in the query.
+        train_points (numpy.ndarray): The (n, 2) x, y positions of the same matches in the train image.
+        reprojection_threshold (float, optional): The RANSAC reprojection error in train pixels. Defaults to 5.0.
+
+    Returns:
+        int: The number of inliers, 0 when fewer than 4 matches are given or no homography is found.
+    """
+    if len(query_points) < 4:
+        return 0
+    _, inlier_mask = cv2.findHomography(np.float32(query_points), np.float32(train_points), cv2.RANSAC, reprojection_threshold)
+    return 0 if inlier_mask is None else int(inlier_mask.sum())
+
+class SubregionVerifier:
+    def __init__(self, train_image, cache_size=256, workers=None, ratio=0.75, feature_type='sift'):
+        """
+        Verifies candidate subregions by matching the query descriptors against features extracted from the
+        subregion.
+
+        Extraction runs on each subregion at most once while it stays in an LRU cache of cache_size subregions, so
+        candidates repeated across frames of a sequence are nearly free, and the candidates of one query are
+        verified in parallel threads (OpenCV releases the GIL).
+
+        Args:
+            train_image (numpy.ndarray): The train image, for example from load_train_image.
+            cache_size (int, optional): The number of subregions whose features are kept. Defaults to 256.
+            workers (int, optional): The number of verification threads. Defaults to the CPU count.
+            ratio (float, optional): The Lowe ratio test threshold. Defaults to 0.75.
+            feature_type (str, optional): The feature type of the query descriptors. Defaults to 'sift'.
+
+        Returns:
+            None
+        """
+        self.train_image = train_image
+        self.ratio = ratio
+        self.feature_type = feature_type
+        self.executor = ThreadPoolExecutor(workers or os.cpu_count())
+        self.features = lru_cache(maxsize=cache_size)(self.compute_features)
+
+    def subregion(self, coords):
+        """
+        Crops a subregion out of the train image, clipped to the image, in the same way as extract_subregion.
+
+        Args:
+            coords (tuple): The (center_y, center_x, top_left_y, top_left_x, bottom_right_y, bottom_right_x)
+                            coordinates of the subregion.
+
+        Returns:
+            numpy.ndarray: The subregion.
+        """
+        height, width = self.train_image.shape[:2]
+        top_left_y, top_left_x, bottom_right_y, bottom_right_x = coords[2:]
+        top_left_y, bottom_right_y = (max(0, min(v, height - 1)) for v in (top_left_y, bottom_right_y))
+        top_left_x, bottom_right_x = (max(0, min(v, width - 1)) for v in (top_left_x, bottom_right_x))
+        return np.asarray(self.train_image[top_left_y:bottom_right_y, top_left_x:bottom_right_x])
+
+    def compute_features(self, coords):
+        """
+        Extracts the features of a subregion. Called through the self.features cache.
+
+        Args:
+            coords (tuple): The coordinates of the subregion.
+
+        Returns:
+            tuple: The keypoints and the (K, D) descriptors of the subregion.
+        """
+        subregion = self.subregion(coords)
+        if subregion.ndim == 3:
+            subregion = cv2.cvtColor(subregion, cv2.COLOR_BGR2GRAY)
+        # Each verification thread gets its own cached extractor
+        return get_extractor(self.feature_type).detect_and_compute(subregion)
+
+    def verify_one(self, query_descriptors, coords):
+        """
+        Matches the query descriptors against one subregion and keeps the matches passing the ratio test.
+
+        Args:
+            query_descriptors (numpy.ndarray): The (M, D) query descriptors.
+            coords (tuple): The coordinates of the subregion.
+
+        Returns:
+            tuple: The subregion keypoints and the list of good cv2.DMatch objects.
+        """
+        keypoints, descriptors = self.features(tuple(int(v) for v in coords))
+        return keypoints, match_descriptors(query_descriptors, descriptors, self.ratio)
+
+    def verify(self, query_descriptors, coords_list):
+        """
+        Verifies several candidate subregions of one query in parallel.
+
+        Args:
+            query_descriptors (numpy.ndarray): The (M, D) query descriptors.
+            coords_list (list): The coordinates of each candidate subregion.
+
+        Returns:
+            list: One (subregion keypoints, good matches) tuple per candidate, in order.
+        """
+        return list(self.executor.map(lambda coords: self.verify_one(query_descriptors, coords), coords_list))
+
+    def draw(self, query_image, query_keypoints, coords, verification, output_path):
+        """
+        Saves the good matches between a query and a subregion side by side, with the subregion resized to the size
+        of the query.
+
+        Args:
+            query_image (numpy.ndarray): The color query image.
+            query_keypoints (list): The keypoints of the query descriptors.
+            coords (tuple): The coordinates of the subregion.
+            verification (tuple): The (subregion keypoints, good matches) returned by verify for the subregion.
+            output_path (str): The path of the image to save.
+
+        Returns:
+            None
+        """
+        keypoints, good_matches = verification
+        subregion = self.subregion(coords)
+
+        # Compute scale factors
+        scale_x = query_image.shape[1] / subregion.shape[1]
+        scale_y = query_image.shape[0] / subregion.shape[0]
+
+        # Resize subregion and adjust its keypoints to match
+        resized_subregion = cv2.resize(subregion, (query_image.shape[1], query_image.shape[0]))
+        adjusted_keypoints = [cv2.KeyPoint(kp.pt[0] * scale_x, kp.pt[1] * scale_y, kp.size * scale_x) for kp in keypoints]
+
+        img_matches = cv2.drawMatches(query_image, query_keypoints, resized_subregion, adjusted_keypoints, good_matches, None, flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
+        cv2.imwrite(output_path, img_matches)
@@ -1,11 +1,19 @@
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
+import scipy.fft
 from scipy.ndimage import maximum_filter
 import argparse
 import os
+import threading
+from functools import lru_cache
 
+# Side of the resampled images whose log-polar spectra are compared, which sets the rotation resolution to
+# 360 / LOG_POLAR_SIZE degrees and the scale resolution to a factor of LOG_POLAR_SIZE / 2 per LOG_POLAR_SIZE columns
+LOG_POLAR_SIZE = 256
 
+# Step between the source windows compared with a template, as a fraction of the window side
+LOG_POLAR_WINDOW_STEP = 0.25
 
 def random_crop(image, crop_height, crop_width):
     """
@@ -91,31 +99,389 @@ def rotate_and_crop_template(template_img, rotation_angle, scale_factor):
 
     return cropped_img, centroid
 
+def template_stack(template_img, rotation_angles, scale_factor):
+    """
+    Resamples a template at several rotations for one scale in a single cv2.remap call, by stacking the sampling
+    grids of every rotation along the rows.
+
+    Each patch is the largest square around the template center that stays inside the template at any rotation,
+    resampled so that one patch pixel covers one source pixel, so every patch of a scale has the same size.
+
+    Args:
+        template_img (numpy.ndarray): The grayscale float32 template image.
+        rotation_angles (list): The rotations in degrees of the template relative to the source, counterclockwise as
+                                in cv2.getRotationMatrix2D.
+        scale_factor (float): The number of template pixels per source pixel.
+
+    Returns:
+        numpy.ndarray: The (len(rotation_angles), side, side) patches, which have no rows when the template is too
+                       small for the scale.
+    """
+    h, w = template_img.shape[:2]
+    side = int(min(h, w) / (np.sqrt(2) * scale_factor))
+    if side < 1 or len(rotation_angles) == 0:
+        return np.empty((0, max(side, 0), max(side, 0)), dtype=np.float32)
+
+    # Offsets of the patch pixels from the patch center, in source pixels
+    offsets = np.arange(side, dtype=np.float32) - (side - 1) / 2
+    dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+
+    # A source offset lands on the template rotated by the angle, as in cv2.getRotationMatrix2D, and scaled
+    radians = np.deg2rad(np.asarray(rotation_angles, dtype=np.float32))[:, None, None]
+    cos, sin = np.cos(radians) * scale_factor, np.sin(radians) * scale_factor
+    map_x = (cos * dx + sin * dy + (w - 1) / 2).astype(np.float32)
+    map_y = (cos * dy - sin * dx + (h - 1) / 2).astype(np.float32)
+
+    # cv2.remap outputs fewer than 32767 rows, so very large stacks are resampled in several calls
+    per_call = max(32767 // side, 1)
+    patches = [cv2.remap(template_img, map_x[i:i + per_call].reshape(-1, side), map_y[i:i + per_call].reshape(-1, side), cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+               for i in range(0, len(map_x), per_call)]
+    return np.concatenate(patches).reshape(len(map_x), side, side)
+
+def log_polar_spectrum(image):
+    """
+    Computes the log-polar transform of the high-passed magnitude spectrum of an image, which turns a rotation and
+    a scaling of the image into a translation along its rows and columns and ignores any translation.
+
+    Args:
+        image (numpy.ndarray): The square grayscale image.
+
+    Returns:
+        numpy.ndarray: The (LOG_POLAR_SIZE, LOG_POLAR_SIZE) float32 transform, with one row per angle and one column
+                       per log radius.
+    """
+    size = LOG_POLAR_SIZE
+    image = cv2.resize(image.astype(np.float32), (size, size), interpolation=cv2.INTER_AREA)
+
+    # The window keeps the edges of the image from adding a cross to the spectrum
+    image = (image - np.mean(image)) * cv2.createHanningWindow((size, size), cv2.CV_32F)
+    spectrum = np.abs(np.fft.fftshift(scipy.fft.fft2(image, workers=-1))).astype(np.float32)
+
+    # The high-pass filter removes the low frequencies, which barely move under rotation and scaling
+    frequencies = np.cos(np.pi * np.linspace(-0.5, 0.5, size, dtype=np.float32))
+    spectrum *= 1 - np.outer(frequencies, frequencies)
+
+    return cv2.warpPolar(spectrum, (size, size), (size / 2, size / 2), size / 2, cv2.INTER_LINEAR | cv2.WARP_FILL_OUTLIERS | cv2.WARP_POLAR_LOG)
+
+def fast_fft_shape(shape):
+    """
+    Pads an image shape to the nearest size scipy's real FFT handles quickly (a product of small primes).
+
+    Args:
+        shape (tuple): The (height, width) of the image.
+
+    Returns:
+        tuple: The padded (height, width).
+    """
+    return tuple(scipy.fft.next_fast_len(int(n), real=True) for n in shape[:2])
+
 def compute_correlation(source_img, template_img):
     """
     Computes the correlation between the source image and the template image.
 
+    Both images are real, so real FFTs are used, which only compute half of the spectrum, in float32 and complex64
+    on every core. The images are zero padded to a fast FFT size, which only changes the correlation where the
+    template would wrap around the edge of the source.
+
     Parameters:
     source_img (numpy.ndarray): The source image.
     template_img (numpy.ndarray): The template image.
 
     Returns:
-    numpy.ndarray: The correlation between the source image and the template image.
+    numpy.ndarray: The correlation between the source image and the template image, with the shape of the source.
     """
-    # Compute the 2D Fourier transform of the source image
-    dft_source = np.fft.fft2(source_img)
+    fft_shape = fast_fft_shape(source_img.shape)
 
-    # Compute the 2D Fourier transform of the template image, with the same shape as the source image
-    dft_template = np.fft.fft2(template_img, s=source_img.shape)
+    # Compute the 2D Fourier transforms of the source and template images, zero padded to the same shape
+    dft_source = scipy.fft.rfft2(source_img.astype(np.float32), s=fft_shape, workers=-1)
+    dft_template = scipy.fft.rfft2(template_img.astype(np.float32), s=fft_shape, workers=-1)
 
-    # Compute the complex conjugate of the Fourier transform of the template image
-    dft_template_conj = np.conj(dft_template)
-
-    # Compute the inverse 2D Fourier transform of the product of the Fourier transforms of the source image 
+    # Compute the inverse 2D Fourier transform of the product of the Fourier transform of the source image
     # and the complex conjugate of the Fourier transform of the template image
-    corr = np.fft.ifft2(dft_source * dft_template_conj)
-
-    return np.abs(corr)
+    corr = scipy.fft.irfft2(dft_source * np.conj(dft_template), s=fft_shape, workers=-1, overwrite_x=True)
+
+    return np.abs(corr[:source_img.shape[0], :source_img.shape[1]])
+
+class FourierMatcher:
+    def __init__(self, source_img_path):
+        """
+        Loads, normalizes and transforms a source image once so that many templates can be matched against it.
+
+        The source is zero padded to a fast FFT size as in compute_correlation, so each match only costs the real
+        FFT of the template, a multiplication and an inverse real FFT. The padded template and the spectrum product
+        are written into buffers allocated once per thread, so matches can run in parallel threads.
+
+        Args:
+            source_img_path (str): Path to the source image file.
+        """
+        self.source_img_color = cv2.imread(source_img_path)
+        source_img = cv2.cvtColor(self.source_img_color, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        self.source_shape = source_img.shape
+        self.fft_shape = fast_fft_shape(source_img.shape)
+        source_img = zero_mean_normalize(source_img)
+        self.dft_source = scipy.fft.rfft2(source_img, s=self.fft_shape, workers=-1)
+        self.buffers = threading.local()
+
+        # Summed-area tables of the source and its square, from which the normalized cross-correlation reads the
+        # energy of the source under every template position in constant time
+        self.source_sum, self.source_sqsum = cv2.integral2(source_img, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        self.window_norms = lru_cache(maxsize=16)(self.compute_window_norms)
+        self.window_spectra = lru_cache(maxsize=4)(self.compute_window_spectra)
+        self.source_img = source_img
+
+    def thread_buffers(self):
+        """
+        Returns the padded template and spectrum product buffers of the calling thread, allocating them on first use.
+
+        Returns:
+            threading.local: The buffers, as its template and product attributes.
+        """
+        buffers = self.buffers
+        if not hasattr(buffers, 'template'):
+            buffers.template = np.zeros(self.fft_shape, dtype=np.float32)
+            buffers.product = np.empty(self.dft_source.shape, dtype=np.complex64)
+        return buffers
+
+    def cross_correlate(self, template_img):
+        """
+        Computes the signed correlation between the cached source image and a template image.
+
+        Args:
+            template_img (numpy.ndarray): The normalized template image.
+
+        Returns:
+            numpy.ndarray: The correlation, with the shape of the source image.
+        """
+        buffers = self.thread_buffers()
+        h, w = template_img.shape[:2]
+        buffers.template.fill(0)
+        buffers.template[:h, :w] = template_img
+
+        dft_template = scipy.fft.rfft2(buffers.template, workers=-1)
+        np.multiply(self.dft_source, np.conj(dft_template, out=dft_template), out=buffers.product)
+        corr = scipy.fft.irfft2(buffers.product, s=self.fft_shape, workers=-1)
+        return corr[:self.source_shape[0], :self.source_shape[1]]
+
+    def correlate(self, template_img):
+        """
+        Computes the magnitude of the correlation between the cached source image and a template image.
+
+        Args:
+            template_img (numpy.ndarray): The normalized template image.
+
+        Returns:
+            numpy.ndarray: The correlation, with the shape of the source image.
+        """
+        return np.abs(self.cross_correlate(template_img))
+
+    def compute_window_norms(self, h, w):
+        """
+        Computes the norm of the zero-mean source under every position of an h by w template from the summed-area
+        tables, in four lookups per position. Called through the self.window_norms cache, since every template of a
+        scale has the same size.
+
+        Args:
+            h (int): The height of the template.
+            w (int): The width of the template.
+
+        Returns:
+            numpy.ndarray: The (source height - h + 1, source width - w + 1) norms.
+        """
+        valid_h, valid_w = self.source_shape[0] - h + 1, self.source_shape[1] - w + 1
+
+        def window_sums(table):
+            return table[h:, w:] - table[:valid_h, w:] - table[h:, :valid_w] + table[:valid_h, :valid_w]
+
+        source_sum = window_sums(self.source_sum)
+        return np.sqrt(np.maximum(window_sums(self.source_sqsum) - source_sum ** 2 / (h * w), 0)).astype(np.float32)
+
+    def normalized_cross_correlate(self, template_img):
+        """
+        Computes the normalized cross-correlation coefficient of a template image at every position where it lies
+        fully inside the source image.
+
+        The numerator is the FFT correlation of the source with the zero-mean template. The denominator needs the
+        mean and variance of the source under each template position, which compute_window_norms reads from the
+        summed-area tables in four lookups per position, so the whole surface stays O(N log N). Unlike the global
+        normalization of correlate, bright textured areas do not dominate, and the values are comparable between
+        sources.
+
+        Args:
+            template_img (numpy.ndarray): The grayscale float32 template image.
+
+        Returns:
+            numpy.ndarray: The float32 coefficients in [-1, 1], of shape (source height - h + 1, source width - w + 1),
+                           with 0 wherever the source or the template is flat.
+        """
+        h, w = template_img.shape[:2]
+        template_img = template_img - np.mean(template_img)
+        template_norm = np.sqrt(np.sum(np.square(template_img, dtype=np.float64)))
+        valid_h, valid_w = self.source_shape[0] - h + 1, self.source_shape[1] - w + 1
+
+        # The template has zero mean, so the local mean of the source drops out of the numerator
+        numerator = self.cross_correlate(template_img)[:valid_h, :valid_w]
+        window_norms = self.window_norms(h, w)
+
+        # Flat windows have no defined coefficient; cancellation can leave them with a tiny positive norm
+        flat = window_norms <= 1e-3 * np.sqrt(h * w)
+        if template_norm == 0:
+            return np.zeros((valid_h, valid_w), dtype=np.float32)
+        ncc = numerator / (np.where(flat, 1, window_norms) * np.float32(template_norm))
+        ncc[flat] = 0
+        return np.clip(ncc, -1, 1, out=ncc)
+
+    def normalized_cross_correlate_batch(self, templates):
+        """
+        Computes the normalized cross-correlation surfaces of a stack of same-size templates, with the real FFTs of
+        the whole stack computed as one batch over its last two axes, on every core, and multiplied with the cached
+        source spectrum by broadcasting.
+
+        Args:
+            templates (numpy.ndarray): The (n, h, w) float32 templates.
+
+        Returns:
+            numpy.ndarray: The (n, source height - h + 1, source width - w + 1) coefficients, as returned by
+                           normalized_cross_correlate for each template.
+        """
+        n, h, w = templates.shape
+        valid_h, valid_w = self.source_shape[0] - h + 1, self.source_shape[1] - w + 1
+        templates = templates - templates.mean(axis=(1, 2), keepdims=True)
+        template_norms = np.sqrt(np.sum(np.square(templates, dtype=np.float64), axis=(1, 2))).astype(np.float32)
+
+        # The 2D transforms are split by axis: the row transforms only run on the h rows holding the templates, and
+        # the inverse row transforms only on the valid_h rows that are kept
+        dft_templates = scipy.fft.rfft(templates, n=self.fft_shape[1], axis=-1, workers=-1)
+        dft_templates = scipy.fft.fft(dft_templates, n=self.fft_shape[0], axis=-2, workers=-1, overwrite_x=True)
+        np.multiply(self.dft_source, np.conj(dft_templates, out=dft_templates), out=dft_templates)
+        products = scipy.fft.ifft(dft_templates, axis=-2, workers=-1, overwrite_x=True)[:, :valid_h]
+        numerators = scipy.fft.irfft(products, n=self.fft_shape[1], axis=-1, workers=-1)[:, :, :valid_w]
+
+        window_norms = self.window_norms(h, w)
+        flat = window_norms <= 1e-3 * np.sqrt(h * w)
+        ncc = numerators / (np.where(flat, 1, window_norms) * np.where(template_norms == 0, np.inf, template_norms)[:, None, None])
+        ncc[:, flat] = 0
+        return np.clip(ncc, -1, 1, out=ncc)
+
+    def sweep(self, template_img, rotation_angles, scale_factors, batch_size=8):
+        """
+        Searches the rotation and scale of a template relative to the source in one call, by matching every
+        rotation of every scale and keeping the best position of each.
+
+        The rotations of a scale are resampled together by template_stack and correlated batch_size at a time by
+        normalized_cross_correlate_batch, whose source norms are shared by the whole scale. Positions are scored by
+        the normalized cross-correlation coefficient so that patches of different scales are comparable.
+
+        Args:
+            template_img (numpy.ndarray): The grayscale float32 template image.
+            rotation_angles (list): The rotations in degrees of the template relative to the source.
+            scale_factors (list): The numbers of template pixels per source pixel.
+            batch_size (int, optional): The number of templates transformed at once, which bounds the memory to
+                                        about 2 * batch_size source-sized float32 arrays. Defaults to 8.
+
+        Returns:
+            list: One dict per (scale_factor, rotation_angle) pair, in that order, with the rotation_angle,
+                  scale_factor, the patch size, the top-left row and col of its best position in the source and
+                  the confidence of that position. Scales whose patch is empty or larger than the source are
+                  left out.
+        """
+        peaks = []
+        for scale_factor in scale_factors:
+            templates = template_stack(template_img, rotation_angles, scale_factor)
+            side = templates.shape[-1]
+            if len(templates) == 0 or side > min(self.source_shape):
+                continue
+
+            for start in range(0, len(templates), batch_size):
+                ncc = self.normalized_cross_correlate_batch(templates[start:start + batch_size])
+                best = ncc.reshape(len(ncc), -1).argmax(axis=1)
+                rows, cols = np.unravel_index(best, ncc.shape[1:])
+                for i, (row, col) in enumerate(zip(rows, cols)):
+                    peaks.append({
+                        'rotation_angle': rotation_angles[start + i],
+                        'scale_factor': scale_factor,
+                        'size': side,
+                        'row': int(row),
+                        'col': int(col),
+                        'confidence': float(ncc[i, row, col]),
+                    })
+        return peaks
+
+    def compute_window_spectra(self, side):
+        """
+        Computes the log-polar spectra of square source windows overlapping by 1 - LOG_POLAR_WINDOW_STEP. Called
+        through the self.window_spectra cache, since every template of a flight has the same size.
+
+        Args:
+            side (int): The side of the windows.
+
+        Returns:
+            tuple: The (top, left) of every window and their log-polar spectra.
+        """
+        step = max(int(side * LOG_POLAR_WINDOW_STEP), 1)
+        height, width = self.source_shape
+
+        def starts(length):
+            return sorted(set(range(0, length - side + 1, step)) | {length - side})
+
+        corners = [(top, left) for top in starts(height) for left in starts(width)]
+        return corners, [log_polar_spectrum(self.source_img[top:top + side, left:left + side]) for top, left in corners]
+
+    def estimate_rotation_scale(self, template_img):
+        """
+        Estimates the rotation and scale of a template relative to the source by Fourier-Mellin registration: the
+        log-polar spectrum of the central square of the template is phase correlated with that of every source
+        window, and the shift of the strongest response gives the rotation along the rows and the log of the scale
+        along the columns.
+
+        Spectra are symmetric, so the rotation is only known up to 180 degrees, and the translation search has to
+        try both.
+
+        Args:
+            template_img (numpy.ndarray): The grayscale float32 template image.
+
+        Returns:
+            tuple: The rotation_angle in [0, 180) degrees and the scale_factor, in the conventions of template_stack,
+                   and the phase correlation response, or None when the template is larger than the source.
+        """
+        h, w = template_img.shape[:2]
+        side = min(h, w)
+        if side > min(self.source_shape):
+            return None
+
+        top, left = (h - side) // 2, (w - side) // 2
+        template_spectrum = log_polar_spectrum(template_img[top:top + side, left:left + side])
+        (shift_x, shift_y), response = max((cv2.phaseCorrelate(template_spectrum, window_spectrum) for window_spectrum in self.window_spectra(side)[1]), key=lambda result: result[1])
+
+        # A tiny negative shift wraps to just under 180 in floating point, which is the same rotation as 0
+        rotation_angle = (shift_y * 360 / LOG_POLAR_SIZE) % 180
+        if rotation_angle >= 180 - 1e-6:
+            rotation_angle = 0.0
+        scale_factor = np.exp(shift_x * np.log(LOG_POLAR_SIZE / 2) / LOG_POLAR_SIZE)
+        return float(rotation_angle), float(scale_factor), float(response)
+
+    def match(self, template_img, num_peaks, mode='correlation'):
+        """
+        Correlates a template image with the source image and detects the strongest peaks.
+
+        Args:
+            template_img (numpy.ndarray): The grayscale float32 template image.
+            num_peaks (int): Number of peaks to detect.
+            mode (str, optional): "correlation" for the magnitude of the correlation of the globally normalized
+                                  images, with confidences relative to its highest value, or "ncc" for the
+                                  normalized cross-correlation coefficient, whose values are the confidences.
+                                  Defaults to "correlation".
+
+        Returns:
+            tuple: The correlation surface, the peak locations and the peak confidences.
+        """
+        if mode == 'ncc':
+            corr = self.normalized_cross_correlate(template_img)
+            peak_locations, peak_confidences = detect_peaks(corr, template_img.shape[0], num_peaks)
+            return corr, peak_locations, peak_confidences
+
+        corr = self.correlate(zero_mean_normalize(template_img))
+        peak_locations, peak_confidences = detect_peaks(corr, template_img.shape[0], num_peaks)
+        return corr, peak_locations, peak_confidences / np.max(corr)
 
 def detect_peaks(corr, min_dist, num_peaks):
     """
@@ -297,7 +663,7 @@ def draw_detections_on_image(source_img_color, peak_locations, peak_confidences,
 
     return correct_location_found, None
 
-def fourier_transform_match(source_img_path, template_img_path, num_peaks, rotation_angle, scale_factor, save_output, blur_levl = 0):
+def fourier_transform_match(source_img_path, template_img_path, num_peaks, rotation_angle, scale_factor, save_output, blur_levl = 0, matcher=None, mode='correlation', sweep_angles=None, sweep_scales=None, fourier_mellin=False):
     """
     Perform Fourier transform-based template matching on the source and template images.
 
@@ -307,15 +673,26 @@ def fourier_transform_match(source_img_path, template_img_path, num_peaks, rotat
         num_peaks (int): Number of peaks to detect.
         rotation_angle (int): The degree of rotation to apply to the template image.
         scale_factor (int): The pixel scale difference between the source and template images.
+        matcher (FourierMatcher, optional): A matcher already holding the source image, reused across calls
+                                            instead of loading the source again.
+        mode (str, optional): "correlation" or "ncc", see FourierMatcher.match. Defaults to "correlation".
+        sweep_angles (list, optional): Rotations in degrees searched with FourierMatcher.sweep before matching, in
+                                       which case the template is matched at the best rotation and scale found.
+                                       Defaults to None, matching the template as it is.
+        sweep_scales (list, optional): Scales searched with the sweep angles. Defaults to [1.0].
+        fourier_mellin (bool, optional): Whether to estimate the rotation and scale with
+                                         FourierMatcher.estimate_rotation_scale instead, and only sweep the two
+                                         rotations it leaves at the scale it finds. Defaults to False.
     """
     parent_dir = os.path.dirname(os.path.abspath(__file__))
     output_dir = os.path.join(parent_dir, 'output')
     os.makedirs(output_dir, exist_ok=True)
 
     # Read the source and template images
-    source_img_color = cv2.imread(source_img_path)
-    source_img = cv2.cvtColor(source_img_color, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    if matcher is None:
+        matcher = FourierMatcher(source_img_path)
     template_img = cv2.imread(template_img_path, 0).astype(np.float32)
+    edit_h, edit_w = template_img.shape[:2]
 
     # Rotate and crop the template image
     template_img, cropped_centroid = rotate_and_crop_template(template_img, rotation_angle, scale_factor)
@@ -324,22 +701,36 @@ def fourier_transform_match(source_img_path, template_img_path, num_peaks, rotat
     if save_output is True:
         cv2.imwrite(os.path.join(output_dir, 'rotated_template.png'), template_img)
 
+    if fourier_mellin:
+        estimate = matcher.estimate_rotation_scale(template_img)
+        if estimate is not None:
+            rotation_estimate, scale_estimate, _ = estimate
+            sweep_angles, sweep_scales = [rotation_estimate, rotation_estimate + 180], [scale_estimate]
+
+    # Resample the template at the rotation and scale whose best position correlates the most with the source. The
+    # patch keeps the center of the template, so the centroid check below still holds
+    peaks = matcher.sweep(template_img, sweep_angles, sweep_scales or [1.0]) if sweep_angles else []
+    if sweep_angles and not peaks:
+        print('No swept rotation and scale gives a template that fits in the source, matching the template as it is')
+    if peaks:
+        best = max(peaks, key=lambda peak: peak['confidence'])
+        print(f"Best rotation {best['rotation_angle']:.1f} and scale {best['scale_factor']:.2f} with confidence {best['confidence']:.2f}")
+        template_img = template_stack(template_img, [best['rotation_angle']], best['scale_factor'])[0]
+
+        # The crop centroid is in the rotated template, so it is rotated back into the source to check the match
+        rotation_matrix = cv2.getRotationMatrix2D((edit_w / 2, edit_h / 2), rotation_angle, 1)
+        cropped_centroid = tuple(cv2.invertAffineTransform(rotation_matrix) @ (*cropped_centroid, 1))
+
     # Get the height and width of the template image
     h, w = template_img.shape[:2]
 
-    source_img = zero_mean_normalize(source_img)
-    template_img = zero_mean_normalize(template_img)
-
-    corr = compute_correlation(source_img, template_img)
-
-    peak_locations, peak_confidences = detect_peaks(corr, h, num_peaks)
-    peak_confidences = peak_confidences / np.max(corr)  # Normalize confidence scores
+    corr, peak_locations, peak_confidences = matcher.match(template_img, num_peaks, mode)
 
     plot_correlation_matrix(corr, peak_locations, peak_confidences, os.path.join(output_dir, 'correlation_peaks.png'), save_output)
 
-    plot_fourier_transform(template_img, os.path.join(output_dir, 'fourier_template.png'), save_output)
+    plot_fourier_transform(zero_mean_normalize(template_img), os.path.join(output_dir, 'fourier_template.png'), save_output)
 
-    correct_location_found, correct_location_idx = draw_detections_on_image(source_img_color, peak_locations, peak_confidences, (h, w), os.path.join(output_dir, 'detected.png'), cropped_centroid, save_output)
+    correct_location_found, correct_location_idx = draw_detections_on_image(matcher.source_img_color, peak_locations, peak_confidences, (h, w), os.path.join(output_dir, 'detected.png'), cropped_centroid, save_output)
 
     return correct_location_found, correct_location_idx
 
@@ -352,13 +743,18 @@ if __name__ == '__main__':
     parser.add_argument('--rotation_angle', type=int, default=0, help='The degree of rotation to apply to the template image.')
     parser.add_argument('--scale_factor', type=int, default=5, help='The pixel scale difference between the source and template images.')
     parser.add_argument('--save_output', type=bool, default=True, help='Whether to save the output images.')
+    parser.add_argument('--mode', type=str, default='correlation', choices=['correlation', 'ncc'], help='Score positions by the correlation of the globally normalized images or by the normalized cross-correlation coefficient.')
+    parser.add_argument('--sweep_angles', type=float, nargs='+', default=None, help='Rotations in degrees of the template searched in one batched call before matching.')
+    parser.add_argument('--sweep_scales', type=float, nargs='+', default=None, help='Template pixels per source pixel searched with the sweep angles. Defaults to 1.')
+    parser.add_argument('--fourier_mellin', action='store_true', help='Estimate the rotation and scale of the template by log-polar phase correlation instead of sweeping them.')
 
     args = parser.parse_args()
     count = 0
 
     runs = 100
+    matcher = FourierMatcher(args.source_img)
     for _ in range(runs):
-        correct_location_found, correct_location_idx = fourier_transform_match(args.source_img, args.template_img, args.num_peaks, args.rotation_angle, args.scale_factor, args.save_output)
+        correct_location_found, correct_location_idx = fourier_transform_match(args.source_img, args.template_img, args.num_peaks, args.rotation_angle, args.scale_factor, args.save_output, matcher=matcher, mode=args.mode, sweep_angles=args.sweep_angles, sweep_scales=args.sweep_scales, fourier_mellin=args.fourier_mellin)
 
         if correct_location_found:
             count += 1
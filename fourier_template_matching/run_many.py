@@ -27,7 +27,7 @@ output_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
 os.makedirs(output_dir, exist_ok=True)
 
 
-def run_match(blur_level, run_idx, source_path, template_path, scale):
+def run_match(blur_level, run_idx, source_path, template_path, scale, matcher=None):
     correct_location_found, correct_location_idx = fourier_transform_match.fourier_transform_match(
         source_path,
         template_path,
@@ -35,7 +35,8 @@ def run_match(blur_level, run_idx, source_path, template_path, scale):
         0,
         scale,
         False,
-        blur_level
+        blur_level,
+        matcher
     )
     return (correct_location_found, correct_location_idx)
 
@@ -52,6 +53,9 @@ with tqdm.tqdm(distortion_levels, desc='Running each distortion level', unit='di
         distortion_2_output_path = f'{output_dir}/temp/2_{random_image}'
         cv2.imwrite(distortion_2_output_path, distortion_2)
 
+        # The source is the same for every run of this level, so load and transform it once
+        matcher = fourier_transform_match.FourierMatcher(distortion_1_output_path)
+
         for scale in tqdm.tqdm(scales, desc='Running each scale level', unit='scale levels', leave=False):
             blur_start_time = time()
             found_correct_location = 0
@@ -61,7 +65,7 @@ with tqdm.tqdm(distortion_levels, desc='Running each distortion level', unit='di
 
             with ThreadPoolExecutor() as executor:
                
-                futures = [executor.submit(run_match, 0, i, distortion_1_output_path, distortion_2_output_path, scale) for i in range(max_runs)]
+                futures = [executor.submit(run_match, 0, i, distortion_1_output_path, distortion_2_output_path, scale, matcher) for i in range(max_runs)]
                 for future in as_completed(futures):
                     try:
                         correct_location_found, correct_location_idx = future.result()